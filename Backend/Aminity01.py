@@ -1,6 +1,10 @@
 from BaseAgent import BaseAgent
+from deadline import Deadline
+from gazetteer import lookup_place
 import re
 import requests
+
+GEOCODE_TIMEOUT_S = 10  # Nominatim request cap; lowered further when the question is short on time
 class AmenityAgent(BaseAgent):
     def __init__(self, api_key):
         self.pre_prompt = (
@@ -16,13 +20,13 @@ class AmenityAgent(BaseAgent):
         self.coordinates = {}
         
 
-    def extract_place_names(self, prompt):
-        response = self.send_prompt(prompt)
+    def extract_place_names(self, prompt, timeout=None):
+        response = self.send_prompt(prompt, timeout=timeout)
         place_names = [name.strip() for name in response.split(",")]   
         print(place_names)
         return place_names
 
-    def get_coordinates(self, place_name):
+    def get_coordinates(self, place_name, timeout=GEOCODE_TIMEOUT_S):
         url = "https://nominatim.openstreetmap.org/search"
         params = {
             "q": place_name,
@@ -33,7 +37,7 @@ class AmenityAgent(BaseAgent):
             "bounded": 1
         }
        
-        response = requests.get(url, params=params, headers={"User-Agent": "geo_agent"})
+        response = requests.get(url, params=params, headers={"User-Agent": "geo_agent"}, timeout=timeout)
         data = response.json()
         if data:
             place = data[0]
@@ -46,6 +50,20 @@ class AmenityAgent(BaseAgent):
             }
         else:
             return None
+    def lookup_local(self, place_name):
+        """Coordinates from the offline neighbourhood/district gazetteer, in get_coordinates' format"""
+        entry = lookup_place(place_name)
+        if entry is None:
+            return None
+        print(f"📍 {place_name}: {entry['kind']} {entry['name']} (local gazetteer)")
+        return {
+            "name": f"{entry['name']}, Barcelona",
+            "lat": str(entry["lat"]),
+            "lon": str(entry["lon"]),
+            "osm_type": None,
+            "osm_id": None
+        }
+
     def return_mixed_prompt(self):
         """
         Replaces each place name in the prompt with the name + its coordinates.
@@ -59,18 +77,30 @@ class AmenityAgent(BaseAgent):
             mixed_prompt = re.sub(pattern, replacement, mixed_prompt)
         return mixed_prompt
     
-    def find_coordinates_for_prompt(self, prompt):
+    def find_coordinates_for_prompt(self, prompt, deadline=None):
         """
         High-level function: detects place names and returns coordinates for each.
-        Stores the results in self.coordinates.
+        Stores the results in self.coordinates. With a Deadline, names that no longer
+        fit in the budget are skipped and the coordinates found so far are returned.
         """
+        deadline = deadline or Deadline(None)
         self.prompt = prompt
         self.coordinates.clear()  # Clear previous data
-        place_names = self.extract_place_names(prompt)
-        for name in place_names:
-            coord = self.get_coordinates(name)
+        place_names = self.extract_place_names(prompt, timeout=deadline.timeout(30))
+        for i, name in enumerate(place_names):
+            if not deadline.allows(2):
+                deadline.stop("geocoding", f"skipped {len(place_names) - i} of {len(place_names)} place names")
+                break
+            coord = self.lookup_local(name)
+            if coord is None:
+                try:
+                    coord = self.get_coordinates(name, timeout=deadline.timeout(GEOCODE_TIMEOUT_S))
+                except requests.RequestException as e:
+                    print(f"⚠️ Geocoding failed for {name}: {e}")
+                    coord = None
             if coord:
                 self.coordinates[name] = coord
+        deadline.mark("geocoding", f"{len(self.coordinates)} locations")
         
         # Start with the original prompt
         self.mixed_prompt = self.prompt
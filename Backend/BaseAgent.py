@@ -16,8 +16,8 @@ class BaseAgent:
         self.pre_prompt = pre_prompt  # New section for pre-prompt
         self.temperature = temperature
 
-    def send_prompt(self, query):
-        """Send a prompt to OpenAI and get response"""
+    def send_prompt(self, query, timeout=None):
+        """Send a prompt to OpenAI and get response (timeout in seconds, e.g. from a Deadline)"""
         messages = [
             {"role": "system", "content": self.personality}
         ]
@@ -27,9 +27,11 @@ class BaseAgent:
 
         messages.append({"role": "user", "content": query})
 
+        request_options = {"timeout": timeout} if timeout is not None else {}
         completion = self.client.chat.completions.create(
             model=self.model,
             messages=messages,
-            temperature=self.temperature
+            temperature=self.temperature,
+            **request_options
         )
         return completion.choices[0].message.content
@@ -1,10 +1,61 @@
 from BaseAgent import BaseAgent
+from deadline import Deadline
+from lazydata import LazyDataset
+from spatial import standardize_layer, has_metric_points, projection_cache
+from pollution import add_band_columns, band_index, register_layer
+from routing import street_graph
 import os
+import threading
 import pandas as pd
 import requests
 import geopandas as gpd
 import osmnx as ox
 
+OSM_FETCH_ESTIMATE_S = 15  # Typical Overpass round trip; fetches that no longer fit the deadline are skipped
+
+_loaded_layers = {}  # Absolute path -> (file signature, layer), shared by the warm-up and every query
+_loading_locks = {}
+_loaded_layers_lock = threading.Lock()
+
+
+def _read_layer(file_path, nrows=None):
+    data = add_band_columns(standardize_layer(pd.read_csv(file_path, nrows=nrows)))
+    if nrows is None and has_metric_points(data):
+        projection_cache.point_index(data)
+    if nrows is None and "rang_band" in data.columns and "geometry" in data.columns:
+        band_index(data)
+        street_graph(data)
+        register_layer(data)
+    return data
+
+
+def load_layer(file_path, nrows=None):
+    """
+    Reads a local CSV and standardizes it (GeoDataFrame in EPSG:4326, utm_x/utm_y on point layers,
+    parsed rang_* columns on pollution layers). Point layers get their nearest-neighbour index and
+    pollution layers their band bitmaps and street graph built here, before any generated code
+    runs; a full pollution layer is also registered as the one its subsets' exposure rasters come
+    from. The DataCollectorAgent loads every CSV through this function.
+
+    A full read is kept for the process until the file changes, so the warm-up and every query
+    share one loaded layer and everything derived from it. Each caller gets its own copy
+    (projection_cache.share) to add columns to.
+    """
+    if nrows is not None:
+        return _read_layer(file_path, nrows)
+
+    key = os.path.abspath(file_path)
+    with _loaded_layers_lock:
+        lock = _loading_locks.setdefault(key, threading.Lock())
+    with lock:  # One read per file at a time: concurrent queries wait for it instead of repeating it
+        stat = os.stat(file_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        loaded = _loaded_layers.get(key)
+        if loaded is None or loaded[0] != signature:
+            loaded = _loaded_layers[key] = (signature, _read_layer(file_path))
+    return projection_cache.share(loaded[1])
+
+
 class DataCollectorAgent(BaseAgent):
     def __init__(self, api_key, data_dir="./CSV"):
         super().__init__(api_key)
@@ -89,7 +140,14 @@ class DataCollectorAgent(BaseAgent):
         print(f"⚠️ No specific OSM tags found for {dataset_name}. Using generic amenity tag.")
         return {'amenity': name_lower.split()[0]}
 
-    def fetch_data(self, datasets: list, coordinates: dict):
+    def fetch_data(self, datasets: list, coordinates: dict, deadline=None, lazy=True):
+        """
+        Collects the requested datasets. By default nothing is downloaded or read here:
+        each entry is a LazyDataset that loads on first use (see MainAgent._build_exec_globals),
+        so layers the generated code never references are never loaded. lazy=False loads
+        everything now (scripts that inspect every layer). Returns (all_data, csv_dirs).
+        """
+        deadline = deadline or Deadline(None)
         all_data = {}  # Changed from list to dictionary
         csv_dirs = {}  # Tag → CSV file path
         seen_tags = set()  # Avoid duplicate loads
@@ -111,12 +169,28 @@ class DataCollectorAgent(BaseAgent):
 
             radius_km = dataset.get("radius_km", 2.0)
            
-            if source == "osm":
+            if source == "osm" and lazy:
+                all_data[name] = LazyDataset(
+                    name, lambda n=name, l=location, r=radius_km: self._fetch_osm_data_within(n, l, r, deadline), source="osm"
+                )
+            elif source == "osm":
+                if not deadline.allows(OSM_FETCH_ESTIMATE_S):
+                    deadline.stop("fetching", f"skipped OSM layer '{name}'")
+                    continue
                 data = self._fetch_osm_data(name, location, radius_km)
                 if not data.empty:
                     all_data[name] = data  # Store with dataset name as key
             else:
-                if tag not in seen_tags:
+                if tag not in seen_tags and lazy:
+                    seen_tags.add(tag)
+                    file_path = self._resolve_local_csv(tag)
+                    if file_path:
+                        csv_dirs[tag] = file_path
+                        all_data[tag] = LazyDataset(
+                            tag, lambda p=file_path: self._load_csv(p),
+                            columns_hint=lambda p=file_path: self._load_csv(p, nrows=1).columns
+                        )
+                elif tag not in seen_tags:
                     data, file_path = self._fetch_local_csv(tag)
                     seen_tags.add(tag)
                     if file_path:
@@ -126,8 +200,16 @@ class DataCollectorAgent(BaseAgent):
                 else:
                     data = pd.DataFrame()  # Skip re-fetch
 
+        deadline.mark("fetching", f"{len(all_data)} datasets")
         return all_data, csv_dirs
 
+    def _fetch_osm_data_within(self, dataset_name, location, radius_km, deadline):
+        """_fetch_osm_data for a lazy handle: skipped (empty layer) once the fetch no longer fits the deadline."""
+        if not deadline.allows(OSM_FETCH_ESTIMATE_S):
+            deadline.stop("fetching", f"skipped OSM layer '{dataset_name}'")
+            return gpd.GeoDataFrame()
+        return self._fetch_osm_data(dataset_name, location, radius_km)
+
     def _fetch_osm_data(self, dataset_name, location, radius_km):
         print(f"📍 Fetching OSM data for: {dataset_name} at {location}")
         tags = self._determine_osm_tags(dataset_name)
@@ -139,12 +221,22 @@ class DataCollectorAgent(BaseAgent):
         try:
             gdf = ox.features_from_point(center_point, tags=tags, dist=radius_km * 1000)
             print(f"✅ Fetched {len(gdf)} features from OSM.")
-            return gdf
+            return standardize_layer(gdf)
         except Exception as e:
             print(f"❌ Error fetching OSM data: {e}")
             return gpd.GeoDataFrame()
 
     def _fetch_local_csv(self, dataset_name):
+        file_path = self._resolve_local_csv(dataset_name)
+        if file_path:
+            return self._load_csv(file_path), file_path
+        return pd.DataFrame(), None
+
+    def _load_csv(self, file_path, nrows=None):
+        return load_layer(file_path, nrows)
+
+    def _resolve_local_csv(self, dataset_name):
+        """Finds the CSV file for a dataset name/tag without reading it. Returns the path or None."""
         print(f"🔍 Searching for CSV file for: {dataset_name}")
 
         dataset_key = dataset_name.lower().strip().replace(" ", "_")
@@ -154,31 +246,35 @@ class DataCollectorAgent(BaseAgent):
             "air_pollution_levels": [
                 "air pollution", "co2", "carbon footprint", "emission", "pollution", "air quality"
             ],
-            "bicingstations": [
+            "bicing": [
                 "bicing", "bike sharing", "bike stations", "bicing station", "bicycle rental"
             ]
         }
+        # Earlier file names of the same layers, still accepted
+        legacy_filenames = {
+            "bicing": ["bicingstations"]
+        }
 
         # Alias resolution
-        resolved_filename = None
+        candidates = []
         for filename, aliases in alias_map.items():
             if any(alias in dataset_key for alias in aliases):
-                resolved_filename = filename + ".csv"
+                candidates = [name + ".csv" for name in [filename] + legacy_filenames.get(filename, [])]
                 break
 
         # Fallback partial filename match
-        if not resolved_filename:
+        if not candidates:
             for file in os.listdir(self.data_dir):
                 if file.lower().endswith(".csv") and dataset_key in file.lower():
-                    resolved_filename = file
+                    candidates = [file]
                     break
 
         # Final check
-        if resolved_filename:
+        for resolved_filename in candidates:
             file_path = os.path.join(self.data_dir, resolved_filename)
             if os.path.exists(file_path):
                 print(f"📄 Found CSV: {file_path}")
-                return pd.read_csv(file_path), file_path
+                return file_path
 
         print("⚠️ No matching CSV found.")
-        return pd.DataFrame(), None
+        return None
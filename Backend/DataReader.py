@@ -1,19 +1,41 @@
 from BaseAgent import BaseAgent
+from deadline import Deadline
+from lazydata import LazyDataset
 import pandas as pd
 
+ANALYSIS_ESTIMATE_S = 8  # One gpt-3.5 description; optional, skipped when the question is short on time
+
 class DataReaderAgent(BaseAgent):
     def __init__(self, api_key):
         super().__init__(api_key)
         self.model = "gpt-3.5-turbo"
 
-    def analyze_dataset(self, dataset_dict):
+    def analyze_dataset(self, dataset_dict, deadline=None):
         """
         Analyzes each dataset in the dictionary using GPT-3.5 Turbo.
         Returns a dictionary with dataset names as keys and their analysis as values.
+        Descriptions are optional: with a Deadline they are skipped once time runs short.
+        LazyDataset handles that are not loaded yet get a static note instead of being loaded.
         """
+        deadline = deadline or Deadline(None)
         analysis_results = {}
         
         for dataset_name, data in dataset_dict.items():
+            if isinstance(data, LazyDataset):
+                if not data.is_loaded:
+                    columns = data.peek_columns()
+                    analysis_results[dataset_name] = (
+                        f"{data.source} layer, loaded only if the analysis code uses it"
+                        + (f"; columns: {columns}" if columns else "")
+                    )
+                    continue
+                data = data.resolve()
+
+            if not deadline.allows(ANALYSIS_ESTIMATE_S):
+                deadline.stop("describing", f"skipped description of '{dataset_name}'")
+                analysis_results[dataset_name] = "Analysis skipped (time budget)"
+                continue
+
             print(f"📊 Analyzing dataset: {dataset_name}")
             
             # Create prompt for GPT-3.5 Turbo
@@ -38,7 +60,7 @@ class DataReaderAgent(BaseAgent):
             
             # Get analysis from GPT
             try:
-                analysis = self.send_prompt(prompt)
+                analysis = self.send_prompt(prompt, timeout=deadline.timeout(30))
                 analysis_results[dataset_name] = analysis
             except Exception as e:
                 print(f"❌ Error analyzing {dataset_name}: {str(e)}")
@@ -46,7 +68,7 @@ class DataReaderAgent(BaseAgent):
         print("aada"+analysis_results[dataset_name])
         return analysis_results
 
-    def create_dataset_with_analysis(self, dataset_dict):
+    def create_dataset_with_analysis(self, dataset_dict, deadline=None):
         """
         Creates a new dictionary where each value is a tuple containing:
         1. The original dataset
@@ -56,7 +78,7 @@ class DataReaderAgent(BaseAgent):
         dict: {dataset_name: (dataset, analysis)}
         """
         # First get the analysis for all datasets
-        analysis_results = self.analyze_dataset(dataset_dict)
+        analysis_results = self.analyze_dataset(dataset_dict, deadline)
         
         # Create new dictionary with (dataset, analysis) tuples
         enriched_datasets = {}
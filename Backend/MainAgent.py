@@ -5,29 +5,142 @@ import pandas as pd
 import geopandas as gpd
 import numpy as np
 import re
+import time
+import traceback
+import uuid
+from shapely.geometry import Point, LineString
+from shapely import wkt
+from diagnostics import SpatialDiagnostics
+from deadline import Deadline
+from cancellation import Cancelled, abort_on_cancel
+from lazydata import LazyDataset, materialize, referenced_names, prefetch
+from capture import BoundedOutput, echo, persist_attempt_log
+from spatial import METRIC_CRS, projection_cache, project_point
+from pollution import exposure_at, band_labels, band_index
+from ranking import rank_top_k
+import routing
+from accessibility import access_at_coords, coverage_gaps
+from mainAgentUtils import (
+    GENERATED_FILENAME, estimate_tokens, traceback_line_numbers, numbered_window, apply_unified_diff
+)
+
+CORRECTION_ESTIMATE_S = 25  # One gpt-4o correction plus re-execution
+
+DIFF_REPLY_FORMAT = """
+        REPLY FORMAT:
+        - Reply ONLY with a unified diff against the script (--- a/generated.py, +++ b/generated.py, @@ hunks)
+        - Context and removed lines must match the script exactly, without the line-number prefix
+        - Change only what is needed; the script must still write results.csv with name, longitude, latitude
+        """
 
 class MainAgent(BaseAgent):
     def __init__(self, api_key):
         super().__init__(api_key)
         self.model = "gpt-4o"  # Using GPT-4 for better code generation
+        self.diagnostics = SpatialDiagnostics()  # Filled by the spatial helpers during exec
+        self.radius_floor_km = None  # Set by local empty-result recovery
+        self.max_local_recoveries = 3
+        self.correction_token_budget = 12000  # Per question, across all correction prompts
+        self.correction_tokens_used = 0
+        self.current_deadline = Deadline(None)  # Replaced per question by execute_question
+        self.current_question_id = "adhoc"  # Names the per-attempt log directory
 
     def generate_analysis_code(self, user_question, enriched_datasets, coordinates=None):
         """
-        Generates Python code (or a prompt) for spatial analysis using enriched datasets and (optionally) coordinates.
+        Generates Python code for spatial analysis using enriched datasets and (optionally) coordinates.
+        
         Args:
-            user_question (str): The user's query (e.g. "Find residential buildings in low emission zones in Barceloneta").
-            enriched_datasets (dict): A dictionary (or a string prompt) containing (or describing) the datasets (e.g. residential buildings, emission zones).
-            coordinates (dict, optional): A dictionary (or a string prompt) (e.g. { "Barceloneta": { "lat": 41.3809, "lon": 2.191 } }) or None.
+            user_question (str): The user's query (e.g. "Find residential buildings in low emission zones in Barceloneta")
+            enriched_datasets (dict): Dictionary with dataset_name: (dataset, analysis) tuples
+            coordinates (dict, optional): Extracted coordinates from AmenityAgent (e.g. {'Barceloneta': {'lat': '41.38', 'lon': '2.19'}})
+        
         Returns:
-            str: A Python code snippet (or a prompt) (e.g. """\n# Generated analysis code (or prompt) for spatial analysis\n\n# 1. Define target center (using coordinates if provided) \n{self._generate_location_centers_code(coordinates)}\n\n# 2. Include mandatory helper functions (using instance methods) \n# (Note: Do not define a global filter_by_distance; use self.filter_by_distance_with_fallback or self.filter_by_distance.) \n\n# 3. Validate and convert emission data (using a helper) \nemission_gdf = validate_and_convert_emission_data(air_pollution_levels) \n\n# 4. Filter residential buildings (using self.filter_by_distance_with_fallback) \n{self._generate_location_filter_code(coordinates)}\n\n# 5. Filter emission zones (using self.filter_by_distance_with_fallback) \n{self._generate_emission_filter_code(coordinates)}\n\n# 6. (Optional) Print debug info (using a helper) \n{self._generate_debug_coordinates_code(coordinates)}\n\n# 7. (Optional) Proximity analysis (using self.find_nearest_emission_for_location) \n# (e.g. loop over nearby_buildings and call self.find_nearest_emission_for_location(building, nearby_emissions) ) \n\n# 8. (Optional) Combine (or export) results (e.g. pd.DataFrame(...) and .to_csv(...)) \n\n"""")
+            str: Generated Python code
         """
-        # (Optional) If enriched_datasets is a prompt (or coordinates is a prompt), return a prompt (e.g. """\n# Prompt for spatial analysis (using enriched_datasets and coordinates)""")
-        if (isinstance(enriched_datasets, str) or (coordinates is not None and isinstance(coordinates, str))):
-             return ("""\n# Prompt for spatial analysis (using enriched_datasets and coordinates) (e.g. """\n# Generated analysis code (or prompt) for spatial analysis\n\n# 1. Define target center (using coordinates if provided) \n{self._generate_location_centers_code(coordinates)}\n\n# 2. Include mandatory helper functions (using instance methods) \n# (Note: Do not define a global filter_by_distance; use self.filter_by_distance_with_fallback or self.filter_by_distance.) \n\n# 3. Validate and convert emission data (using a helper) \nemission_gdf = validate_and_convert_emission_data(air_pollution_levels) \n\n# 4. Filter residential buildings (using self.filter_by_distance_with_fallback) \n{self._generate_location_filter_code(coordinates)}\n\n# 5. Filter emission zones (using self.filter_by_distance_with_fallback) \n{self._generate_emission_filter_code(coordinates)}\n\n# 6. (Optional) Print debug info (using a helper) \n{self._generate_debug_coordinates_code(coordinates)}\n\n# 7. (Optional) Proximity analysis (using self.find_nearest_emission_for_location) \n# (e.g. loop over nearby_buildings and call self.find_nearest_emission_for_location(building, nearby_emissions) ) \n\n# 8. (Optional) Combine (or export) results (e.g. pd.DataFrame(...) and .to_csv(...)) \n\n"""")
+        dataset_info = self._prepare_dataset_summary(enriched_datasets)
+        coordinates_info = self._prepare_coordinates_info(coordinates)
+        
+        prompt = f"""
+        You are an expert data analyst and Python programmer. Generate ONLY Python code to answer the user's question using the available datasets.
+
+        USER QUESTION: "{user_question}"
+
+        AVAILABLE DATASETS:
+        {dataset_info}
 
-        # (Otherwise) Generate a Python code snippet (or prompt) (e.g. """\n# Generated analysis code (or prompt) for spatial analysis\n\n# 1. Define target center (using coordinates if provided) \n{self._generate_location_centers_code(coordinates)}\n\n# 2. Include mandatory helper functions (using instance methods) \n# (Note: Do not define a global filter_by_distance; use self.filter_by_distance_with_fallback or self.filter_by_distance.) \n\n# 3. Validate and convert emission data (using a helper) \nemission_gdf = validate_and_convert_emission_data(air_pollution_levels) \n\n# 4. Filter residential buildings (using self.filter_by_distance_with_fallback) \n{self._generate_location_filter_code(coordinates)}\n\n# 5. Filter emission zones (using self.filter_by_distance_with_fallback) \n{self._generate_emission_filter_code(coordinates)}\n\n# 6. (Optional) Print debug info (using a helper) \n{self._generate_debug_coordinates_code(coordinates)}\n\n# 7. (Optional) Proximity analysis (using self.find_nearest_emission_for_location) \n# (e.g. loop over nearby_buildings and call self.find_nearest_emission_for_location(building, nearby_emissions) ) \n\n# 8. (Optional) Combine (or export) results (e.g. pd.DataFrame(...) and .to_csv(...)) \n\n"""")
+        LOCATIONS MENTIONED IN THE QUESTION:
+        {coordinates_info}
 
-        return ("""\n# Generated analysis code (or prompt) for spatial analysis\n\n# 1. Define target center (using coordinates if provided) \n{self._generate_location_centers_code(coordinates)}\n\n# 2. Include mandatory helper functions (using instance methods) \n# (Note: Do not define a global filter_by_distance; use self.filter_by_distance_with_fallback or self.filter_by_distance.) \n\n# 3. Validate and convert emission data (using a helper) \nemission_gdf = validate_and_convert_emission_data(air_pollution_levels) \n\n# 4. Filter residential buildings (using self.filter_by_distance_with_fallback) \n{self._generate_location_filter_code(coordinates)}\n\n# 5. Filter emission zones (using self.filter_by_distance_with_fallback) \n{self._generate_emission_filter_code(coordinates)}\n\n# 6. (Optional) Print debug info (using a helper) \n{self._generate_debug_coordinates_code(coordinates)}\n\n# 7. (Optional) Proximity analysis (using self.find_nearest_emission_for_location) \n# (e.g. loop over nearby_buildings and call self.find_nearest_emission_for_location(building, nearby_emissions) ) \n\n# 8. (Optional) Combine (or export) results (e.g. pd.DataFrame(...) and .to_csv(...)) \n\n"""")
+        CRITICAL REQUIREMENTS:
+        1. Generate ONLY executable Python code - NO explanations, NO markdown, NO text outside code
+        2. The final output MUST be a CSV file 'results.csv' with exactly 3 columns: 'name', 'longitude', 'latitude'
+        3. Use these EXACT dataset variable names, they are already defined: {list(self._get_dataset_variable_names(enriched_datasets).keys())}
+        4. DO NOT use pd.read_csv(), gpd.read_file(), or any file loading operations
+        5. Use proper 4-space indentation and PREFER simple if statements over try/except
+
+        HELPERS ALREADY DEFINED (do NOT redefine them):
+        - filter_by_distance(gdf, center_point, max_distance_km) -> features within the radius
+        - filter_by_distance_with_fallback(gdf, center_point, max_distance_km=10.0) -> widens the radius if nothing is found
+        - filter_by_distance_multi(gdf, location_centers, max_distance_km=1.0, how='union') -> features near several
+          centers in one pass; how='union' | 'intersection' | 'nearest' (adds 'nearest_center', 'center_distance_m')
+          | 'pairs' (one row per feature-center match); max_distance_km may be a {{name: km}} dict
+        - find_nearest_emission_for_location(location_row, emission_gdf) -> nearest pollution row (has 'Rang'), or None if there is none
+        - pollution_exposure(locations_gdf, emission_gdf) -> locations_gdf plus 'exposure_ugm3' and 'exposure_band'
+          (a 'Rang' label); vectorized, prefer it over per-row matching and pass the FULL pollution layer
+        - filter_by_pollution(emission_gdf, min_ugm3=None, max_ugm3=None) -> segments whose band lies in the range
+        - top_k(gdf, k, by='exposure', largest=False, center_point=None, radius_km=None, emission_gdf=None) -> the k best
+          rows in rank order with 'score' and 'rank'; by is 'exposure', 'distance', a numeric column, a callable or a
+          weighted mix like {{'exposure': 1.0, 'distance': 0.01}}. Use it for "N least/most ..." questions instead of sorting
+        - cleanest_route(emission_gdf, start_point, end_point, pollution_weight=2.0) -> the least-polluted walking route
+          between two location centers: street segments in walking order with 'step', 'length_m', 'cumulative_m',
+          'exposure_ugm3' (totals in route.attrs['route']); pollution_weight=0 gives the shortest route
+        - path_exposure(emission_gdf, path) -> {{'length_m', 'mean_ugm3', 'max_ugm3', 'mean_band'}} along a route
+          GeoDataFrame, a LineString or a list of Points
+        - Pollution layers already have numeric rang_lower_ugm3 / rang_upper_ugm3 / rang_mid_ugm3 and an ordered
+          categorical rang_band: sort or compare with these, never parse 'Rang' strings
+        - points_within_radius(points_gdf, center_point, radius_km) -> stations/stops in the radius, closest first, with 'distance_m'
+        - k_nearest_points(points_gdf, center_point, k=5) -> the k closest stations/stops with 'distance_m'
+        - nearest_point_for_each(locations_gdf, points_gdf) -> locations_gdf plus 'nearest_point' (points_gdf index label)
+          and 'nearest_distance_m'; one batch call, use it instead of looping over rows
+        - transit_access(locations_gdf, modes=None) -> locations_gdf plus '<mode>_nearest_m', '<mode>_within_300m' and
+          '<mode>_within_500m' for modes 'bus', 'metro', 'fgc', 'tram', 'rail', 'bicing' (precomputed grid, no stop data needed)
+        - transit_gaps(mode='bicing', min_distance_m=500, center_point=None, radius_km=None) -> city grid cells (points with
+          'nearest_m', rep_lon/rep_lat) at least min_distance_m from that mode, farthest first: "where is X missing" questions
+        - Point and wkt are imported; center points are Point(longitude, latitude) in EPSG:4326
+        - Datasets with coordinates are already GeoDataFrames in EPSG:4326 (do NOT rebuild geometry);
+          every feature has rep_lon/rep_lat plus utm_x/utm_y in metres (EPSG:25831) for any custom distance maths,
+          and lines/polygons have metric bounding boxes bbox_minx/bbox_miny/bbox_maxx/bbox_maxy for quick prefilters
+
+        FOLLOW THIS SKELETON (adapt it to the question):
+        # 1. Location centers
+        {self._generate_location_centers_code(coordinates)}
+
+        # 2. Pollution data is already a GeoDataFrame built from geometry_wkt (only if pollution is needed)
+        # emission_gdf = {self._get_emission_dataset_name(enriched_datasets)}
+
+        # 3. Filter layers around the target center
+        {self._generate_location_filter_code(coordinates)}
+        {self._generate_emission_filter_code(coordinates)}
+
+        # 4. Debug info
+        {self._generate_debug_coordinates_code(coordinates)}
+
+        # 5. Proximity analysis, e.g. nearby_buildings = pollution_exposure(nearby_buildings, emission_gdf)
+        #    or, for "N least/most exposed": top_k(residential_building_locations, 20, by='exposure',
+        #    center_point=target_center, radius_km=1.0, emission_gdf=emission_gdf)
+
+        # 6. Every layer has rep_lon / rep_lat (a point on each feature): use them as longitude / latitude
+        #    instead of .geometry.centroid, then export
+        # result[['name', 'longitude', 'latitude']].to_csv('results.csv', index=False)
+
+        IMPORTANT: Return ONLY Python code. Include data validation and debugging prints.
+        """
+        
+        try:
+            generated_code = self.send_prompt(prompt, timeout=self.current_deadline.timeout(90))
+            return self._clean_generated_code(generated_code)
+        except Exception as e:
+            return f"# Error generating code: {str(e)}\nprint('Error: Could not generate analysis code')"
 
     def _prepare_dataset_summary(self, enriched_datasets):
         """
@@ -36,9 +149,14 @@ class MainAgent(BaseAgent):
         summary = []
         
         for dataset_name, (dataset, analysis) in enriched_datasets.items():
-            # Get basic dataset info
-            columns = list(dataset.columns)
-            row_count = len(dataset)
+            # Get basic dataset info (without loading lazy handles)
+            if isinstance(dataset, LazyDataset) and not dataset.is_loaded:
+                columns = dataset.peek_columns() or []
+                row_count = "unknown (loaded when the code uses it)"
+            else:
+                dataset = materialize(dataset)
+                columns = list(dataset.columns)
+                row_count = len(dataset)
             
             # Check if it has geometry (spatial data)
             has_geometry = 'geometry' in columns
@@ -181,6 +299,49 @@ Dataset: {dataset_name}
             dataset_variables[var_name] = dataset
         return dataset_variables
 
+    def _build_exec_globals(self, enriched_datasets, code=None):
+        """
+        Prepares the execution environment: libraries, datasets and the spatial helpers.
+        Resets self.diagnostics so the helpers record into a clean slate for this run.
+        When code is given, only the datasets it references are injected, so lazy
+        handles for unused layers are never loaded.
+        """
+        exec_globals = {
+            'pd': pd,
+            'gpd': gpd,
+            'np': np,
+            'os': os,
+            'Point': Point,
+            'wkt': wkt,
+            'self': self,
+            'filter_by_distance': self.filter_by_distance,
+            'filter_by_distance_with_fallback': self.filter_by_distance_with_fallback,
+            'find_nearest_emission_for_location': self.find_nearest_emission_for_location,
+            'pollution_exposure': self.pollution_exposure,
+            'filter_by_pollution': self.filter_by_pollution,
+            'top_k': self.top_k,
+            'cleanest_route': self.cleanest_route,
+            'path_exposure': self.path_exposure,
+            'filter_by_distance_multi': self.filter_by_distance_multi,
+            'points_within_radius': self.points_within_radius,
+            'k_nearest_points': self.k_nearest_points,
+            'nearest_point_for_each': self.nearest_point_for_each,
+            'transit_access': self.transit_access,
+            'transit_gaps': self.transit_gaps,
+            '__builtins__': __builtins__
+        }
+
+        # Add datasets to execution environment (loading referenced lazy handles concurrently)
+        dataset_variables = self._get_dataset_variable_names(enriched_datasets)
+        if code is not None:
+            used = referenced_names(code, dataset_variables)
+            dataset_variables = {name: d for name, d in dataset_variables.items() if name in used}
+        dataset_variables = prefetch(dataset_variables)
+        exec_globals.update(dataset_variables)
+
+        self.diagnostics.reset({id(data): name for name, data in dataset_variables.items()})
+        return exec_globals
+
     def execute_code(self, code, enriched_datasets):
         """
         Executes the generated Python code with the datasets in scope.
@@ -194,22 +355,12 @@ Dataset: {dataset_name}
         """
         print("🚀 Executing generated code...")
         
-        # Prepare execution environment
-        exec_globals = {
-            'pd': pd,
-            'gpd': gpd,
-            'np': np,
-            'os': os,
-            '__builtins__': __builtins__
-        }
-        
-        # Add datasets to execution environment
-        dataset_variables = self._get_dataset_variable_names(enriched_datasets)
-        exec_globals.update(dataset_variables)
+        # Prepare execution environment (datasets + spatial helpers)
+        exec_globals = self._build_exec_globals(enriched_datasets, code)
         
         try:
             # Execute the code
-            exec(code, exec_globals)
+            self._exec_generated(code, exec_globals)
             
             # Check if results.csv was created
             if os.path.exists('results.csv'):
@@ -235,6 +386,8 @@ Dataset: {dataset_name}
                     "executed_code": code
                 }
                 
+        except Cancelled as e:
+            return self._cancelled_result(e, code)
         except Exception as e:
             print(f"❌ Error executing code: {str(e)}")
             return {
@@ -243,160 +396,52 @@ Dataset: {dataset_name}
                 "executed_code": code
             }
 
-    def correct_code_error(self, original_code, error_message, user_question, enriched_datasets):
+    def correct_code_error(self, original_code, error_message, user_question, enriched_datasets, traceback_text=None):
         """
         Generates corrected code based on the error message from the previous execution.
+        Only the traceback-anchored region of the code is sent; the model replies with a
+        unified diff that is applied locally (see _request_patch).
         
         Args:
             original_code (str): The code that failed
             error_message (str): The error message from execution
             user_question (str): Original user question
             enriched_datasets (dict): Available datasets
+            traceback_text (str, optional): Formatted traceback, used to locate the failing lines
             
         Returns:
-            str: Corrected Python code
+            str: Corrected Python code, or None if the correction token budget is exhausted or the request failed
         """
-        dataset_info = self._prepare_dataset_summary(enriched_datasets)
-        
         # Truncate extremely long error messages to prevent context overflow
-        max_error_length = 1000
+        max_error_length = 500
         if len(error_message) > max_error_length:
             error_message = error_message[:max_error_length] + "... [ERROR MESSAGE TRUNCATED - TOO LONG]"
         
-        # Extract the specific line that caused the error if possible
-        error_line = ""
-        if "line" in error_message and "invalid syntax" in error_message:
-            try:
-                lines = original_code.split('\n')
-                line_num = int(error_message.split('line ')[1].split(')')[0])
-                if line_num <= len(lines):
-                    error_line = f"\nERROR LINE {line_num}: {lines[line_num-1]}"
-            except:
-                pass
+        # Anchor on the innermost frame of the generated script (SyntaxErrors report it in the message)
+        anchors = traceback_line_numbers(traceback_text)[-1:]
+        if not anchors:
+            anchors = [int(n) for n in re.findall(r'line (\d+)', error_message)][-1:]
         
-        prompt = f"""
-        You are debugging Python code that failed to execute. Fix the error and generate corrected code.
+        context = f"""
+        You are debugging a Python script that failed to execute.
 
         ORIGINAL USER QUESTION: "{user_question}"
 
-        FAILED CODE:
-        {original_code}
-
         ERROR MESSAGE:
-        {error_message}{error_line}
+        {error_message}
 
-        AVAILABLE DATASETS:
-        {dataset_info}
+        FAILING REGION ('>>' marks the failing line; line numbers are not part of the code):
+        {numbered_window(original_code, anchors)}
+
+        DATASETS (already defined as variables - DO NOT load files):
+        {self._dataset_digest(enriched_datasets)}
 
-        CRITICAL DEBUGGING FOCUS:
-        The error message is: "{error_message}"
-        
-        If "invalid syntax":
-        - Check for double spaces in operators like "= =" should be "=="
-        - Check for malformed comparison operators
-        - Check for missing commas, colons, or parentheses
-        - Fix spacing around operators
-        
-        If "expected an indented block":
-        - CRITICAL: Fix Python indentation immediately after ':' 
-        - Use exactly 4 spaces for indentation (not tabs)
-        - After if:, try:, except:, for:, while:, def:, class: - next line MUST be indented
-        - Example fix:
-          if condition:
-              # This line needs 4 spaces of indentation
-              code_here
-          try:
-              # This line needs 4 spaces of indentation  
-              code_here
-          except:
-              # This line needs 4 spaces of indentation
-              error_handling
-        
-        If "expected 'except' or 'finally' block":
-        - CRITICAL: Fix malformed try/except structure
-        - ALL code in try block must be properly indented
-        - ❌ WRONG: try: code_line except: (code_line outside try block)
-        - ✅ CORRECT: try: [4 spaces]code_line except: [4 spaces]error_handling
-        - Example fix:
-          # WRONG (causes error):
-          try:
-              line1
-          line2  # This line should be inside try!
-              except:
-                  error_handling
-          
-          # CORRECT:
-          try:
-              line1
-              line2  # Both lines properly inside try block
-          except:
-              error_handling
-          
-          # OR use simple if statement instead:
-          if condition:
-              line1
-              line2
-        
-        If "could not convert string to numeric":
-        - The data appears corrupted with concatenated values
-        - Add data cleaning steps to handle malformed data
-        - Use proper data filtering and validation
-        - Try different approaches to access the data
-        
-        DEBUGGING REQUIREMENTS:
-        1. Analyze the error message carefully - focus on the specific issue
-        2. Fix the EXACT issue that caused the failure
-        3. Generate ONLY corrected Python code - NO explanations
-        4. If data seems corrupted, add data validation and cleaning steps
-        5. Ensure final output is CSV with 3 columns: name, longitude, latitude
-        6. Use these EXACT variable names: {list(self._get_dataset_variable_names(enriched_datasets).keys())}
-        - DO NOT load files - variables are already available
-
-        SPECIFIC ERROR FIXES:
-        - If "invalid syntax" with "= =": Change to "=="
-        - If "invalid syntax" with "! =": Change to "!="  
-        - If "invalid syntax" with "< =": Change to "<="
-        - If "invalid syntax" with "> =": Change to ">="
-        - If "expected an indented block": Add 4 spaces indentation after ':'
-        - If "expected 'except' or 'finally' block": Fix malformed try/except structure
-        - If "could not convert string to numeric": Add data cleaning and validation
-        - If "x attribute access only provided for Point geometries": Use .centroid.x and .centroid.y
-        - If "CRS mismatch": Use .to_crs('EPSG:4326') to standardize coordinate systems
-        - If NameError: check variable names match exactly: {list(self._get_dataset_variable_names(enriched_datasets).keys())}
-        - If AttributeError: check column names and methods exist, use .centroid for geometry access
-        - If KeyError: verify column names in the data
-        - If ImportError: add missing import statements
-        - If geometric errors: ensure proper coordinate extraction using .centroid.x and .centroid.y
-        - If empty results: add proper checks for empty dataframes
-        - If "sjoin() got an unexpected keyword argument": Use predicate= instead of op=
-        - If "'right_df' should be GeoDataFrame": Convert DataFrame to GeoDataFrame before spatial join
-        - If "Geometry is in a geographic CRS" warning: Use projected CRS for calculations
-        - If spatial join returns 0 rows: Check data alignment, add debugging, try distance-based approach
-        - If "geometry.geometry.distance": Remove duplicate .geometry (should be just .geometry.distance)
-
-        SPATIAL ANALYSIS ERROR FIXES:
-        - Empty spatial join results: Add data validation and debugging steps
-        - Use distance-based proximity instead of spatial intersections for point data
-        - Check both datasets have valid geometries before spatial operations
-        - Print intermediate results to identify where data is lost
-        - For point-to-polygon joins, consider using buffer: points.buffer(0.001)
-        - Always validate data exists before processing: if not data.empty:
-
-        GEOMETRY HANDLING FIXES:
-        - ALWAYS use .geometry.centroid.x and .geometry.centroid.y for coordinate extraction
-        - Set CRS if missing: gdf.set_crs('EPSG:4326', allow_override=True)
-        - Check for empty geometries before operations
-        - Use proper distance calculations in meters
-        - Use projected CRS (EPSG:3857) for distance calculations, then convert back to EPSG:4326
-
-        Return ONLY the corrected Python code with the error fixed.
+        COMMON FIXES:
+        - Non-Point geometries: use .geometry.centroid.x / .geometry.centroid.y
+        - Missing CRS: gdf.set_crs('EPSG:4326', allow_override=True); sjoin takes predicate= not op=
+        - NameError: use the dataset variable names above exactly
         """
-        
-        try:
-            corrected_code = self.send_prompt(prompt)
-            return self._clean_generated_code(corrected_code)
-        except Exception as e:
-            return f"# Error generating correction: {str(e)}\nprint('Could not generate corrected code')"
+        return self._request_patch(original_code, context)
 
     def execute_code_with_retry(self, code, enriched_datasets, max_retries=5):
         """
@@ -416,22 +461,12 @@ Dataset: {dataset_name}
         while attempt <= max_retries + 1:  # +1 for initial attempt
             print(f"🚀 Executing code (Attempt {attempt})...")
             
-            # Prepare execution environment
-            exec_globals = {
-                'pd': pd,
-                'gpd': gpd,
-                'np': np,
-                'os': os,
-                '__builtins__': __builtins__
-            }
-            
-            # Add datasets to execution environment
-            dataset_variables = self._get_dataset_variable_names(enriched_datasets)
-            exec_globals.update(dataset_variables)
+            # Prepare execution environment (datasets + spatial helpers)
+            exec_globals = self._build_exec_globals(enriched_datasets, current_code)
             
             try:
                 # Execute the code
-                exec(current_code, exec_globals)
+                self._exec_generated(current_code, exec_globals)
                 
                 # Check if results.csv was created
                 if os.path.exists('results.csv'):
@@ -459,18 +494,24 @@ Dataset: {dataset_name}
                         "attempts": attempt
                     }
                     
+            except Cancelled as e:
+                return self._cancelled_result(e, current_code, attempt)
             except Exception as e:
                 error_message = str(e)
                 print(f"❌ Attempt {attempt} failed with error: {error_message}")
                 
-                if attempt <= max_retries:
+                if attempt <= max_retries and self._has_time_for_correction():
                     print(f"🔧 Attempting to correct the error...")
-                    current_code = self.correct_code_error(
+                    corrected_code = self.correct_code_error(
                         current_code, 
                         error_message, 
                         self.current_question if hasattr(self, 'current_question') else "Original user question",
-                        enriched_datasets
+                        enriched_datasets,
+                        traceback.format_exc()
                     )
+                    if corrected_code is None:
+                        return self._budget_exhausted_result(current_code, attempt, error_message)
+                    current_code = corrected_code
                     print("\n" + "="*50)
                     print(f"📄 CORRECTED CODE (Attempt {attempt + 1}):")
                     print("="*50)
@@ -493,7 +534,35 @@ Dataset: {dataset_name}
             "attempts": attempt
         }
 
-    def execute_question(self, user_question, enriched_datasets, coordinates=None):
+    def _exec_generated(self, code, exec_globals):
+        """
+        Runs generated code in exec_globals. If the question is cancelled meanwhile
+        (client gone, stream timed out), the script is aborted with Cancelled, which
+        its own `except Exception` blocks cannot catch. Questions without a time
+        budget (direct calls, scripts) have nobody to cancel them and run unguarded.
+        """
+        compiled = compile(code, GENERATED_FILENAME, 'exec')
+        if self.current_deadline.budget_s is None:
+            exec(compiled, exec_globals)
+            return
+        with abort_on_cancel(self.current_deadline.cancel_token):
+            exec(compiled, exec_globals)
+
+    def _cancelled_result(self, reason, code=None, attempt=None):
+        """Result returned when the question is cancelled (client gone or time budget used up)."""
+        print(f"🛑 Question cancelled: {reason}")
+        result = {
+            "status": "cancelled",
+            "message": f"Analysis cancelled: {reason}",
+            "deadline": self.current_deadline.report()
+        }
+        if code is not None:
+            result["executed_code"] = code
+        if attempt is not None:
+            result["attempts"] = attempt
+        return result
+
+    def execute_question(self, user_question, enriched_datasets, coordinates=None, deadline=None):
         """
         Complete workflow: Generate code and execute it automatically with enhanced empty results handling.
         
@@ -501,18 +570,31 @@ Dataset: {dataset_name}
             user_question (str): The user's question
             enriched_datasets (dict): Available datasets
             coordinates (dict): Extracted coordinates from AmenityAgent (e.g., {'Barceloneta': {'lat': '41.38', 'lon': '2.19'}})
+            deadline (Deadline, optional): Question time budget; corrections stop when it runs short
             
         Returns:
             dict: Execution results and status
         """
+        self.current_deadline = deadline or Deadline(None)
+        self.current_question_id = time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:6]
         print(f"🤖 Analyzing question: {user_question}")
         print(f"📊 Available datasets: {list(enriched_datasets.keys())}")
         if coordinates:
             print(f"📍 Available coordinates: {list(coordinates.keys())}")
         
+        try:
+            return self._execute_question(user_question, enriched_datasets, coordinates)
+        except Cancelled as e:
+            result = self._cancelled_result(e)
+            result["question"] = user_question
+            return result
+
+    def _execute_question(self, user_question, enriched_datasets, coordinates):
         # Generate the analysis code with coordinates
         generated_code = self.generate_analysis_code(user_question, enriched_datasets, coordinates)
+        self.current_deadline.cancel_token.raise_if_cancelled()
         print("📝 Code generated successfully")
+        self.current_deadline.mark("generation")
         
         # Print the generated code
         print("\n" + "="*50)
@@ -524,6 +606,8 @@ Dataset: {dataset_name}
         # Store the original question for error correction
         self.current_question = user_question
         self.current_coordinates = coordinates
+        self.radius_floor_km = None
+        self.correction_tokens_used = 0
         
         # Execute with enhanced empty results retry capability
         execution_result = self.execute_code_with_empty_retry(generated_code, enriched_datasets, user_question, coordinates)
@@ -532,6 +616,8 @@ Dataset: {dataset_name}
         execution_result["question"] = user_question
         execution_result["available_datasets"] = list(enriched_datasets.keys())
         execution_result["coordinates_used"] = coordinates
+        self.current_deadline.mark("execution", execution_result["status"])
+        execution_result["deadline"] = self.current_deadline.report()
         
         return execution_result
 
@@ -575,34 +661,25 @@ Dataset: {dataset_name}
         """
         attempt = 1
         current_code = code
+        local_recoveries = 0
+        run_index = 0
         
         while attempt <= max_retries + 1:  # +1 for initial attempt
             print(f"🚀 Executing code (Attempt {attempt})...")
+            run_index += 1
             
-            # Prepare execution environment
-            exec_globals = {
-                'pd': pd,
-                'gpd': gpd,
-                'np': np,
-                'os': os,
-                '__builtins__': __builtins__
-            }
-            
-            # Add datasets to execution environment
-            dataset_variables = self._get_dataset_variable_names(enriched_datasets)
-            exec_globals.update(dataset_variables)
+            # Prepare execution environment (datasets + spatial helpers)
+            exec_globals = self._build_exec_globals(enriched_datasets, current_code)
             
-            # Capture execution output for analysis
-            import io
-            import sys
-            old_stdout = sys.stdout
-            execution_output = io.StringIO()
+            # Capture execution output for analysis: bounded, and private to this execution
+            # (the script gets its own print; the process-wide sys.stdout is left alone)
+            execution_output = BoundedOutput()
+            exec_globals['print'] = execution_output.print
             
             try:
-                # Redirect stdout to capture debugging prints
-                sys.stdout = execution_output
-                exec(current_code, exec_globals)
-                sys.stdout = old_stdout
+                with execution_output.capturing():  # The helpers' notes land in the same buffer
+                    self._exec_generated(current_code, exec_globals)
+                persist_attempt_log(self.current_question_id, run_index, attempt, current_code, execution_output, "completed")
                 
                 # Get the captured output
                 debug_output = execution_output.getvalue()
@@ -617,22 +694,33 @@ Dataset: {dataset_name}
                     if len(results_df) == 0:
                         # EMPTY RESULTS - Analyze why and retry
                         print(f"⚠️ WARNING: Empty results detected on attempt {attempt}")
+
+                        # Too-small radius: re-run the same code with a wider radius, no new generation
+                        recovery_radius = self.diagnostics.recovery_radius_km()
+                        if recovery_radius and local_recoveries < self.max_local_recoveries and not self.current_deadline.expired():
+                            local_recoveries += 1
+                            self.radius_floor_km = recovery_radius
+                            print(f"🔁 Re-running locally with radius >= {recovery_radius}km (recovery {local_recoveries})")
+                            continue
                         
-                        if attempt <= max_retries:
+                        if attempt <= max_retries and self._has_time_for_correction():
                             # Analyze debugging output to understand why it failed
                             failure_reason = self._analyze_empty_results_failure(debug_output, enriched_datasets)
                             print(f"🔍 Failure analysis: {failure_reason}")
                             print(f"🔧 Generating corrected code for attempt {attempt + 1}...")
                             
                             # Generate corrected code with specific feedback
-                            current_code = self._correct_empty_results_code(
+                            corrected_code = self._correct_empty_results_code(
                                 current_code, 
                                 failure_reason, 
                                 user_question, 
                                 enriched_datasets,
-                                debug_output,
+                                execution_output.excerpt(600),
                                 coordinates
                             )
+                            if corrected_code is None:
+                                return self._budget_exhausted_result(current_code, attempt, failure_reason)
+                            current_code = corrected_code
                             print(f"\n📄 CORRECTED CODE (Attempt {attempt + 1}):")
                             print("="*50)
                             print(current_code)
@@ -648,6 +736,8 @@ Dataset: {dataset_name}
                                 "row_count": 0,
                                 "executed_code": current_code,
                                 "attempts": attempt,
+                                "local_recoveries": local_recoveries,
+                                "diagnostics": self.diagnostics.summary(),
                                 "debug_output": debug_output
                             }
                     else:
@@ -663,15 +753,21 @@ Dataset: {dataset_name}
                             "preview": results_df.head().to_dict(),
                             "executed_code": current_code,
                             "attempts": attempt,
+                            "local_recoveries": local_recoveries,
+                            "diagnostics": self.diagnostics.summary(),
                             "debug_output": debug_output
                         }
                 else:
                     print("⚠️ Code executed but no results.csv file was created")
-                    if attempt <= max_retries:
+                    if attempt <= max_retries and self._has_time_for_correction():
                         failure_reason = "No output file created - likely missing result.to_csv() statement"
-                        current_code = self._correct_empty_results_code(
-                            current_code, failure_reason, user_question, enriched_datasets, debug_output, coordinates
+                        corrected_code = self._correct_empty_results_code(
+                            current_code, failure_reason, user_question, enriched_datasets,
+                            execution_output.excerpt(600), coordinates
                         )
+                        if corrected_code is None:
+                            return self._budget_exhausted_result(current_code, attempt, failure_reason)
+                        current_code = corrected_code
                         attempt += 1
                         continue
                     else:
@@ -682,17 +778,24 @@ Dataset: {dataset_name}
                             "attempts": attempt
                         }
                     
+            except Cancelled as e:
+                persist_attempt_log(self.current_question_id, run_index, attempt, current_code, execution_output,
+                                    f"cancelled: {e}")
+                return self._cancelled_result(e, current_code, attempt)
             except Exception as e:
-                sys.stdout = old_stdout
                 error_message = str(e)
-                debug_output = execution_output.getvalue()
+                persist_attempt_log(self.current_question_id, run_index, attempt, current_code, execution_output,
+                                    f"error: {error_message}")
                 print(f"❌ Attempt {attempt} failed with error: {error_message}")
                 
-                if attempt <= max_retries:
+                if attempt <= max_retries and self._has_time_for_correction():
                     print(f"🔧 Attempting to correct the error...")
-                    current_code = self.correct_code_error(
-                        current_code, error_message, user_question, enriched_datasets
+                    corrected_code = self.correct_code_error(
+                        current_code, error_message, user_question, enriched_datasets, traceback.format_exc()
                     )
+                    if corrected_code is None:
+                        return self._budget_exhausted_result(current_code, attempt, error_message)
+                    current_code = corrected_code
                     attempt += 1
                 else:
                     return {
@@ -709,9 +812,28 @@ Dataset: {dataset_name}
             "attempts": attempt
         }
 
+    def _has_time_for_correction(self):
+        """True if another LLM correction fits in the question's deadline; records the stop reason otherwise."""
+        if self.current_deadline.allows(CORRECTION_ESTIMATE_S):
+            return True
+        self.current_deadline.stop("correction", "not enough time left for another correction, returning best result so far")
+        return False
+
+    def _budget_exhausted_result(self, code, attempt, last_problem):
+        """Result returned when no further correction fits the per-question token budget."""
+        return {
+            "status": "error",
+            "message": f"Correction token budget exhausted after {attempt} attempts: {last_problem}",
+            "executed_code": code,
+            "attempts": attempt,
+            "correction_tokens_used": self.correction_tokens_used
+        }
+
     def _analyze_empty_results_failure(self, debug_output, enriched_datasets):
         """
-        Analyzes debugging output to determine why results are empty.
+        Analyzes why results are empty. Structured diagnostics recorded by the
+        spatial helpers are used first; captured stdout is only a fallback for
+        code that did not go through the helpers.
         
         Args:
             debug_output (str): Captured stdout from code execution
@@ -720,7 +842,9 @@ Dataset: {dataset_name}
         Returns:
             str: Detailed analysis of failure reason
         """
-        failure_reasons = []
+        failure_reasons = self.diagnostics.failure_reasons()
+        if failure_reasons:
+            return " | ".join(failure_reasons)
         
         # Check for dataset loading issues
         if "No buildings found near location" in debug_output:
@@ -743,7 +867,10 @@ Dataset: {dataset_name}
             # If no specific issues found, likely a distance/location problem
             dataset_info = []
             for name, (dataset, _) in enriched_datasets.items():
-                dataset_info.append(f"{name}: {len(dataset)} rows")
+                if isinstance(dataset, LazyDataset) and not dataset.is_loaded:
+                    dataset_info.append(f"{name}: not used by the code")
+                else:
+                    dataset_info.append(f"{name}: {len(materialize(dataset))} rows")
             
             failure_reasons.append(f"DISTANCE_ISSUE: Likely distance radius too small or wrong location coordinates. Available data: {', '.join(dataset_info)}")
         
@@ -752,90 +879,119 @@ Dataset: {dataset_name}
     def _correct_empty_results_code(self, original_code, failure_reason, user_question, enriched_datasets, debug_output, coordinates):
         """
         Generates corrected code specifically for empty results issues.
+        The prompt carries the lines that call the spatial helpers or write results,
+        not the whole script; the model replies with a unified diff.
         
         Args:
             original_code (str): The code that produced empty results
             failure_reason (str): Analysis of why results were empty
             user_question (str): Original user question
             enriched_datasets (dict): Available datasets
-            debug_output (str): Captured debugging output
+            debug_output (str): Compact excerpt of the captured output (BoundedOutput.excerpt)
             coordinates (dict): Extracted coordinates from AmenityAgent
             
         Returns:
-            str: Corrected Python code
+            str: Corrected Python code, or None if the correction token budget is exhausted or the request failed
         """
-        dataset_info = self._prepare_dataset_summary(enriched_datasets)
+        anchors = [
+            n for n, line in enumerate(original_code.split('\n'), 1)
+            if any(marker in line for marker in ('filter_by_distance', 'find_nearest', 'sjoin', 'to_csv'))
+        ]
         
-        prompt = f"""
-        You are fixing code that executed successfully but produced EMPTY RESULTS (0 rows).
+        context = f"""
+        You are fixing a script that executed successfully but produced EMPTY RESULTS (0 rows).
 
         ORIGINAL USER QUESTION: "{user_question}"
 
         FAILURE ANALYSIS: {failure_reason}
 
-        DEBUGGING OUTPUT FROM FAILED ATTEMPT:
-        {debug_output[-1000:]}  # Last 1000 characters
+        LOCATIONS:
+        {self._prepare_coordinates_info(coordinates)}
 
-        AVAILABLE DATASETS:
-        {dataset_info}
+        OUTPUT EXCERPT OF THE FAILED ATTEMPT:
+        {debug_output}
 
-        SPECIFIC FIXES FOR EMPTY RESULTS:
+        RELEVANT REGION ('>>' marks spatial/output lines; line numbers are not part of the code):
+        {numbered_window(original_code, anchors, context=3)}
 
-        1. If "BUILDINGS_NOT_FOUND":
-           - INCREASE distance radius from 2.0km to 5.0km or 10.0km
-           - CHECK location coordinates - use exact coordinates from user query
-           - TRY different building types (use 'building' column instead of specific types)
+        DATASETS (already defined as variables - DO NOT load files):
+        {self._dataset_digest(enriched_datasets)}
 
-        2. If "EMISSIONS_NOT_FOUND":
-           - INCREASE distance radius for emission zones
-           - CHECK emission data variable name (use exact name from datasets)
-           - VERIFY emission data processing with debugging prints
-
-        3. If "DISTANCE_ISSUE":
-           - INCREASE max_distance_km parameter to 10.0 or 20.0
-           - CHECK if location coordinates are correct
-           - PRINT bounds of datasets to verify spatial overlap
-
-        4. If "INVALID_EMISSION_DATA":
-           - CHECK correct dataset variable name (available: {list(self._get_dataset_variable_names(enriched_datasets).keys())})
-           - VERIFY column names match exactly
-           - ADD more validation and debugging
+        FIXES BY FAILURE CODE:
+        - DISTANCE_ISSUE: increase max_distance_km (5-20km) and check the center is Point(lon, lat)
+        - EMPTY_INPUT / NO_MATCHING_DATA: the named layer was already empty - fix the earlier filtering/conversion
+        - LOGIC_ISSUE: spatial filtering kept rows; fix the later join/column filter/dropna that dropped them
+        - INVALID_EMISSION_DATA: check the pollution variable name and its geometry_wkt column
+        """
+        return self._request_patch(original_code, context)
 
-        ENHANCED SOLUTION PATTERN:
-        ```python
-        # Use LARGER distance radius for better coverage
-        max_distance_km = 10.0  # Increased from 2.0
+    def _dataset_digest(self, enriched_datasets, max_columns=15):
+        """
+        One line per dataset (variable name, rows, leading columns) for correction prompts.
+        """
+        lines = []
+        for var_name, dataset in self._get_dataset_variable_names(enriched_datasets).items():
+            if isinstance(dataset, LazyDataset) and not dataset.is_loaded:
+                columns, rows = dataset.peek_columns() or [], "?"
+            else:
+                dataset = materialize(dataset)
+                columns, rows = list(dataset.columns), len(dataset)
+            shown = columns[:max_columns] + (['...'] if len(columns) > max_columns else [])
+            lines.append(f"- {var_name}: {rows} rows, columns {shown}")
+        return "\n".join(lines)
 
-        # Add more debugging for dataset bounds
-        print(f"Dataset bounds check:")
-        if hasattr(residential_building_locations, 'total_bounds'):
-            print(f"Buildings bounds: {{residential_building_locations.total_bounds}}")
-        if hasattr(emission_zones, 'total_bounds'):
-            print(f"Emissions bounds: {{emission_zones.total_bounds}}")
+    def _request_patch(self, original_code, context):
+        """
+        Sends a correction prompt under the per-question token budget and applies the
+        unified diff in the reply. If the reply has no usable diff, asks once for the
+        complete script instead (if the budget still allows).
+        
+        Args:
+            original_code (str): The code being corrected
+            context (str): Prompt body describing the failure
+            
+        Returns:
+            str: Corrected Python code, or None if the correction token budget is exhausted or the request failed
+        """
+        prompt = context + DIFF_REPLY_FORMAT
+        reply = self._send_correction_prompt(prompt)
+        if reply is None:
+            return None
 
-        # Check actual coordinate overlap
-        barceloneta_center = Point(2.191, 41.3809)
-        print(f"Target location: {{barceloneta_center}}")
+        if '@@' in reply:
+            try:
+                return apply_unified_diff(original_code, reply)
+            except ValueError as e:
+                print(f"⚠️ Could not apply correction diff ({e}), requesting the full script...")
+        elif 'filter_by_distance' in reply or 'to_csv' in reply:
+            # The model ignored the protocol and sent a whole script
+            return self._clean_generated_code(reply)
 
-        # Use larger radius in filter_by_distance calls
-        nearby_buildings = filter_by_distance(residential_building_locations, barceloneta_center, max_distance_km)
-        ```
+        prompt = context + f"""
+        FULL SCRIPT:
+        {original_code}
 
-        CRITICAL REQUIREMENTS:
-        - INCREASE distance radius significantly (5-20km)
-        - ADD bounds checking and coordinate validation
-        - ENSURE correct dataset variable names are used
-        - INCLUDE comprehensive debugging output
-        - MAINTAIN all helper functions and debugging prints
+        Return ONLY the complete corrected Python code.
+        """
+        reply = self._send_correction_prompt(prompt)
+        return None if reply is None else self._clean_generated_code(reply)
 
-        Generate ONLY the corrected Python code with these specific fixes applied.
+    def _send_correction_prompt(self, prompt):
         """
-        
+        Sends prompt if it fits the remaining correction token budget. Returns None when it
+        does not, or when the request fails (e.g. the deadline ran out), so the caller stops correcting.
+        """
+        prompt_tokens = estimate_tokens(prompt)
+        if self.correction_tokens_used + prompt_tokens > self.correction_token_budget:
+            print(f"⛔ Correction token budget exhausted ({self.correction_tokens_used}/{self.correction_token_budget})")
+            return None
         try:
-            corrected_code = self.send_prompt(prompt)
-            return self._clean_generated_code(corrected_code)
+            reply = self.send_prompt(prompt, timeout=self.current_deadline.timeout(60))
         except Exception as e:
-            return f"# Error generating correction: {str(e)}\nprint('Could not generate corrected code')"
+            print(f"❌ Error generating correction: {str(e)}")
+            return None
+        self.correction_tokens_used += prompt_tokens + estimate_tokens(reply)
+        return reply
 
     def _prepare_coordinates_info(self, coordinates):
         """
@@ -882,6 +1038,13 @@ Dataset: {dataset_name}
         first_location = list(coordinates.keys())[0]
         first_var = first_location.lower().replace(' ', '_').replace('-', '_')
         code_lines.append(f"target_center = {first_var}_center  # Primary target location")
+
+        # All centers together, for one multi-center query instead of a filter per location
+        if len(coordinates) > 1:
+            entries = ", ".join(
+                f"'{name}': {name.lower().replace(' ', '_').replace('-', '_')}_center" for name in coordinates
+            )
+            code_lines.append(f"location_centers = {{{entries}}}")
         
         return "\n".join(code_lines)
 
@@ -897,6 +1060,10 @@ Dataset: {dataset_name}
         """
         if not coordinates:
             return "nearby_buildings = self.filter_by_distance_with_fallback(residential_building_locations, target_center)"
+        if len(coordinates) > 1:
+            return ("# Several locations: one pass over the layer, each building tagged with its closest location\n"
+                    "nearby_buildings = filter_by_distance_multi(residential_building_locations, location_centers, "
+                    "max_distance_km=1.0, how='nearest')")
         return "nearby_buildings = self.filter_by_distance_with_fallback(residential_building_locations, target_center)"
 
     def _generate_emission_filter_code(self, coordinates):
@@ -955,45 +1122,309 @@ Dataset: {dataset_name}
 
     def filter_by_distance(self, gdf, center_point, max_distance_km=10.0):
         """Filter features within a specified distance from a center point"""
+        if self.radius_floor_km:
+            max_distance_km = max(max_distance_km, self.radius_floor_km)
+
         if gdf.empty:
+            self.diagnostics.record('filter_by_distance', gdf, 0, 0, [max_distance_km], center_point, gdf.crs)
             return gdf
         
-        # Project to a metric system for accurate distance calculation
-        gdf_proj = gdf.to_crs('EPSG:3857')
-        center_proj = gpd.GeoSeries([center_point], crs='EPSG:4326').to_crs('EPSG:3857').iloc[0]
-        
-        # Calculate distances and filter
-        distances = gdf_proj.geometry.distance(center_proj)
-        nearby_mask = distances <= (max_distance_km * 1000)
-        nearby_gdf = gdf[nearby_mask].copy()
-        
+        # Projection and distances are cached per (dataset, center); this only slices rows
+        within = projection_cache.indices_within(gdf, center_point, max_distance_km)
+        nearby_gdf = gdf.iloc[within]
+
+        self.diagnostics.record('filter_by_distance', gdf, len(gdf), len(nearby_gdf),
+                                [max_distance_km], center_point, gdf.crs, projection_cache.note(gdf))
         return nearby_gdf
 
     def filter_by_distance_with_fallback(self, gdf, center_point, max_distance_km=10.0):
         """Filter with automatic radius expansion if no results"""
-        result = self.filter_by_distance(gdf, center_point, max_distance_km)
+        if self.radius_floor_km:
+            max_distance_km = max(max_distance_km, self.radius_floor_km)
+
+        if gdf.empty:
+            self.diagnostics.record('filter_by_distance_with_fallback', gdf, 0, 0,
+                                    [max_distance_km], center_point, gdf.crs)
+            return gdf
+
+        # Distances are sorted once per (dataset, center); each radius is a binary search
+        radii_tried = [max_distance_km]
+        within = projection_cache.indices_within(gdf, center_point, max_distance_km)
         
         # If empty, try larger radius
-        if result.empty and max_distance_km < 20:
-            print(f"⚠️ No results within {max_distance_km}km, trying {max_distance_km*2}km...")
-            return self.filter_by_distance_with_fallback(gdf, center_point, max_distance_km*2)
-        
+        while len(within) == 0 and max_distance_km < 20:
+            echo(f"⚠️ No results within {max_distance_km}km, trying {max_distance_km*2}km...")
+            max_distance_km *= 2
+            radii_tried.append(max_distance_km)
+            within = projection_cache.indices_within(gdf, center_point, max_distance_km)
+
+        self.diagnostics.record('filter_by_distance_with_fallback', gdf, len(gdf), len(within),
+                                radii_tried, center_point, gdf.crs, projection_cache.note(gdf))
+        return gdf.iloc[within]
+
+    def filter_by_distance_multi(self, gdf, centers, max_distance_km=1.0, how='union'):
+        """
+        Filter features around several location centers with a single spatial-index query.
+
+        Args:
+            gdf (GeoDataFrame): Layer to filter
+            centers (dict): {location name: Point(lon, lat)}
+            max_distance_km (float | dict): One radius for all centers, or {location name: radius}
+            how (str): 'union' (near any center), 'intersection' (near every center), 'nearest'
+                (near any, tagged with 'nearest_center' and 'center_distance_m') or 'pairs'
+                (one row per feature/center match, with 'center' and 'center_distance_m')
+
+        Returns:
+            GeoDataFrame: Matching features
+        """
+        names = list(centers)
+        if isinstance(max_distance_km, dict):
+            radii = [max_distance_km.get(name, 1.0) for name in names]
+        else:
+            radii = [max_distance_km] * len(names)
+        if self.radius_floor_km:
+            radii = [max(radius, self.radius_floor_km) for radius in radii]
+
+        if gdf.empty or not names:
+            self.diagnostics.record('filter_by_distance_multi', gdf, len(gdf), 0, radii, crs=gdf.crs)
+            return gdf.iloc[0:0]
+
+        membership = projection_cache.multi_center(gdf, [centers[name] for name in names], radii)
+        center_names = np.array(names, dtype=object)
+        if how == 'intersection':
+            result = gdf.iloc[membership.intersection()]
+        elif how == 'nearest':
+            positions, center_idx, distances = membership.nearest_center()
+            result = gdf.iloc[positions].assign(nearest_center=center_names[center_idx], center_distance_m=distances)
+        elif how == 'pairs':
+            result = gdf.iloc[membership.features].assign(
+                center=center_names[membership.centers], center_distance_m=membership.distances
+            )
+        else:
+            result = gdf.iloc[membership.union()]
+
+        notes = [projection_cache.note(gdf)]
+        if result.empty:
+            notes.append("centers: " + ", ".join(f"{name} ({radius} km)" for name, radius in zip(names, radii)))
+        self.diagnostics.record('filter_by_distance_multi', gdf, len(gdf), len(result), radii,
+                                crs=gdf.crs, note="; ".join(n for n in notes if n) or None)
         return result
 
     def find_nearest_emission_for_location(self, location_row, emission_gdf):
         """Find the nearest emission record for a given location"""
-        location_point = location_row.geometry.centroid
-        location_proj = gpd.GeoSeries([location_point], crs='EPSG:4326').to_crs('EPSG:3857').iloc[0]
-        
-        # Project emission data for distance calculation
-        emission_proj = emission_gdf.to_crs('EPSG:3857')
-        
-        # Calculate distances to emissions
-        distances_to_emissions = emission_proj.geometry.distance(location_proj)
-        nearest_idx = distances_to_emissions.idxmin()
-        nearest_emission = emission_gdf.loc[nearest_idx]
-        
-        return nearest_emission
+        nearest_position = -1
+        if not emission_gdf.empty:
+            # Bounding boxes and representative points settle most segments; only a few get exact distances
+            nearest_position, _ = projection_cache.nearest(emission_gdf, location_row.geometry.centroid)
+        self.diagnostics.tally('nearest_emission', emission_gdf, len(emission_gdf),
+                               0 if nearest_position < 0 else 1, emission_gdf.crs)
+
+        if nearest_position < 0:
+            return None  # No emission record with a usable geometry
+        return emission_gdf.iloc[nearest_position]
+
+    def pollution_exposure(self, locations_gdf, emission_gdf):
+        """Pollution band at every location, looked up in the cached pollution raster"""
+        if locations_gdf.empty or emission_gdf.empty:
+            self.diagnostics.record('pollution_exposure', emission_gdf, len(emission_gdf), 0, crs=emission_gdf.crs)
+            return locations_gdf.assign(exposure_ugm3=np.nan, exposure_band=None)
+
+        exposure = exposure_at(locations_gdf, emission_gdf)
+        matched = int(np.isfinite(exposure).sum())
+        self.diagnostics.record('pollution_exposure', emission_gdf, len(emission_gdf), matched,
+                                crs=emission_gdf.crs, note=projection_cache.note(emission_gdf))
+        return locations_gdf.assign(exposure_ugm3=exposure, exposure_band=band_labels(exposure))
+
+    def filter_by_pollution(self, emission_gdf, min_ugm3=None, max_ugm3=None):
+        """Pollution segments whose whole band lies between min_ugm3 and max_ugm3 (per-band bitmaps)"""
+        if emission_gdf.empty:
+            self.diagnostics.record('filter_by_pollution', emission_gdf, 0, 0, crs=emission_gdf.crs)
+            return emission_gdf
+
+        selected = emission_gdf.iloc[band_index(emission_gdf).positions(min_ugm3, max_ugm3)]
+        self.diagnostics.record('filter_by_pollution', emission_gdf, len(emission_gdf), len(selected),
+                                crs=emission_gdf.crs,
+                                note=f"no band within {min_ugm3}-{max_ugm3} µg/m³" if selected.empty else None)
+        return selected
+
+    def top_k(self, gdf, k=20, by='exposure', largest=False, center_point=None, radius_km=None, emission_gdf=None):
+        """
+        Returns the k best-ranked features by a vectorized score, in stable rank order.
+
+        Args:
+            gdf (GeoDataFrame): Candidate layer
+            k (int): Number of features to return
+            by (str | callable | dict): 'exposure', 'distance', a numeric column, a callable(candidates) -> scores,
+                or a {component: weight} mix of those
+            largest (bool): Rank the highest scores first (e.g. most exposed)
+            center_point (Point, optional): Needed for 'distance'; candidates are visited nearest-first
+            radius_km (float, optional): Only rank features within this radius of center_point
+            emission_gdf (GeoDataFrame, optional): Pollution layer, needed for 'exposure'
+
+        Returns:
+            GeoDataFrame: Up to k rows with 'score' and 'rank' columns
+        """
+        if self.radius_floor_km and radius_km is not None:
+            radius_km = max(radius_km, self.radius_floor_km)
+        radii = [radius_km] if radius_km is not None else None
+
+        if gdf.empty:
+            self.diagnostics.record('top_k', gdf, 0, 0, radii, center_point, gdf.crs)
+            return gdf
+
+        positions, scores, scanned = rank_top_k(gdf, k, by, largest, center_point, radius_km, emission_gdf)
+        ranked = gdf.iloc[positions].assign(score=scores, rank=np.arange(1, len(positions) + 1))
+
+        self.diagnostics.record('top_k', gdf, len(gdf), len(ranked), radii, center_point, gdf.crs,
+                                projection_cache.note(gdf))
+        return ranked
+
+    def cleanest_route(self, emission_gdf, start_point, end_point, pollution_weight=routing.DEFAULT_POLLUTION_WEIGHT):
+        """
+        Finds the least-polluted walking route between two points over the pollution street network.
+
+        Args:
+            emission_gdf (GeoDataFrame): Pollution layer (its street segments form the network)
+            start_point (Point): Start, Point(longitude, latitude)
+            end_point (Point): Destination, Point(longitude, latitude)
+            pollution_weight (float): How much extra length a clean street is worth; 0 = shortest route
+
+        Returns:
+            GeoDataFrame: Segments in walking order with 'step', 'length_m', 'cumulative_m' and
+            'exposure_ugm3'; route totals in .attrs['route']
+        """
+        if emission_gdf.empty:
+            self.diagnostics.record('cleanest_route', emission_gdf, 0, 0, center=start_point, crs=emission_gdf.crs)
+            return emission_gdf
+
+        route = routing.cleanest_route(emission_gdf, start_point, end_point, pollution_weight)
+        segments = emission_gdf.iloc[route.segments].assign(
+            step=np.arange(1, len(route.segments) + 1),
+            length_m=route.lengths,
+            cumulative_m=np.cumsum(route.lengths),
+            exposure_ugm3=route.exposures,
+        )
+        segments.attrs['route'] = route.summary()
+
+        self.diagnostics.record('cleanest_route', emission_gdf, len(emission_gdf), len(segments),
+                                center=start_point, crs=emission_gdf.crs,
+                                note=None if route.found else "start and end are not connected by the street network")
+        return segments
+
+    def path_exposure(self, emission_gdf, path):
+        """Pollution exposure along a path (route GeoDataFrame, LineString or list of Points)"""
+        if hasattr(path, 'geometry'):
+            lines = np.asarray(path.geometry.values)
+        elif isinstance(path, (list, tuple)):
+            lines = [LineString([(p.x, p.y) for p in path])] if len(path) > 1 else []
+        else:
+            lines = [path]
+        return routing.path_exposure(emission_gdf, lines)
+
+    def points_within_radius(self, points_gdf, center_point, radius_km=0.5):
+        """Point features (stations, stops) within radius_km of a center point, closest first"""
+        if self.radius_floor_km:
+            radius_km = max(radius_km, self.radius_floor_km)
+
+        if points_gdf.empty:
+            self.diagnostics.record('points_within_radius', points_gdf, 0, 0, [radius_km], center_point, points_gdf.crs)
+            return points_gdf
+
+        # The point index is built once per layer (at load for the CSV layers) and reused
+        x, y = project_point(center_point)
+        positions, distances = projection_cache.point_index(points_gdf).radius(x, y, radius_km * 1000)
+        nearby_points = points_gdf.iloc[positions].assign(distance_m=distances)
+
+        self.diagnostics.record('points_within_radius', points_gdf, len(points_gdf), len(nearby_points),
+                                [radius_km], center_point, points_gdf.crs, projection_cache.note(points_gdf))
+        return nearby_points
+
+    def k_nearest_points(self, points_gdf, center_point, k=5):
+        """The k point features closest to a center point, closest first"""
+        if points_gdf.empty:
+            self.diagnostics.record('k_nearest_points', points_gdf, 0, 0, center=center_point, crs=points_gdf.crs)
+            return points_gdf
+
+        x, y = project_point(center_point)
+        positions, distances = projection_cache.point_index(points_gdf).knn(x, y, k)
+        nearest_points = points_gdf.iloc[positions].assign(distance_m=distances)
+
+        self.diagnostics.record('k_nearest_points', points_gdf, len(points_gdf), len(nearest_points),
+                                center=center_point, crs=points_gdf.crs, note=projection_cache.note(points_gdf))
+        return nearest_points
+
+    def nearest_point_for_each(self, locations_gdf, points_gdf):
+        """Nearest point feature for every location (centroids for polygons), in one batch query"""
+        if locations_gdf.empty or points_gdf.empty:
+            self.diagnostics.record('nearest_point_for_each', points_gdf, len(points_gdf), 0, crs=points_gdf.crs)
+            return locations_gdf.assign(nearest_point=None, nearest_distance_m=np.nan)
+
+        probes = projection_cache.metric_coords(locations_gdf)
+        positions, distances = projection_cache.point_index(points_gdf).nearest_many(probes)
+        labels = points_gdf.index.to_numpy(dtype=object)[np.maximum(positions, 0)]
+        labels[positions < 0] = None
+
+        matched = int((positions >= 0).sum())
+        self.diagnostics.record('nearest_point_for_each', points_gdf, len(points_gdf), matched,
+                                crs=points_gdf.crs, note=projection_cache.note(points_gdf))
+        return locations_gdf.assign(nearest_point=labels, nearest_distance_m=np.where(positions >= 0, distances, np.nan))
+
+    def transit_access(self, locations_gdf, modes=None):
+        """
+        Transit accessibility of every location (centroids for polygons), read from the precomputed grid.
+
+        Args:
+            locations_gdf (GeoDataFrame): Locations to score
+            modes (list): Subset of 'bus', 'metro', 'fgc', 'tram', 'rail', 'bicing' (default: all)
+
+        Returns:
+            GeoDataFrame: locations_gdf plus '<mode>_nearest_m', '<mode>_within_300m' and '<mode>_within_500m'
+        """
+        if locations_gdf.empty:
+            self.diagnostics.record('transit_access', locations_gdf, 0, 0, crs=locations_gdf.crs)
+            return locations_gdf
+
+        columns = access_at_coords(projection_cache.metric_coords(locations_gdf), modes)
+        scored = locations_gdf.assign(**columns)
+
+        covered = int(np.isfinite(next(iter(columns.values()))).sum()) if columns else 0
+        self.diagnostics.record('transit_access', locations_gdf, len(locations_gdf), covered, crs=locations_gdf.crs,
+                                note=None if covered else "locations lie outside the accessibility grid")
+        return scored
+
+    def transit_gaps(self, mode='bicing', min_distance_m=500, center_point=None, radius_km=None):
+        """
+        Areas of the city poorly served by one transit mode.
+
+        Args:
+            mode (str): 'bus', 'metro', 'fgc', 'tram', 'rail' or 'bicing'
+            min_distance_m (float): Minimum distance to the nearest stop/station of that mode
+            center_point (Point): Optional center, Point(longitude, latitude)
+            radius_km (float): Optional radius around center_point
+
+        Returns:
+            GeoDataFrame: Grid cell centres (EPSG:4326) with 'nearest_m', rep_lon/rep_lat and utm_x/utm_y,
+            farthest from the mode first
+        """
+        center_xy = project_point(center_point) if center_point is not None else None
+        radius_m = radius_km * 1000 if radius_km is not None else None
+        centers, distances = coverage_gaps(mode, min_distance_m, center_xy, radius_m)
+
+        order = np.argsort(-distances, kind="stable")
+        centers, distances = centers[order], distances[order]
+        geometry = gpd.points_from_xy(centers[:, 0], centers[:, 1], crs=METRIC_CRS).to_crs("EPSG:4326")
+        gaps = gpd.GeoDataFrame({
+            'mode': mode,
+            'nearest_m': distances,
+            'rep_lon': geometry.x,
+            'rep_lat': geometry.y,
+            'utm_x': centers[:, 0],
+            'utm_y': centers[:, 1],
+        }, geometry=geometry)
+
+        self.diagnostics.record('transit_gaps', gaps, len(gaps), len(gaps),
+                                [radius_km] if radius_km is not None else None, center_point, gaps.crs)
+        return gaps
 
     def execute_spatial_analysis(self):
         # ... existing code ...
@@ -1009,7 +1440,7 @@ Dataset: {dataset_name}
             
             # Create result entry
             building_type = building.get('building', 'residential')
-            emission_level = nearest_emission.get('Rang', 'Unknown')
+            emission_level = 'Unknown' if nearest_emission is None else nearest_emission.get('Rang', 'Unknown')
             name = f"Building (Type: {building_type} - Emission: {emission_level})"
             
             results_list.append({
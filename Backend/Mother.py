@@ -1,56 +1,73 @@
-from BaseAgent import BaseAgent
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 from Aminity01 import AmenityAgent
 from Data02 import DataLayerAgent
 from DataReader import DataReaderAgent
 from DataCollect03 import DataCollectorAgent
-import pandas as pd
-# from MainAgent import MainAgent
-from lapa import MainAgent
-from Viz01 import save_kepler_map, display_html_with_custom_style
-from config import get_openai_api_key
-
-# 1️⃣ Initialize agents
-api_key = get_openai_api_key()
-
-# 2️⃣ User prompt
-user_query = "find 20 houses that are least exposed to polution in  Maragall street in barcelona "
+from MainAgent import MainAgent
+from deadline import Deadline, DEFAULT_QUESTION_BUDGET_S
+from lazydata import LazyDataset, materialize
+from config import get_openai_api_key, get_data_dir
 
+try:
+    from Viz01 import save_kepler_map, display_html_with_custom_style
+except ImportError as e:
+    print(f"⚠️ Map output unavailable: {e}")
+    save_kepler_map = None
 
 
-# 5️⃣ Step 3: Use DataCollectorAgent to fetch data
-# print("\n🔹 Using DataCollectorAgent...")
-# fetched_data = data_collector_agent.fetch_data(dataset_info["datasets"], coordinates)
-# all_data, csv_dirs = data_collector_agent.fetch_data(dataset_info["datasets"], coordinates)
+def answer_question(user_query, api_key, budget_s=DEFAULT_QUESTION_BUDGET_S):
+    """
+    Runs the agent pipeline for one question under a single time budget: every stage
+    (geocoding, fetching, describing, code generation, execution, correction) gets
+    the same Deadline and gives up or cuts its work short when it runs out.
 
-# print("All data:", all_data)
-# print("CSV dirs:", csv_dirs)
-# print(all_data.keys())
-# # Example: if any "other" dataset was found
-# if csv_dirs:
-#     print("\n📁 Found CSV paths:")
-#     for tag, path in csv_dirs.items():
-#         print(f"- {tag}: {path}")
-# 5️⃣ Step 4: Use add description to the data
+    Returns:
+        tuple: (execution_result, all_data), all_data holding the layers by name
+    """
+    deadline = Deadline(budget_s)
 
+    # 1️⃣ Place names -> coordinates
+    print("\n🔹 Using AmenityAgent...")
+    coordinates = AmenityAgent(api_key).find_coordinates_for_prompt(user_query, deadline)
 
+    # 2️⃣ Which data layers the question needs
+    print("\n🔹 Using DataLayerAgent...")
+    dataset_info = DataLayerAgent(api_key).identify_datasets(user_query)
 
-# 6️⃣ Step 5: Use MainAgent to execute the code with coordinates  
-# main_agent = MainAgent(api_key)
+    # 3️⃣ Collect them (lazy handles: only what the generated code uses gets loaded)
+    print("\n🔹 Using DataCollectorAgent...")
+    all_data, csv_dirs = DataCollectorAgent(api_key, data_dir=str(get_data_dir())).fetch_data(
+        dataset_info["datasets"], coordinates, deadline
+    )
+    if csv_dirs:
+        print("\n📁 Found CSV paths:")
+        for tag, path in csv_dirs.items():
+            print(f"- {tag}: {path}")
 
+    # 4️⃣ Describe them
+    print("\n🔹 Using DataReaderAgent...")
+    enriched_datasets = DataReaderAgent(api_key).create_dataset_with_analysis(all_data, deadline) if all_data else {}
 
+    # 5️⃣ Generate and execute the analysis code
+    print("\n🔹 Using MainAgent...")
+    execution_result = MainAgent(api_key).execute_question(user_query, enriched_datasets, coordinates, deadline)
+    return execution_result, all_data
 
 
-# execution_result = main_agent.execute_question(user_query, Nice_Dataset)
+if __name__ == "__main__":
+    api_key = get_openai_api_key()
+    user_query = "find 20 houses that are least exposed to polution in  Maragall street in barcelona "
 
+    execution_result, all_data = answer_question(user_query, api_key)
+    print(execution_result)
 
-# print(execution_result)
-# 6️⃣ Merge and display
-# if fetched_data:
-#     merged_df = pd.concat(fetched_data, ignore_index=True)
-#     print("\n✅ Final merged data:")
-#     print(merged_df.head())
-# else:
-#     print("\n⚠️ No data found for the given query.")
-map_path, map_filename = save_kepler_map(all_data)
-display_html_with_custom_style(map_path)
-print(f"🌐 Map saved and ready at: {map_path}")
\ No newline at end of file
+    # 6️⃣ Map the layers the analysis loaded
+    loaded = {name: materialize(data) for name, data in all_data.items()
+              if not isinstance(data, LazyDataset) or data.is_loaded}
+    if save_kepler_map is not None and loaded:
+        map_path, map_filename = save_kepler_map(loaded)
+        display_html_with_custom_style(map_path)
+        print(f"🌐 Map saved and ready at: {map_path}")
@@ -4,12 +4,24 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from flask import Flask, request, jsonify, send_from_directory, Response
 from flask_cors import CORS
-import time
-import random
 import json
-import threading
-from queue import Queue
+import math
 from config import get_openai_api_key
+from deadline import Deadline, DEFAULT_QUESTION_BUDGET_S
+from deltastream import DeltaEncoder
+from sessions import SessionRegistry, SessionLimitError
+from warmup import Warmup, WARMUP_RETRY_AFTER_S, warm_gazetteer, warm_layers, warm_pollution_raster, warm_transit_grid
+from workers import WorkerPool, PoolSaturatedError, SATURATED_RETRY_AFTER_S
+from singleflight import SingleFlight, flight_key
+
+STREAM_MESSAGE_TIMEOUT_S = 30  # Longest silence tolerated between two SSE events
+STREAM_GRACE_S = 5  # Extra wait after the question deadline for the final error/complete event
+TOOL_STATUS = {  # Status line shown for each code-interpreter stage
+    'created': '🔧 Starting code interpreter...',
+    'code': '🧮 Writing analysis code...',
+    'output': '📊 Running analysis code...',
+    'done': '✅ Analysis step finished',
+}
 
 # Try to import the real assistant, fallback to demo if there are issues
 try:
@@ -20,10 +32,12 @@ except ImportError as e:
     REAL_ASSISTANT_AVAILABLE = False
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['Retry-After'])  # Clients on other origins read the 429/503 back-off hint
 
-# Global streaming state
-streaming_sessions = {}
+# Global streaming state: bounded, expiring sessions (see sessions.SessionRegistry)
+sessions = SessionRegistry()
+# Identical questions in flight, answered once for every session asking them
+inflight = SingleFlight()
 
 class StreamingHybridAssistant:
     """Hybrid assistant with real-time streaming capabilities"""
@@ -33,10 +47,22 @@ class StreamingHybridAssistant:
         self.mode = "initializing"
         self.real_assistant = None
         self.file_count = 0
-        self.setup_assistant()
+        self.workers = WorkerPool()  # Runs the blocking assistant work of streamed questions
+        # Setup runs in the background (start_warmup) so the server can bind and answer /health at once
+        self.warmup = (
+            Warmup()
+            .add('assistant', self.setup_assistant, required=True)
+            .add('gazetteer', warm_gazetteer)
+            .add('layers', warm_layers)
+            .add('pollution_raster', warm_pollution_raster)
+            .add('transit_grid', warm_transit_grid)
+        )
+    
+    def start_warmup(self):
+        self.warmup.start()
     
     def setup_assistant(self):
-        """Try to setup real assistant, fallback to demo mode"""
+        """Try to setup real assistant, fallback to demo mode. Returns True when the real assistant is ready"""
         print("🔄 Initializing CityTalk Assistant...")
         
         # First try real OpenAI assistant if available
@@ -50,7 +76,7 @@ class StreamingHybridAssistant:
                     self.file_count = info['files_uploaded']
                     self.mode = "openai"
                     print(f"✅ Real OpenAI Assistant ready! ({self.file_count} files)")
-                    return
+                    return True
                 else:
                     print("⚠️ OpenAI Assistant setup failed, switching to demo mode...")
                     
@@ -59,84 +85,127 @@ class StreamingHybridAssistant:
                 print("🔄 Falling back to demo mode...")
         
         # Fallback to demo mode
-        
+        return False
     
    
-    def process_query_streaming(self, user_query, session_id):
-        """Process query with real-time streaming to frontend"""
+    def process_query_streaming(self, user_query, session_id, deadline=None, client_id=None):
+        """
+        Process query with real-time streaming to frontend (client_id picks the client's conversation thread).
+        An identical question already in flight is not asked again: the session joins its job (see singleflight).
+        """
         try:
             if self.mode == "openai" and self.real_assistant:
-                return self._stream_openai_response(user_query, session_id)
+                return self._stream_openai_response(user_query, session_id, deadline or Deadline(), client_id)
             else:
                 return self._stream_demo_response(user_query, session_id)
                 
+        except PoolSaturatedError:
+            raise
         except Exception as e:
             print(f"❌ Error in streaming query: {e}")
             return self._send_stream_error(session_id, str(e))
     
-    def _stream_openai_response(self, user_query, session_id):
-        """Stream real OpenAI response"""
+    def flight_key(self, user_query, client_id):
+        """Single-flight key of a question, or None when its answer must not be shared"""
+        if self.mode != "openai" or self.real_assistant is None:
+            return None
+        if self.real_assistant.threads.has_conversation(client_id):
+            return None  # Follow-up question: the answer depends on this client's conversation
+        return flight_key(user_query, self.real_assistant.data_version)
+    
+    def _stream_openai_response(self, user_query, session_id, deadline, client_id=None):
+        """Stream real OpenAI response: run events are fanned out to the subscribed sessions as they arrive"""
+        session = sessions.get(session_id)
+        if session is None:
+            return
+        job, leader = inflight.join_or_start(self.flight_key(user_query, client_id), lambda: Deadline(deadline.budget_s))
+        if not leader:
+            # The run happens on the leader's thread: this client's own thread gets a copy of the exchange
+            member = (client_id, user_query)
+            self.real_assistant.threads.expect_history(client_id)
+            if not job.subscribe(session, member):
+                # Finished between joining and subscribing: the replay has the whole answer
+                self._share_answer(job, [member])
+            print(f"🔗 Joined the in-flight answer to: {user_query} ({job.subscriber_count} clients)")
+            return
+        job.subscribe(session)
+        
         def stream_thread():
+            # The run uses the job's deadline: it is cancelled only once every subscriber has left
             try:
-                queue = streaming_sessions[session_id]
-                
                 # Send initial status
-                queue.put({
+                job.publish({
                     'type': 'status',
                     'message': '🤖 Connecting to OpenAI Assistant...'
                 })
                 
-                # Use the streaming method from lapa.py
-                # We need to modify lapa.py to support custom streaming callbacks
-                result = self.real_assistant.process_query_simple(user_query)
+                # Answer text goes out as coalesced delta frames (see deltastream)
+                content = DeltaEncoder(job.publish)
+                
+                def on_event(event):
+                    if event['type'] == 'text':
+                        if not content.started:
+                            job.publish({
+                                'type': 'start',
+                                'message': '🤖 Assistant is writing...'
+                            })
+                        content.append(event['delta'])
+                    elif event['type'] == 'tool':
+                        content.flush()
+                        job.publish(dict(event, message=TOOL_STATUS.get(event['stage'], '🔧 Working...')))
+                
+                result = self.real_assistant.process_query_streaming(user_query, on_event, job.deadline, client_id)
+                content.flush()
                 
                 if result['success']:
-                    # Simulate streaming for now (we can enhance this later)
-                    response = result['response']
-                    words = response.split()
-                    
-                    queue.put({
-                        'type': 'start',
-                        'message': '🤖 Assistant is writing...'
-                    })
-                    
-                    current_text = ""
-                    for i, word in enumerate(words):
-                        current_text += word + " "
-                        queue.put({
-                            'type': 'content',
-                            'content': current_text,
-                            'progress': (i + 1) / len(words)
-                        })
-                        time.sleep(0.05)  # Simulate typing speed
-                    
-                    queue.put({
+                    job.publish({
                         'type': 'complete',
-                        'final_content': response,
-                        'run_id': result.get('run_id', 'openai_complete')
+                        'seq': content.seq,
+                        'final_content': result['response'],
+                        'run_id': result.get('run_id', 'openai_complete'),
+                        'deadline': job.deadline.report()
                     })
                 else:
-                    queue.put({
+                    job.publish({
                         'type': 'error',
-                        'error': result['error']
+                        'error': result['error'],
+                        'stop_reason': job.deadline.stop_reason
                     })
                     
             except Exception as e:
-                queue.put({
+                job.publish({
                     'type': 'error',
                     'error': f'OpenAI streaming error: {str(e)}'
                 })
+            
+            # No client joins after the terminal event, so the member list is final
+            self._share_answer(job, job.members)
         
-        # Start streaming in background thread
-        thread = threading.Thread(target=stream_thread)
-        thread.start()
+        # Run on the bounded worker pool (raises PoolSaturatedError when it is full)
+        try:
+            self.workers.submit(stream_thread)
+        except PoolSaturatedError as e:
+            job.publish({'type': 'error', 'error': f'Server busy: {e}'})  # Also ends any session that joined meanwhile
+            self._share_answer(job, job.members)
+            raise
     
-
+    def _share_answer(self, job, members):
+        """
+        Queues a finished shared job's question and answer for each joiner's own thread.
+        Only memory is touched here; each joiner's exchange reaches the API with its next question.
+        """
+        result = job.result
+        for client_id, question in members:
+            if result is not None and result['type'] == 'complete':
+                self.real_assistant.add_exchange(client_id, question, result['final_content'])
+            else:
+                self.real_assistant.threads.drop_pending(client_id)
     
     def _send_stream_error(self, session_id, error_msg):
         """Send error to streaming session"""
-        if session_id in streaming_sessions:
-            streaming_sessions[session_id].put({
+        session = sessions.get(session_id)
+        if session is not None:
+            session.put({
                 'type': 'error',
                 'error': error_msg
             })
@@ -147,7 +216,7 @@ class StreamingHybridAssistant:
         """Get current assistant status"""
         return {
             'mode': self.mode,
-            'ready': True,
+            'ready': self.warmup.ready,
             'files_uploaded': self.file_count,
             'assistant_type': 'OpenAI GPT-4' if self.mode == 'openai' else 'Demo Assistant'
         }
@@ -156,34 +225,165 @@ class StreamingHybridAssistant:
 api_key ="test"
 chat_assistant = StreamingHybridAssistant(api_key)
 
+def not_ready_payload():
+    """503 body with a retry hint while the assistant is still warming up; returns (payload, status, headers)"""
+    failed = chat_assistant.warmup.failed
+    payload = {
+        'error': 'Assistant failed to start, please contact the administrator' if failed else 'Assistant is warming up, please retry shortly',
+        'warming_up': not failed,
+        'retry_after_s': WARMUP_RETRY_AFTER_S,
+        'warmup': chat_assistant.warmup.report()
+    }
+    return payload, 503, {'Retry-After': str(WARMUP_RETRY_AFTER_S)}
+
+def busy_payload(error, retry_after_s):
+    """429 body for a server at capacity; returns (payload, status, headers)"""
+    return {'error': f'Server busy: {error}', 'retry_after_s': retry_after_s}, 429, {'Retry-After': str(retry_after_s)}
+
+def parse_time_budget(value):
+    """Client-requested question budget in seconds, clamped to the default; None if not a positive number"""
+    try:
+        budget = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(budget) or budget <= 0:
+        return None
+    return min(budget, DEFAULT_QUESTION_BUDGET_S)
+
+def submit_prompt(data):
+    """
+    Starts answering a prompt request. Shared by the Flask app and the ASGI server (asgi_server).
+
+    Args:
+        data (dict): Request body: prompt, streaming, client_id, time_budget_s
+
+    Returns:
+        tuple: (payload, status, headers)
+    """
+    user_query = data.get('prompt', '')
+    use_streaming = data.get('streaming', True)  # Default to streaming
+    
+    if not user_query:
+        return {'error': 'No prompt provided'}, 400, {}
+    
+    # Clients may ask for a shorter budget, never a longer one
+    budget_s = parse_time_budget(data.get('time_budget_s', DEFAULT_QUESTION_BUDGET_S))
+    if budget_s is None:
+        return {'error': 'time_budget_s must be a positive number of seconds'}, 400, {}
+    
+    if not chat_assistant.warmup.ready:
+        return not_ready_payload()
+    
+    if not use_streaming:
+        # Non-streaming fallback (for compatibility)
+        return {'error': 'Non-streaming mode not implemented. Please use streaming mode.'}, 400, {}
+    
+    # Admission control: refuse early rather than queue work nobody can pick up
+    # (joining an identical question in flight needs no worker)
+    requested_client = data.get('client_id')
+    joins = inflight.joinable(chat_assistant.flight_key(user_query, requested_client and str(requested_client)))
+    if not joins and not chat_assistant.workers.admits():
+        return busy_payload('all workers are busy', SATURATED_RETRY_AFTER_S)
+    
+    print(f"\n🔹 Processing user query: {user_query}")
+    
+    # Create streaming session
+    deadline = Deadline(budget_s)
+    try:
+        session = sessions.create(deadline, data.get('client_id'))
+    except SessionLimitError as e:
+        return busy_payload(e, STREAM_MESSAGE_TIMEOUT_S)
+    session_id = session.id
+    
+    # Start streaming process; questions from one client share its conversation thread
+    client_id = str(data.get('client_id') or session_id)
+    try:
+        chat_assistant.process_query_streaming(user_query, session_id, deadline, client_id)
+    except PoolSaturatedError as e:
+        sessions.remove(session_id)
+        return busy_payload(e, SATURATED_RETRY_AFTER_S)
+    
+    # Return streaming info
+    status = chat_assistant.get_status()
+    return {
+        'streaming': True,
+        'session_id': session_id,
+        'stream_url': f'/stream/{session_id}',
+        'mode': status['mode'],
+        'assistant_type': status['assistant_type']
+    }, 200, {}
+
+def health_payload():
+    """Liveness (the process answers) and readiness (warm-up done) reported separately"""
+    status = chat_assistant.get_status()
+    return {
+        'status': 'healthy', 
+        'live': True,
+        'ready': status['ready'],
+        'warmup': chat_assistant.warmup.report(),
+        'sessions': sessions.stats(),
+        'workers': chat_assistant.workers.stats(),
+        'inflight': inflight.stats(),
+        'assistant_ready': status['ready'],
+        'files_uploaded': status['files_uploaded'],
+        'mode': status['mode'],
+        'assistant_type': status['assistant_type'],
+        'streaming_available': True
+    }
+
+def readiness_payload():
+    if not chat_assistant.warmup.ready:
+        return not_ready_payload()
+    return {'ready': True, 'warmup': chat_assistant.warmup.report()}, 200, {}
+
+def json_response(payload, status=200, headers=None):
+    response = jsonify(payload)
+    response.status_code = status
+    for name, value in (headers or {}).items():
+        response.headers[name] = value
+    return response
+
+@app.before_request
+def ensure_warmup():
+    """Servers that import this module (instead of running it) start the warm-up on the first request"""
+    chat_assistant.start_warmup()
+
 @app.route('/stream/<session_id>')
 def stream_response(session_id):
     """Server-Sent Events endpoint for real-time streaming"""
     def generate():
-        if session_id not in streaming_sessions:
+        queue = sessions.claim(session_id)
+        if queue is None:
             yield f"data: {json.dumps({'type': 'error', 'error': 'Session not found'})}\n\n"
             return
         
-        queue = streaming_sessions[session_id]
+        deadline = queue.deadline or Deadline(None)
         
-        while True:
-            try:
-                # Get message from queue (blocks until available)
-                message = queue.get(timeout=30)  # 30 second timeout
-                yield f"data: {json.dumps(message)}\n\n"
-                
-                # End stream on completion or error
-                if message['type'] in ['complete', 'error']:
-                    break
+        try:
+            while True:
+                try:
+                    # Get message from queue (blocks until available, never past the question deadline)
+                    timeout = min(STREAM_MESSAGE_TIMEOUT_S, deadline.remaining() + STREAM_GRACE_S)
+                    message = queue.get(timeout=timeout)
+                    yield f"data: {json.dumps(message)}\n\n"
                     
-            except:
-                # Timeout or error - end stream
-                yield f"data: {json.dumps({'type': 'timeout'})}\n\n"
-                break
-        
-        # Clean up session
-        if session_id in streaming_sessions:
-            del streaming_sessions[session_id]
+                    # End stream on completion or error
+                    if message['type'] in ['complete', 'error']:
+                        break
+                        
+                except Exception:
+                    # Timeout - end stream, and stop the work nobody will read
+                    reason = deadline.stop_reason or ('question deadline reached' if deadline.expired() else 'no event received in time')
+                    deadline.cancel(f"stream timed out: {reason}")
+                    yield f"data: {json.dumps({'type': 'timeout', 'reason': reason})}\n\n"
+                    break
+        except GeneratorExit:
+            # Client disconnected: cancel the run and any generated code still executing
+            deadline.cancel("client disconnected")
+            raise
+        finally:
+            # Clean up session
+            sessions.remove(session_id)
     
     return Response(generate(), mimetype='text/event-stream', headers={
         'Cache-Control': 'no-cache',
@@ -194,55 +394,22 @@ def stream_response(session_id):
 @app.route('/process-prompt', methods=['POST'])
 def process_prompt():
     try:
-        data = request.get_json()
-        user_query = data.get('prompt', '')
-        use_streaming = data.get('streaming', True)  # Default to streaming
-        
-        if not user_query:
-            return jsonify({'error': 'No prompt provided'}), 400
-        
-        print(f"\n🔹 Processing user query: {user_query}")
-        
-        if use_streaming:
-            # Create streaming session
-            session_id = f"session_{random.randint(10000, 99999)}_{int(time.time())}"
-            streaming_sessions[session_id] = Queue()
-            
-            # Start streaming process
-            chat_assistant.process_query_streaming(user_query, session_id)
-            
-            # Return streaming info
-            status = chat_assistant.get_status()
-            return jsonify({
-                'streaming': True,
-                'session_id': session_id,
-                'stream_url': f'/stream/{session_id}',
-                'mode': status['mode'],
-                'assistant_type': status['assistant_type']
-            })
-        else:
-            # Non-streaming fallback (for compatibility)
-            return process_prompt_classic()
-        
+        return json_response(*submit_prompt(request.get_json()))
     except Exception as e:
         print(f"❌ Error processing prompt: {e}")
         return jsonify({'error': str(e)}), 500
 
-def process_prompt_classic():
-    """Classic non-streaming processing for fallback"""
-    return jsonify({'error': 'Non-streaming mode not implemented. Please use streaming mode.'}), 400
-
 @app.route('/health')
 def health_check():
-    status = chat_assistant.get_status()
-    return jsonify({
-        'status': 'healthy', 
-        'assistant_ready': status['ready'],
-        'files_uploaded': status['files_uploaded'],
-        'mode': status['mode'],
-        'assistant_type': status['assistant_type'],
-        'streaming_available': True
-    })
+    return jsonify(health_payload())
+
+@app.route('/health/live')
+def liveness_check():
+    return jsonify({'live': True})
+
+@app.route('/health/ready')
+def readiness_check():
+    return json_response(*readiness_payload())
 
 @app.route('/maps/<filename>')
 def serve_map(filename):
@@ -297,14 +464,17 @@ def serve_map(filename):
     return Response(default_html, mimetype='text/html')
 
 if __name__ == '__main__':
-    status = chat_assistant.get_status()
     print("🚀 Starting CityTalk Streaming Backend...")
     print("📁 Available endpoints:")
     print("  - POST /process-prompt (Streaming chat processing)")
     print("  - GET /stream/<session_id> (SSE streaming endpoint)")
-    print("  - GET /health (Health check)")
+    print("  - GET /health (Liveness and readiness)")
+    print("  - GET /health/live, /health/ready (Probes; ready answers 503 during warm-up)")
     print("  - GET /maps/<filename> (Default page)")
-    print(f"🤖 Assistant Mode: {status['assistant_type']}")
-    print(f"📊 Files Available: {status['files_uploaded']} CSV datasets")
     print("✨ Real-time streaming enabled!")
-    app.run(debug=True, host='127.0.0.1', port=5000)
\ No newline at end of file
+    print("💡 For hundreds of concurrent streams use the async server: python asgi_server.py")
+    # With the debug reloader only the serving child process warms up (the watcher would upload twice)
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        print("🔥 Warming up the assistant and data caches in the background...")
+        chat_assistant.start_warmup()
+    app.run(debug=True, host='127.0.0.1', port=5000)
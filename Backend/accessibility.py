@@ -0,0 +1,226 @@
+"""
+Transit accessibility surface.
+
+Bus stops (ESTACIONS_BUS.csv), metro / FGC / tram / rail stations
+(PublicTransport.csv, split by NOM_CAPA) and bicing stations (bicing.csv) are
+summarised on a fixed metric grid: per mode, the distance from each cell centre
+to the nearest stop and the number of stops within 300 m and 500 m. The stack is
+saved under the cache dir as a .npy array plus JSON metadata, memory-mapped on
+load, and rebuilt only when one of the source files changes, so scoring any set
+of locations is an array lookup and coverage gaps are array reductions.
+"""
+import hashlib
+import json
+import math
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from capture import echo
+from config import get_cache_dir, get_data_dir
+from spatial import METRIC_CRS, PointIndex, standardize_layer
+
+ACCESS_CELL_M = 25.0
+ACCESS_MARGIN_M = 1000.0
+COUNT_RADII_M = (300, 500)
+SERVED_AREA_M = 800.0  # Cells farther than this from every stop of every mode are outside the city (sea, Collserola)
+
+# mode -> (source file, NOM_CAPA values to keep or None for every row)
+MODES = {
+    "bus": ("ESTACIONS_BUS.csv", None),
+    "metro": ("PublicTransport.csv", ["Metro i línies urbanes FGC"]),
+    "fgc": ("PublicTransport.csv", ["Ferrocarrils Generalitat (FGC)"]),
+    "tram": ("PublicTransport.csv", ["Tramvia"]),
+    "rail": ("PublicTransport.csv", ["RENFE", "Tren a l'aeroport"]),
+    "bicing": ("bicing.csv", None),
+}
+
+
+def layer_names():
+    """Names of the stacked grids, in storage order."""
+    names = []
+    for mode in MODES:
+        names.append(f"{mode}_nearest_m")
+        names.extend(f"{mode}_within_{radius}m" for radius in COUNT_RADII_M)
+    return names
+
+
+class AccessibilitySurface:
+    """Stack of grids (layer, row, col); cell (row, col) is centred on x0 + (col + .5)*cell, y0 - (row + .5)*cell."""
+
+    def __init__(self, values, x0, y0, cell_m, names, signature=None):
+        self.values = values
+        self.x0 = x0
+        self.y0 = y0
+        self.cell_m = cell_m
+        self.names = list(names)
+        self.signature = signature
+
+    def _cells(self, coords):
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        cols = np.floor((coords[:, 0] - self.x0) / self.cell_m)
+        rows = np.floor((self.y0 - coords[:, 1]) / self.cell_m)
+        _, height, width = self.values.shape
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        return np.nan_to_num(rows).astype(np.intp), np.nan_to_num(cols).astype(np.intp), inside
+
+    def sample(self, coords, names=None):
+        """{layer name: values} at (x, y) METRIC_CRS coordinates; NaN outside the grid."""
+        rows, cols, inside = self._cells(coords)
+        result = {}
+        for name in names or self.names:
+            column = np.full(len(rows), np.nan)
+            column[inside] = self.values[self.names.index(name), rows[inside], cols[inside]]
+            result[name] = column
+        return result
+
+    def cell_centers(self, cells):
+        """(n, 2) METRIC_CRS centres of flat cell indices."""
+        _, _, width = self.values.shape
+        rows, cols = np.divmod(np.asarray(cells), width)
+        return np.column_stack([self.x0 + (cols + 0.5) * self.cell_m, self.y0 - (rows + 0.5) * self.cell_m])
+
+    def served_mask(self):
+        """Cells within SERVED_AREA_M of at least one stop of any mode (the city, roughly)."""
+        nearest = np.stack([self.values[self.names.index(f"{mode}_nearest_m")] for mode in MODES])
+        return (nearest <= SERVED_AREA_M).any(axis=0)
+
+    def save(self, path):
+        """Writes <path>.npy and <path>.json (atomically, so concurrent builders cannot clash)."""
+        tmp = f"{path}.{os.getpid()}.tmp.npy"
+        np.save(tmp, np.asarray(self.values, dtype=np.float32))
+        os.replace(tmp, f"{path}.npy")
+        meta = {"x0": self.x0, "y0": self.y0, "cell_m": self.cell_m, "names": self.names,
+                "shape": list(self.values.shape), "crs": METRIC_CRS, "signature": self.signature}
+        meta_tmp = f"{path}.{os.getpid()}.json.tmp"
+        with open(meta_tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(meta_tmp, f"{path}.json")
+
+    @classmethod
+    def load(cls, path):
+        """Memory-maps a saved surface; returns None if it is missing or incomplete."""
+        if not (os.path.exists(f"{path}.npy") and os.path.exists(f"{path}.json")):
+            return None
+        with open(f"{path}.json") as f:
+            meta = json.load(f)
+        values = np.load(f"{path}.npy", mmap_mode="r")
+        return cls(values, meta["x0"], meta["y0"], meta["cell_m"], meta["names"], meta.get("signature"))
+
+
+def _source_signature(data_dir):
+    """Changes whenever a source file is added, removed or modified (or the grid parameters change)."""
+    files = sorted({source for source, _ in MODES.values()})
+    stats = []
+    for name in files:
+        path = os.path.join(data_dir, name)
+        stat = os.stat(path) if os.path.exists(path) else None
+        stats.append([name, stat.st_size if stat else None, stat.st_mtime_ns if stat else None])
+    params = [ACCESS_CELL_M, ACCESS_MARGIN_M, list(COUNT_RADII_M), {m: v[1] for m, v in MODES.items()}]
+    return hashlib.sha1(json.dumps([stats, params], sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _mode_coords(data_dir):
+    """{mode: (n, 2) METRIC_CRS stop coordinates}; modes whose file is missing get no stops."""
+    layers = {}
+    coords = {}
+    for mode, (source, capas) in MODES.items():
+        path = os.path.join(data_dir, source)
+        if source not in layers:
+            layers[source] = standardize_layer(pd.read_csv(path)) if os.path.exists(path) else None
+        layer = layers[source]
+        if layer is None or "utm_x" not in layer.columns:
+            coords[mode] = np.empty((0, 2))
+            continue
+        if capas is not None and "NOM_CAPA" in layer.columns:
+            layer = layer[layer["NOM_CAPA"].isin(capas)]
+        coords[mode] = np.column_stack([layer["utm_x"].to_numpy(float), layer["utm_y"].to_numpy(float)])
+    return coords
+
+
+def build_accessibility_surface(data_dir, cell_m=ACCESS_CELL_M, signature=None):
+    """Computes every mode's nearest distance and stop counts for each grid cell."""
+    coords = _mode_coords(data_dir)
+    every_stop = np.vstack([c for c in coords.values() if len(c)] or [np.zeros((1, 2))])
+    minx, miny = np.nanmin(every_stop, axis=0) - ACCESS_MARGIN_M
+    maxx, maxy = np.nanmax(every_stop, axis=0) + ACCESS_MARGIN_M
+    width = int(math.ceil((maxx - minx) / cell_m))
+    height = int(math.ceil((maxy - miny) / cell_m))
+    x0, y0 = float(minx), float(maxy)
+
+    cols, rows = np.meshgrid(np.arange(width), np.arange(height))
+    centers = np.column_stack([x0 + (cols.ravel() + 0.5) * cell_m, y0 - (rows.ravel() + 0.5) * cell_m])
+
+    values = np.empty((len(layer_names()), height, width), dtype=np.float32)
+    layer = 0
+    for mode in MODES:
+        index = PointIndex(coords[mode])
+        _, nearest = index.nearest_many(centers)
+        values[layer] = nearest.reshape(height, width)
+        layer += 1
+        for radius in COUNT_RADII_M:
+            values[layer] = index.count_within(centers, radius).reshape(height, width)
+            layer += 1
+    return AccessibilitySurface(values, x0, y0, float(cell_m), layer_names(), signature)
+
+
+_surface = None
+_surface_lock = threading.Lock()
+
+
+def get_accessibility_surface(data_dir=None):
+    """
+    The accessibility surface for the current source files: reused while they are
+    unchanged, otherwise loaded from the cache dir (memory-mapped) or rebuilt.
+    """
+    global _surface
+    data_dir = str(data_dir or get_data_dir())
+    signature = _source_signature(data_dir)
+    with _surface_lock:
+        if _surface is not None and _surface.signature == signature:
+            return _surface
+
+        cache_dir = get_cache_dir()
+        path = os.path.join(cache_dir, f"accessibility_{signature}")
+        surface = AccessibilitySurface.load(path)
+        if surface is None:
+            echo(f"🚏 Building transit accessibility grid ({ACCESS_CELL_M:.0f} m cells)...")
+            build_accessibility_surface(data_dir, signature=signature).save(path)
+            surface = AccessibilitySurface.load(path)
+            # Surfaces for older versions of the source files are never used again
+            for name in os.listdir(cache_dir):
+                if name.startswith("accessibility_") and signature not in name:
+                    try:
+                        os.remove(os.path.join(cache_dir, name))
+                    except OSError:
+                        pass
+        _surface = surface
+        return _surface
+
+
+def access_at_coords(coords, modes=None):
+    """{column: values} per mode at (n, 2) METRIC_CRS coordinates: '<mode>_nearest_m' and '<mode>_within_<r>m'."""
+    surface = get_accessibility_surface()
+    modes = list(modes or MODES)
+    names = [name for name in surface.names if name.split("_")[0] in modes]
+    return surface.sample(coords, names)
+
+
+def coverage_gaps(mode="bicing", min_distance_m=500.0, center_xy=None, radius_m=None):
+    """
+    Served-area cells whose nearest <mode> stop is at least min_distance_m away, optionally
+    restricted to radius_m around a METRIC_CRS center. Returns (cell centres (n, 2), distances).
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown transit mode '{mode}' (expected one of {', '.join(MODES)})")
+    surface = get_accessibility_surface()
+    nearest = np.asarray(surface.values[surface.names.index(f"{mode}_nearest_m")])
+    gaps = surface.served_mask() & (nearest >= min_distance_m)
+    cells = np.flatnonzero(gaps)
+    centers = surface.cell_centers(cells)
+    if center_xy is not None and radius_m is not None:
+        keep = np.hypot(centers[:, 0] - center_xy[0], centers[:, 1] - center_xy[1]) <= radius_m
+        cells, centers = cells[keep], centers[keep]
+    return centers, nearest.ravel()[cells]
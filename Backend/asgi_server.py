@@ -0,0 +1,182 @@
+"""
+Asyncio serving mode for the CityTalk backend (a plain ASGI app).
+
+Same routes and responses as Mother2's Flask app, which it shares its request
+logic, session registry and assistant with. The difference is how waiting is
+done. An open /stream connection is an async SSE generator awaiting its
+session queue, so it holds no thread, and one process keeps hundreds of
+streams open. The blocking assistant work runs on the bounded worker pool
+(workers.WorkerPool; size it with CITYTALK_WORKERS and
+CITYTALK_MAX_QUEUED_JOBS). When the pool is full, /process-prompt answers 429
+with Retry-After.
+
+Run it with `python asgi_server.py` or `uvicorn asgi_server:app` from Backend.
+Use a single process: sessions live in process memory.
+"""
+import asyncio
+import json
+import os
+import sys
+from queue import Empty
+
+from Mother2 import (
+    chat_assistant, sessions, submit_prompt, health_payload, readiness_payload,
+    STREAM_MESSAGE_TIMEOUT_S, STREAM_GRACE_S,
+)
+from deadline import Deadline
+
+MAX_BODY_BYTES = 1 << 20
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type'),
+    (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+    (b'access-control-expose-headers', b'Retry-After'),  # Readable by the browser on 429/503
+]
+SSE_HEADERS = [
+    (b'content-type', b'text/event-stream'),
+    (b'cache-control', b'no-cache'),
+    (b'connection', b'keep-alive'),
+]
+
+
+async def read_json(receive):
+    """Request body parsed as JSON (None if empty, malformed or too large)."""
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if len(body) > MAX_BODY_BYTES:
+            return None
+        if not message.get('more_body'):
+            break
+    try:
+        return json.loads(body or b'null')
+    except ValueError:
+        return None
+
+
+async def send_json(send, payload, status=200, headers=None):
+    body = json.dumps(payload).encode()
+    extra = [(name.lower().encode(), str(value).encode()) for name, value in (headers or {}).items()]
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())] + CORS_HEADERS + extra,
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def sse_events(session):
+    """Events of a session until it completes, errors or times out (the async twin of Mother2's generate)."""
+    deadline = session.deadline or Deadline(None)
+    while True:
+        try:
+            timeout = min(STREAM_MESSAGE_TIMEOUT_S, deadline.remaining() + STREAM_GRACE_S)
+            message = await session.get_async(timeout=timeout)
+        except Empty:
+            if session.closed:
+                return  # Client went away; nobody to tell
+            # Timeout - end stream, and stop the work nobody will read
+            reason = deadline.stop_reason or ('question deadline reached' if deadline.expired() else 'no event received in time')
+            deadline.cancel(f"stream timed out: {reason}")
+            yield {'type': 'timeout', 'reason': reason}
+            return
+        yield message
+        if message['type'] in ['complete', 'error']:
+            return
+
+
+async def watch_disconnect(receive, session):
+    """Cancels the question as soon as the client disconnects, even while no event is flowing."""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            if session.deadline is not None:
+                session.deadline.cancel("client disconnected")
+            sessions.remove(session.id)
+            return
+
+
+async def stream_response(session_id, receive, send):
+    """Server-Sent Events endpoint for real-time streaming"""
+    await send({'type': 'http.response.start', 'status': 200, 'headers': SSE_HEADERS + CORS_HEADERS})
+    session = sessions.claim(session_id)
+    if session is None:
+        body = f"data: {json.dumps({'type': 'error', 'error': 'Session not found'})}\n\n".encode()
+        await send({'type': 'http.response.body', 'body': body})
+        return
+
+    watcher = asyncio.create_task(watch_disconnect(receive, session))
+    try:
+        async for message in sse_events(session):
+            await send({'type': 'http.response.body', 'body': f"data: {json.dumps(message)}\n\n".encode(), 'more_body': True})
+        if not session.closed:
+            await send({'type': 'http.response.body', 'body': b''})
+    except (OSError, asyncio.CancelledError):
+        # Connection dropped mid-write, or the server is shutting down
+        if session.deadline is not None:
+            session.deadline.cancel("client disconnected")
+        raise
+    finally:
+        watcher.cancel()
+        sessions.remove(session_id)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            chat_assistant.start_warmup()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entry point"""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    # Servers without lifespan support warm up on the first request
+    chat_assistant.start_warmup()
+    method, path = scope['method'], scope['path']
+
+    if method == 'OPTIONS':
+        await send({'type': 'http.response.start', 'status': 204, 'headers': CORS_HEADERS})
+        await send({'type': 'http.response.body', 'body': b''})
+    elif path == '/process-prompt' and method == 'POST':
+        data = await read_json(receive)
+        if not isinstance(data, dict):
+            return await send_json(send, {'error': 'Request body must be a JSON object'}, 400)
+        try:
+            await send_json(send, *submit_prompt(data))
+        except Exception as e:
+            print(f"❌ Error processing prompt: {e}")
+            await send_json(send, {'error': str(e)}, 500)
+    elif path.startswith('/stream/') and method == 'GET':
+        await stream_response(path[len('/stream/'):], receive, send)
+    elif path == '/health' and method == 'GET':
+        await send_json(send, health_payload())
+    elif path == '/health/live' and method == 'GET':
+        await send_json(send, {'live': True})
+    elif path == '/health/ready' and method == 'GET':
+        await send_json(send, *readiness_payload())
+    else:
+        await send_json(send, {'error': 'Not found'}, 404)
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        print("❌ The async server needs uvicorn: pip install uvicorn (or run Mother2.py for the Flask server)")
+        sys.exit(1)
+
+    print("🚀 Starting CityTalk async streaming backend...")
+    print(f"⚙️ Workers: {chat_assistant.workers.workers} (+{chat_assistant.workers.max_queued} queued jobs)")
+    uvicorn.run(app, host=os.environ.get('HOST', '127.0.0.1'), port=int(os.environ.get('PORT', 5000)), workers=1)
@@ -0,0 +1,124 @@
+"""
+Upload manifest for the Assistants API.
+
+Maps the content hash of every Data/ CSV to the file id it was uploaded as,
+and records the assistant built over those files. On startup the manifest is
+checked against the API. Unchanged files and the assistant are reused. Only
+new or changed files are uploaded, concurrently in bounded batches. Uploads
+whose CSV changed or disappeared, or that were replaced by a re-upload, are
+deleted, so orphaned files no longer pile up in the account. Only a 404 marks a
+recorded upload as gone: any other error while checking is raised. The manifest is kept per account and API endpoint in the
+cache dir.
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from openai import NotFoundError
+
+from config import get_cache_dir
+
+UPLOAD_CONCURRENCY = 4  # Files uploaded (or verified) at the same time
+HASH_CHUNK_BYTES = 1 << 20
+
+
+def file_digest(path):
+    """sha256 of a file's content, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class UploadManifest:
+    """{'files': {sha256: {'file_id', 'filename', 'bytes'}}, 'assistant': {'id', 'file_ids', 'config'}}"""
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.assistant = {}
+
+    @classmethod
+    def for_client(cls, client):
+        """The manifest for this API key and endpoint (file ids are only valid there)."""
+        account = hashlib.sha1(f"{client.api_key}|{client.base_url}".encode()).hexdigest()[:12]
+        manifest = cls(os.path.join(get_cache_dir(), f"assistant_manifest_{account}.json"))
+        manifest.load()
+        return manifest
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.files = data.get("files", {})
+            self.assistant = data.get("assistant", {})
+        except (OSError, ValueError):
+            self.files, self.assistant = {}, {}
+
+    def save(self):
+        """Writes the manifest atomically."""
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"files": self.files, "assistant": self.assistant}, f, indent=2)
+        os.replace(tmp, self.path)
+
+
+def _file_exists(client, file_id):
+    """False only if the API says the file is gone; other errors (network, auth, rate limits) are raised."""
+    try:
+        client.files.retrieve(file_id)
+        return True
+    except NotFoundError:
+        return False
+
+
+def _upload(client, path):
+    with open(path, "rb") as f:
+        return client.files.create(file=f, purpose="assistants").id
+
+
+def sync_files(client, data_dir, manifest, concurrency=UPLOAD_CONCURRENCY):
+    """
+    Makes sure every CSV in data_dir is uploaded once. Returns {filename: file_id} for
+    the files now available; uploads that failed are reported and left out. If a
+    recorded upload cannot be checked, the error is raised and nothing is re-uploaded.
+    """
+    paths = {name: os.path.join(data_dir, name) for name in sorted(os.listdir(data_dir)) if name.endswith(".csv")}
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        digests = dict(zip(paths, pool.map(file_digest, paths.values())))
+
+        # Reuse recorded uploads that still exist remotely
+        known = {name: manifest.files[digest]["file_id"] for name, digest in digests.items() if digest in manifest.files}
+        alive = dict(zip(known, pool.map(lambda file_id: _file_exists(client, file_id), known.values())))
+        available = {name: known[name] for name in known if alive[name]}
+
+        # Upload what is new, changed or gone remotely
+        missing = [name for name in paths if name not in available]
+        futures = {name: pool.submit(_upload, client, paths[name]) for name in missing}
+        for name, future in futures.items():
+            try:
+                available[name] = future.result()
+                print(f"✅ Uploaded: {name}")
+            except Exception as e:
+                print(f"⚠️ Failed to upload {name}: {e}")
+
+    current = {digests[name]: {"file_id": file_id, "filename": name, "bytes": os.path.getsize(paths[name])}
+               for name, file_id in available.items()}
+    # Uploads of removed or changed CSVs, and those replaced by a re-upload
+    kept = {entry["file_id"] for entry in current.values()}
+    stale = [entry["file_id"] for entry in manifest.files.values() if entry["file_id"] not in kept]
+    for file_id in stale:
+        try:
+            client.files.delete(file_id)
+        except Exception:
+            pass  # Already gone, or belongs to an account we can no longer reach
+    if stale:
+        print(f"🧹 Deleted {len(stale)} outdated uploads")
+
+    manifest.files = current
+    reused = len(paths) - len(missing)
+    if reused:
+        print(f"♻️ Reused {reused} unchanged uploads")
+    return available
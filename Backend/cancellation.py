@@ -0,0 +1,111 @@
+"""
+Cancellation for questions nobody is waiting for any more.
+
+A CancelToken belongs to one question (every Deadline carries one). It fires
+when the SSE client disconnects, the stream times out or the session expires.
+Work checks it through the Deadline, which reads as expired once cancelled, so
+retry and correction loops stop. Blocking work registers on_cancel callbacks
+(e.g. cancelling the Assistant run). Generated code running under
+abort_on_cancel is interrupted as soon as the interpreter regains control.
+"""
+import ctypes
+import threading
+from contextlib import contextmanager
+
+
+class Cancelled(BaseException):
+    """
+    Raised inside work that was cancelled. A BaseException, like KeyboardInterrupt,
+    so `except Exception` blocks in generated code cannot swallow it.
+    """
+
+
+class CancelToken:
+    """Thread-safe, one-shot cancellation flag with callbacks."""
+
+    def __init__(self):
+        self.reason = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="cancelled"):
+        """Fires the token once; callbacks run on the cancelling thread. Returns False if already fired."""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(reason)
+            except Exception as e:
+                print(f"⚠️ Cancellation callback failed: {e}")
+        return True
+
+    def on_cancel(self, callback):
+        """Registers callback(reason); runs it now if already cancelled. Returns a function that unregisters it."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._discard(callback)
+        callback(self.reason)
+        return lambda: None
+
+    def _discard(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise Cancelled(self.reason)
+
+
+def _raise_in_thread(thread_id, exc_type):
+    """Schedules exc_type in another thread at its next bytecode check; None clears a pending one."""
+    exc = ctypes.py_object(exc_type) if exc_type is not None else None  # None is passed as NULL
+    return ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id), exc)
+
+
+@contextmanager
+def abort_on_cancel(token):
+    """
+    Runs the block so that cancelling token interrupts it with Cancelled.
+
+    Nothing is traced while the block runs. When the token fires, Cancelled is
+    scheduled as an asynchronous exception in this thread, and the interpreter
+    raises it at its next bytecode check: the next loop iteration or Python call,
+    or when a long C call (a geopandas join, a sleep) returns. Until then the block
+    runs at full speed, and debuggers or coverage tracers stay installed.
+    """
+    token.raise_if_cancelled()
+    thread_id = threading.get_ident()
+    lock = threading.Lock()
+    state = {"active": True, "fired": False}
+
+    def interrupt(reason):
+        with lock:
+            if state["active"]:
+                state["fired"] = True
+                _raise_in_thread(thread_id, Cancelled)
+
+    unregister = token.on_cancel(interrupt)
+    try:
+        yield
+    except Cancelled:
+        raise Cancelled(token.reason) from None  # The asynchronous one carries no reason
+    finally:
+        with lock:
+            state["active"] = False
+            fired = state["fired"]
+        unregister()
+        if fired:
+            _raise_in_thread(thread_id, None)  # Fired as the block ended: drop it if still pending
+    if fired:
+        raise Cancelled(token.reason)
@@ -0,0 +1,187 @@
+"""
+Bounded capture of generated-code output.
+
+Generated scripts often print whole GeoDataFrames. BoundedOutput keeps only
+the head and tail of what was printed (capped in UTF-8 bytes, so "µg/m³" and
+emoji count for what they weigh), with a marker for the truncated middle, and
+is injected as the script's own `print`, so the process-wide sys.stdout is
+never swapped and concurrent executions cannot interleave. The helpers the
+script calls print through echo(), which writes to the buffer capturing the
+current thread, if any. Full per-attempt logs (still bounded) are written to
+disk by a background thread.
+"""
+import builtins
+import collections
+import contextlib
+import os
+import queue
+import sys
+import threading
+
+EXEC_LOG_DIR = os.environ.get(
+    "CITYTALK_EXEC_LOG_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "exec_logs")
+)
+
+_capturing = threading.local()
+
+
+def _is_continuation(byte):
+    return byte & 0xC0 == 0x80
+
+
+def _prefix(data, limit):
+    """The longest run of whole UTF-8 characters at the start of data within limit bytes."""
+    if limit >= len(data):
+        return data
+    end = max(0, limit)
+    while end > 0 and _is_continuation(data[end]):
+        end -= 1
+    return data[:end]
+
+
+def _char_start(data, offset):
+    """First character boundary at or after offset."""
+    while offset < len(data) and _is_continuation(data[offset]):
+        offset += 1
+    return offset
+
+
+class BoundedOutput:
+    """Text sink keeping the first head_bytes and last tail_bytes (UTF-8) written to it."""
+
+    def __init__(self, head_bytes=8000, tail_bytes=8000):
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self._head = bytearray()
+        self._head_open = True
+        self._tail = collections.deque()
+        self._tail_size = 0
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def truncated_bytes(self):
+        return self.total_bytes - len(self._head) - self._tail_size
+
+    def write(self, text):
+        data = text.encode("utf-8", errors="replace")
+        with self._lock:
+            self.total_bytes += len(data)
+            if self._head_open:
+                taken = _prefix(data, self.head_bytes - len(self._head))
+                self._head += taken
+                data = data[len(taken):]
+                # Whatever did not fit goes to the tail, and so does everything after it
+                self._head_open = not data
+            if not data:
+                return
+            self._tail.append(data)
+            self._tail_size += len(data)
+            # Ring buffer: drop the oldest tail text beyond the cap (whole characters only)
+            while self._tail_size > self.tail_bytes:
+                excess = self._tail_size - self.tail_bytes
+                oldest = self._tail[0]
+                if len(oldest) <= excess:
+                    self._tail.popleft()
+                    self._tail_size -= len(oldest)
+                else:
+                    cut = _char_start(oldest, excess)
+                    self._tail[0] = oldest[cut:]
+                    self._tail_size -= cut
+
+    def flush(self):
+        pass
+
+    def print(self, *args, sep=' ', end='\n', file=None, flush=False):
+        """Drop-in for print() inside generated code; explicit file= targets are honoured."""
+        if file is not None and file not in (sys.stdout, sys.__stdout__):
+            builtins.print(*args, sep=sep, end=end, file=file, flush=flush)
+            return
+        self.write(sep.join(str(arg) for arg in args) + end)
+
+    @contextlib.contextmanager
+    def capturing(self):
+        """Routes echo() on this thread into this buffer for the duration of the block."""
+        previous = getattr(_capturing, "output", None)
+        _capturing.output = self
+        try:
+            yield self
+        finally:
+            _capturing.output = previous
+
+    def _marker(self):
+        return f"\n... [{self.truncated_bytes} bytes truncated] ...\n"
+
+    def getvalue(self):
+        """Head + truncation marker (if anything was dropped) + tail."""
+        with self._lock:
+            head, tail = self._head.decode("utf-8"), b"".join(self._tail).decode("utf-8")
+            return head + (self._marker() if self.truncated_bytes else "") + tail
+
+    def excerpt(self, max_bytes=1500):
+        """Compact view for LLM prompts: a little of the beginning, mostly the end."""
+        with self._lock:
+            data = bytes(self._head) + b"".join(self._tail)
+            dropped = self.truncated_bytes
+        if not dropped and len(data) <= max_bytes:
+            return data.decode("utf-8")
+        head = _prefix(data, max_bytes // 4)
+        tail = data[_char_start(data, max(len(head), len(data) - (max_bytes - len(head)))):]
+        # Counted from the actual slices, plus whatever the buffer itself already dropped
+        omitted = len(data) - len(head) - len(tail) + dropped
+        return head.decode("utf-8") + f"\n... [{omitted} bytes omitted] ...\n" + tail.decode("utf-8")
+
+
+def echo(*args, sep=' ', end='\n', file=None, flush=False):
+    """
+    print() for the helpers generated code calls: their notes go to the buffer
+    capturing this thread's script (BoundedOutput.capturing), else to stdout.
+    """
+    output = getattr(_capturing, "output", None)
+    if output is None:
+        builtins.print(*args, sep=sep, end=end, file=file, flush=flush)
+    else:
+        output.print(*args, sep=sep, end=end, file=file, flush=flush)
+
+
+class _AttemptLogWriter:
+    """Background thread that writes attempt logs so execution never waits on disk."""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="exec-log-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, path, text):
+        self._queue.put((path, text))
+
+    def _run(self):
+        while True:
+            path, text = self._queue.get()
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(text)
+            except OSError as e:
+                builtins.print(f"⚠️ Could not write execution log {path}: {e}")
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def persist_attempt_log(question_id, run_index, attempt, code, output, status):
+    """Queues one attempt's code and captured output for writing under EXEC_LOG_DIR/<question_id>/."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = _AttemptLogWriter()
+
+    path = os.path.join(EXEC_LOG_DIR, question_id, f"run_{run_index:02d}_attempt_{attempt}.log")
+    text = (
+        f"status: {status}\n"
+        f"{'=' * 20} CODE {'=' * 20}\n{code}\n"
+        f"{'=' * 20} OUTPUT ({output.total_bytes} bytes) {'=' * 20}\n{output.getvalue()}\n"
+    )
+    _writer.submit(path, text)
+    return path
@@ -20,7 +20,7 @@ try:
     
     # Fetch data
     print("Fetching datasets...")
-    datasets_info, csv_dirs = collector.fetch_data(datasets, coordinates)
+    datasets_info, csv_dirs = collector.fetch_data(datasets, coordinates, lazy=False)
     
     print("="*50)
     print("DATASET ANALYSIS")
@@ -27,4 +27,14 @@ def get_openai_api_key():
             "with OPENAI_API_KEY=your-api-key-here"
         )
     
-    return api_key 
\ No newline at end of file
+    return api_key 
+
+def get_cache_dir():
+    """Directory for derived data such as rasters (CITYTALK_CACHE_DIR, else Backend/cache)"""
+    cache_dir = Path(os.environ.get('CITYTALK_CACHE_DIR', Path(__file__).parent / "cache"))
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+def get_data_dir():
+    """Directory holding the municipal CSVs (CITYTALK_DATA_DIR, else the repository's Data folder)"""
+    return Path(os.environ.get('CITYTALK_DATA_DIR', Path(__file__).parent.parent / "Data"))
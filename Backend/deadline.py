@@ -0,0 +1,82 @@
+"""
+Per-question time budget shared by every stage of the pipeline (geocoding,
+fetching, code generation, execution, correction and the Assistant run).
+Stages ask how much time is left and skip optional work, lower their retries
+or return their best partial result; the first stage to give up records why.
+"""
+import time
+
+from cancellation import CancelToken
+
+DEFAULT_QUESTION_BUDGET_S = 120.0
+
+
+class Deadline:
+    """
+    Monotonic deadline for one question. budget_s=None means unbounded.
+    Cancelling it (cancel_token) makes it read as expired from then on.
+    """
+
+    def __init__(self, budget_s=DEFAULT_QUESTION_BUDGET_S, cancel_token=None):
+        self.budget_s = budget_s
+        self.cancel_token = cancel_token or CancelToken()
+        self.started = time.monotonic()
+        self.expires_at = None if budget_s is None else self.started + budget_s
+        self.stop_reason = None
+        self.stages = []
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def remaining(self):
+        if self.cancel_token.cancelled:
+            return 0.0
+        if self.expires_at is None:
+            return float('inf')
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    @property
+    def cancelled(self):
+        return self.cancel_token.cancelled
+
+    def cancel(self, reason):
+        """Gives up on the question: every stage sees the deadline as passed and cancellation callbacks run."""
+        if self.cancel_token.cancel(reason):
+            self.stop("cancelled", reason)
+
+    def allows(self, seconds):
+        """True if a step expected to take `seconds` still fits in the budget."""
+        return self.remaining() >= seconds
+
+    def timeout(self, cap, floor=1.0):
+        """Timeout for a blocking call: at most `cap`, never more than what is left (but >= floor)."""
+        return max(floor, min(cap, self.remaining()))
+
+    def mark(self, stage, note=None):
+        """Record that a stage finished (elapsed time since the question started)."""
+        self.stages.append({"stage": stage, "elapsed_s": round(self.elapsed(), 2), "note": note})
+
+    def stop(self, stage, reason):
+        """
+        Record why a stage cut its work short; the first reason wins. Once cancelled,
+        the cancellation's reason does: stages that notice it before cancel() gets to
+        record it only mark where they stopped.
+        """
+        self.mark(stage, reason)
+        if self.cancelled and stage != "cancelled":
+            return
+        if self.stop_reason is None:
+            self.stop_reason = f"{stage}: {reason}"
+            print(f"⏱️ {self.stop_reason} ({self.remaining():.1f}s left)")
+
+    def report(self):
+        """JSON-serialisable summary attached to results and stream events."""
+        return {
+            "budget_s": self.budget_s,
+            "elapsed_s": round(self.elapsed(), 2),
+            "stop_reason": self.stop_reason,
+            "stages": list(self.stages),
+        }
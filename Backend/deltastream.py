@@ -0,0 +1,80 @@
+"""
+Delta-encoded SSE content protocol.
+
+Instead of resending the whole answer on every token, the stream carries
+append-only frames:
+
+    {'type': 'delta', 'seq': n, 'offset': chars_before, 'delta': text}
+    {'type': 'snapshot', 'seq': n, 'content': full_text_so_far}
+
+Tokens arriving within FLUSH_INTERVAL_S of each other are coalesced into one
+delta frame. A client appends a delta only if its seq follows the last one it
+applied and its offset matches the text it holds; otherwise it waits for the
+next snapshot. Offsets count UTF-16 code units (text_length), which is what
+a JavaScript client's string length counts, so emoji do not throw it out of
+sync. Snapshots are sent whenever the text has doubled since the previous
+one, so their total size stays within twice the answer: bytes sent and
+encoding work are linear in answer length.
+"""
+import threading
+
+FLUSH_INTERVAL_S = 0.05
+FIRST_SNAPSHOT_CHARS = 1024
+
+
+def text_length(text):
+    """Length of text in UTF-16 code units (characters outside the BMP count twice)."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+class DeltaEncoder:
+    """Turns a stream of text chunks into delta/snapshot frames passed to put()."""
+
+    def __init__(self, put, flush_interval_s=FLUSH_INTERVAL_S, first_snapshot_chars=FIRST_SNAPSHOT_CHARS):
+        self.put = put
+        self.flush_interval_s = flush_interval_s
+        self.next_snapshot_chars = first_snapshot_chars
+        self.parts = []  # Chunks already sent
+        self.length = 0
+        self.pending = []  # Chunks waiting for the next flush
+        self.seq = 0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def append(self, text):
+        """Queues a chunk; it is sent at most flush_interval_s later, together with any that follow."""
+        if not text:
+            return
+        with self._lock:
+            self.pending.append(text)
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_interval_s, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Sends pending chunks now (call before any other event so frames stay in order)."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self.pending:
+                return
+            delta = "".join(self.pending)
+            self.pending = []
+            self.seq += 1
+            self.put({'type': 'delta', 'seq': self.seq, 'offset': self.length, 'delta': delta})
+            self.parts.append(delta)
+            self.length += text_length(delta)
+
+            if self.length >= self.next_snapshot_chars:
+                self.put({'type': 'snapshot', 'seq': self.seq, 'content': self.text()})
+                self.next_snapshot_chars = 2 * self.length
+
+    def text(self):
+        """Everything sent so far."""
+        return "".join(self.parts)
+
+    @property
+    def started(self):
+        return self.seq > 0 or bool(self.pending)
@@ -0,0 +1,102 @@
+"""
+Structured diagnostics recorded by the spatial helpers that MainAgent injects
+into generated code. The executor reads these directly instead of searching
+the captured stdout for magic phrases.
+"""
+
+# Largest radius the executor will widen to on its own before handing the
+# problem back to the LLM (matches filter_by_distance_with_fallback's cap).
+MAX_RECOVERY_RADIUS_KM = 20.0
+
+
+class SpatialDiagnostics:
+    """Per-execution record of what each spatial helper did to its input layer."""
+
+    def __init__(self):
+        self.stages = []
+        self.layer_names = {}
+
+    def reset(self, layer_names=None):
+        """Start a fresh record. layer_names maps id(dataset) -> variable name."""
+        self.stages = []
+        self.layer_names = dict(layer_names or {})
+
+    def layer_name(self, gdf):
+        return self.layer_names.get(id(gdf), "unnamed layer")
+
+    def record(self, stage, gdf, rows_in, rows_out, radii_km=None, center=None, crs=None, note=None):
+        """Record one helper call (row counts before/after, radii tried and CRS)."""
+        entry = {
+            "stage": stage,
+            "layer": self.layer_name(gdf),
+            "rows_in": int(rows_in),
+            "rows_out": int(rows_out),
+            "radii_km": list(radii_km or []),
+            "center": (round(center.x, 6), round(center.y, 6)) if center is not None else None,
+            "crs": str(crs) if crs is not None else None,
+            "note": note,
+        }
+        self.stages.append(entry)
+        return entry
+
+    def tally(self, stage, gdf, rows_in, matched, crs=None):
+        """
+        Aggregating variant of record() for helpers called once per row (e.g.
+        nearest-emission matching), so a loop over 2k buildings is one entry.
+        """
+        for entry in self.stages:
+            if entry["stage"] == stage and entry.get("layer_id") == id(gdf):
+                entry["calls"] += 1
+                entry["rows_out"] += int(matched)
+                return entry
+        entry = self.record(stage, gdf, rows_in, matched, crs=crs)
+        entry["layer_id"] = id(gdf)
+        entry["calls"] = 1
+        return entry
+
+    def starved_stages(self):
+        """Distance stages that had input rows but kept none of them."""
+        return [s for s in self.stages if s["radii_km"] and s["rows_in"] > 0 and s["rows_out"] == 0]
+
+    def recovery_radius_km(self, max_radius_km=MAX_RECOVERY_RADIUS_KM):
+        """
+        Radius to re-run the same code with when the only problem is a radius
+        that was too small. Returns None when local recovery cannot help.
+        """
+        starved = self.starved_stages()
+        if not starved:
+            return None
+        tried = max(max(s["radii_km"]) for s in starved)
+        if tried >= max_radius_km:
+            return None
+        return min(tried * 2, max_radius_km)
+
+    def failure_reasons(self):
+        """
+        Translates the recorded stages into the failure codes used by the
+        empty-results correction prompt. Returns [] if nothing was recorded.
+        """
+        if not self.stages:
+            return []
+
+        reasons = []
+        for s in self.stages:
+            if s["rows_in"] == 0:
+                code = "NO_MATCHING_DATA" if s["stage"] == "nearest_emission" else "EMPTY_INPUT"
+                reasons.append(f"{code}: '{s['layer']}' was empty when passed to {s['stage']}")
+            elif s["radii_km"] and s["rows_out"] == 0:
+                reasons.append(
+                    f"DISTANCE_ISSUE: '{s['layer']}' had {s['rows_in']} rows but none within "
+                    f"{s['radii_km']} km of {s['center']} (crs={s['crs']})"
+                )
+            if s["note"]:
+                reasons.append(f"NOTE: '{s['layer']}' {s['note']}")
+
+        if not reasons:
+            kept = ", ".join(f"{s['layer']} {s['rows_in']}->{s['rows_out']}" for s in self.stages)
+            reasons.append(f"LOGIC_ISSUE: every spatial stage returned rows ({kept}); rows were lost after filtering")
+        return reasons
+
+    def summary(self):
+        """Compact, JSON-serialisable view for execution results."""
+        return [{k: v for k, v in s.items() if k != "layer_id"} for s in self.stages]
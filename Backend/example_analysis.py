@@ -23,7 +23,7 @@ def analyze_data_properly():
     ]
     coordinates = {"El Poblenou": {"lat": 41.4005, "lon": 2.2017}}
     
-    datasets_info, _ = collector.fetch_data(datasets, coordinates)
+    datasets_info, _ = collector.fetch_data(datasets, coordinates, lazy=False)
     
     print("="*60)
     print("PROPER SPATIAL ANALYSIS EXAMPLE")
@@ -143,6 +143,7 @@ def analyze_data_properly():
         
         return {
             'nearest_pollution_level': nearest_pollution['Rang'], 
+            'pollution_numeric': nearest_pollution['rang_mid_ugm3'],  # Parsed from 'Rang' at ingestion
             'distance_to_pollution_km': nearest_distance,
             'pollution_id': nearest_pollution['TRAM']
         }
@@ -155,25 +156,11 @@ def analyze_data_properly():
     # Extract pollution info into separate columns
     combined_locations['pollution_level'] = [info['nearest_pollution_level'] for info in pollution_info]
     combined_locations['pollution_distance_km'] = [info['distance_to_pollution_km'] for info in pollution_info]
+    combined_locations['pollution_numeric'] = [info['pollution_numeric'] for info in pollution_info]
     
-    # 7. RANK BY POLLUTION LEVEL (parsing the Rang column)
+    # 7. RANK BY POLLUTION LEVEL (band midpoints are numeric columns since ingestion)
     print(f"\n🏆 Ranking by Pollution Level:")
     
-    def parse_pollution_level(rang_str):
-        """Parse pollution level from 'Rang' column (e.g., '20-25 µg/m³' -> 22.5)"""
-        try:
-            # Extract numbers from range like "20-25 µg/m³"
-            numbers = [float(x) for x in rang_str.split() if any(c.isdigit() for c in x)]
-            if len(numbers) >= 2:
-                return (numbers[0] + numbers[1]) / 2  # Average of range
-            elif len(numbers) == 1:
-                return numbers[0]
-            return 0
-        except:
-            return 0
-    
-    combined_locations['pollution_numeric'] = combined_locations['pollution_level'].apply(parse_pollution_level)
-    
     # Sort by highest pollution (descending)
     combined_locations = combined_locations.sort_values('pollution_numeric', ascending=False)
     
@@ -0,0 +1,284 @@
+"""
+Local fake of the OpenAI Assistants API, for exercising lapa.UrbanDataAssistant
+(streaming runs, the polling fallback, thread lifecycle) without an API key,
+network access or cost.
+
+    python fake_assistants.py --port 8765
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 python Mother2.py
+
+It implements just the endpoints lapa uses. Every run answers by echoing the
+question word by word. Streamed runs emit the same server-sent events as the
+real API (thread.run.*, thread.message.delta, done). Polled runs move from
+queued to in_progress to completed over FAKE_RUN_S seconds and send the
+openai-poll-after-ms header (unless poll_after_ms=None). With
+stream_error_status set, streamed run creation fails, which forces clients
+onto the polling fallback.
+"""
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_TOKEN_DELAY_S = 0.02  # Gap between streamed tokens
+FAKE_RUN_S = 1.0  # How long a polled run takes
+FAKE_POLL_AFTER_MS = 250
+
+
+def _id(prefix):
+    return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+
+class FakeAssistantsState:
+    """In-memory threads, messages, runs, assistants and files."""
+
+    def __init__(self, token_delay_s=FAKE_TOKEN_DELAY_S, run_s=FAKE_RUN_S, poll_after_ms=FAKE_POLL_AFTER_MS,
+                 stream_error_status=None):
+        self.token_delay_s = token_delay_s
+        self.run_s = run_s
+        self.poll_after_ms = poll_after_ms  # None: no openai-poll-after-ms hint, clients back off on their own
+        self.stream_error_status = stream_error_status  # e.g. 400: streamed run creation fails, forcing polling
+        self.threads = {}  # thread id -> [message, ...]
+        self.runs = {}  # run id -> run dict
+        self.assistants = {}
+        self.files = {}
+        self.requests = []  # (method, path) of every call, for inspecting API volume
+        self.request_times = []  # time.monotonic() of every call, parallel to requests
+        self.lock = threading.Lock()
+
+    def answer_for(self, thread_id):
+        questions = [m for m in self.threads.get(thread_id, []) if m["role"] == "user"]
+        question = questions[-1]["content"][0]["text"]["value"] if questions else ""
+        return f"You asked: {question}"
+
+    def message(self, thread_id, role, text, run_id=None, assistant_id=None):
+        return {
+            "id": _id("msg"), "object": "thread.message", "created_at": int(time.time()),
+            "thread_id": thread_id, "role": role, "status": "completed", "run_id": run_id,
+            "assistant_id": assistant_id, "attachments": [], "metadata": {},
+            "content": [{"type": "text", "text": {"value": text, "annotations": []}}],
+        }
+
+    def new_run(self, thread_id, body):
+        run = {
+            "id": _id("run"), "object": "thread.run", "created_at": int(time.time()),
+            "thread_id": thread_id, "assistant_id": body.get("assistant_id"), "status": "queued",
+            "model": "fake", "instructions": body.get("instructions") or "", "tools": [],
+            "metadata": {}, "parallel_tool_calls": True, "_started": time.monotonic(),
+        }
+        with self.lock:
+            self.runs[run["id"]] = run
+        return run
+
+    def advance(self, run):
+        """Moves a polled run along its timeline; completes it (posting the answer) after run_s."""
+        if run["status"] in ("cancelled", "completed", "failed", "expired"):
+            return run
+        age = time.monotonic() - run["_started"]
+        if run["status"] == "cancelling":
+            run["status"] = "cancelled"
+        elif age >= self.run_s:
+            self.finish(run, self.answer_for(run["thread_id"]))
+        elif age >= self.run_s / 3:
+            run["status"] = "in_progress"
+        return run
+
+    def finish(self, run, text):
+        with self.lock:
+            if run["status"] != "completed":
+                run["status"] = "completed"
+                self.threads[run["thread_id"]].append(
+                    self.message(run["thread_id"], "assistant", text, run["id"], run["assistant_id"])
+                )
+
+
+def _public(obj):
+    return {k: v for k, v in obj.items() if not k.startswith("_")}
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            if self.headers.get("Content-Type", "").startswith("application/json") and raw:
+                return json.loads(raw)
+            return {"_raw": raw}
+
+        def _json(self, payload, status=200, headers=None):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _not_found(self):
+            self._json({"error": {"message": f"No route for {self.command} {self.path}", "type": "invalid_request_error"}}, 404)
+
+        def _sse(self, event, data):
+            chunk = f"event: {event}\ndata: {json.dumps(data) if not isinstance(data, str) else data}\n\n".encode()
+            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            self.wfile.flush()
+
+        def _stream_run(self, run):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            self._sse("thread.run.created", _public(run))
+            run["status"] = "in_progress"
+            self._sse("thread.run.in_progress", _public(run))
+
+            answer = state.answer_for(run["thread_id"])
+            message = state.message(run["thread_id"], "assistant", "", run["id"], run["assistant_id"])
+            message.update(status="in_progress", content=[])
+            self._sse("thread.message.created", message)
+            for index, token in enumerate(re.findall(r"\S+\s*", answer)):
+                if run["status"] == "cancelling":
+                    break
+                time.sleep(state.token_delay_s)
+                delta = {"id": message["id"], "object": "thread.message.delta", "delta": {"content": [
+                    {"index": 0, "type": "text", "text": {"value": token, "annotations": []}}
+                ]}}
+                self._sse("thread.message.delta", delta)
+
+            if run["status"] == "cancelling":
+                run["status"] = "cancelled"
+                self._sse("thread.run.cancelled", _public(run))
+            else:
+                state.finish(run, answer)
+                message.update(status="completed", content=[{"type": "text", "text": {"value": answer, "annotations": []}}])
+                self._sse("thread.message.completed", message)
+                self._sse("thread.run.completed", _public(run))
+            self._sse("done", "[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+        def _route(self):
+            with state.lock:
+                state.requests.append((self.command, self.path.split("?")[0]))
+                state.request_times.append(time.monotonic())
+            path = self.path.split("?")[0].rstrip("/")
+            parts = path.split("/")[2:] if path.startswith("/v1/") else []
+            method = self.command
+
+            if parts == ["threads"] and method == "POST":
+                body = self._body()
+                thread_id = _id("thread")
+                initial = [state.message(thread_id, m.get("role", "user"), m.get("content", ""))
+                           for m in body.get("messages") or []]
+                with state.lock:
+                    state.threads[thread_id] = initial
+                return self._json({"id": thread_id, "object": "thread", "created_at": int(time.time()),
+                                   "metadata": {}, "tool_resources": None})
+            if len(parts) == 2 and parts[0] == "threads" and method == "DELETE":
+                with state.lock:
+                    existed = state.threads.pop(parts[1], None) is not None
+                return self._json({"id": parts[1], "object": "thread.deleted", "deleted": existed})
+
+            if len(parts) >= 3 and parts[0] == "threads" and parts[1] not in state.threads:
+                return self._not_found()
+            if len(parts) == 3 and parts[2] == "messages":
+                thread_id = parts[1]
+                if method == "POST":
+                    body = self._body()
+                    message = state.message(thread_id, body.get("role", "user"), body.get("content", ""))
+                    with state.lock:
+                        state.threads[thread_id].append(message)
+                    return self._json(message)
+                newest_first = list(reversed(state.threads[thread_id]))
+                return self._json({"object": "list", "data": newest_first, "has_more": False,
+                                   "first_id": newest_first[0]["id"] if newest_first else None,
+                                   "last_id": newest_first[-1]["id"] if newest_first else None})
+            if len(parts) == 3 and parts[2] == "runs" and method == "POST":
+                body = self._body()
+                if body.get("stream") and state.stream_error_status:
+                    return self._json({"error": {"message": "Streaming unavailable", "type": "invalid_request_error"}},
+                                      state.stream_error_status)
+                run = state.new_run(parts[1], body)
+                if body.get("stream"):
+                    return self._stream_run(run)
+                return self._json(_public(run))
+            if len(parts) == 4 and parts[2] == "runs" and parts[3] in state.runs:
+                run = state.advance(state.runs[parts[3]])
+                hint = {"openai-poll-after-ms": str(state.poll_after_ms)} if state.poll_after_ms else None
+                return self._json(_public(run), headers=hint)
+            if len(parts) == 5 and parts[2] == "runs" and parts[4] == "cancel" and parts[3] in state.runs:
+                self._body()
+                run = state.runs[parts[3]]
+                if run["status"] in ("queued", "in_progress"):
+                    run["status"] = "cancelling"
+                return self._json(_public(run))
+
+            if parts == ["assistants"] and method == "POST":
+                body = self._body()
+                assistant = {"id": _id("asst"), "object": "assistant", "created_at": int(time.time()),
+                             "name": body.get("name"), "model": body.get("model", "fake"), "tools": body.get("tools", []),
+                             "tool_resources": body.get("tool_resources"), "metadata": body.get("metadata") or {},
+                             "instructions": body.get("instructions"), "description": body.get("description")}
+                state.assistants[assistant["id"]] = assistant
+                return self._json(assistant)
+            if len(parts) == 2 and parts[0] == "assistants":
+                if parts[1] not in state.assistants:
+                    return self._not_found()
+                if method == "POST":
+                    state.assistants[parts[1]].update(self._body())
+                return self._json(state.assistants[parts[1]])
+
+            if parts == ["files"] and method == "POST":
+                raw = self._body().get("_raw", b"")
+                filename = re.search(rb'filename="([^"]*)"', raw)
+                file = {"id": _id("file"), "object": "file", "bytes": len(raw), "created_at": int(time.time()),
+                        "filename": filename.group(1).decode() if filename else "upload", "purpose": "assistants",
+                        "status": "processed"}
+                state.files[file["id"]] = file
+                return self._json(file)
+            if len(parts) == 2 and parts[0] == "files":
+                if parts[1] not in state.files:
+                    return self._not_found()
+                if method == "DELETE":
+                    state.files.pop(parts[1])
+                    return self._json({"id": parts[1], "object": "file", "deleted": True})
+                return self._json(state.files[parts[1]])
+            return self._not_found()
+
+        do_GET = do_POST = do_DELETE = _route
+
+    return Handler
+
+
+def start_fake_server(port=0, **state_options):
+    """Starts the fake API on a background thread; returns (server, state, base_url)."""
+    state = FakeAssistantsState(**state_options)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI Assistants API for local development")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--token-delay", type=float, default=FAKE_TOKEN_DELAY_S)
+    parser.add_argument("--run-seconds", type=float, default=FAKE_RUN_S)
+    args = parser.parse_args()
+
+    server, state, base_url = start_fake_server(args.port, token_delay_s=args.token_delay, run_s=args.run_seconds)
+    print(f"🧪 Fake Assistants API listening on {base_url}")
+    print(f"   OPENAI_BASE_URL={base_url} OPENAI_API_KEY=fake python Mother2.py")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
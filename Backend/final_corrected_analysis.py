@@ -18,7 +18,7 @@ coordinates = {
 }
 
 print("📊 Fetching datasets for final corrected analysis...")
-datasets_info, _ = collector.fetch_data(datasets, coordinates)
+datasets_info, _ = collector.fetch_data(datasets, coordinates, lazy=False)
 
 # Make datasets available as variables
 residential_building_locations = datasets_info['Residential Building Locations']
@@ -0,0 +1,71 @@
+"""
+Offline gazetteer of Barcelona neighbourhoods and districts.
+
+Every stop in ESTACIONS_BUS.csv and PublicTransport.csv carries its NOM_BARRI
+and NOM_DISTRICTE. The median position of the stops in each area is a good
+stand-in for its centre. Place names that match an area are answered from this
+table, so the most common locations in questions need no Nominatim round trip.
+"""
+import os
+import re
+import threading
+import unicodedata
+
+import pandas as pd
+
+from config import get_data_dir
+
+GAZETTEER_SOURCES = ["ESTACIONS_BUS.csv", "PublicTransport.csv"]
+AREA_COLUMNS = {"NOM_BARRI": "barri", "NOM_DISTRICTE": "districte"}
+ARTICLES = re.compile(r"^(el|la|les|els|l'|the)\s*")
+
+
+def normalize_place(name):
+    """Lowercase, accents stripped, leading article and 'barcelona' suffix removed: "el Clot" -> "clot"."""
+    text = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode().lower()
+    text = re.sub(r"[,\s]+barcelona$", "", text.strip())
+    text = ARTICLES.sub("", text)
+    return re.sub(r"[\s\-]+", " ", text).strip()
+
+
+def build_gazetteer(data_dir):
+    """{normalized name: {'name', 'lat', 'lon', 'kind', 'stops'}} from the stop layers in data_dir."""
+    frames = []
+    for source in GAZETTEER_SOURCES:
+        path = os.path.join(data_dir, source)
+        if os.path.exists(path):
+            columns = ["LONGITUD", "LATITUD", *AREA_COLUMNS]
+            frames.append(pd.read_csv(path, usecols=lambda c: c in columns))
+    if not frames:
+        return {}
+    stops = pd.concat(frames, ignore_index=True).dropna(subset=["LONGITUD", "LATITUD"])
+
+    entries = {}
+    for column, kind in AREA_COLUMNS.items():
+        if column not in stops.columns:
+            continue
+        centres = stops.groupby(column).agg(lon=("LONGITUD", "median"), lat=("LATITUD", "median"), stops=("LATITUD", "size"))
+        for name, row in centres.iterrows():
+            # Neighbourhoods win over districts with the same name (e.g. Sant Andreu)
+            entries.setdefault(normalize_place(name), {
+                "name": name, "lat": float(row["lat"]), "lon": float(row["lon"]), "kind": kind, "stops": int(row["stops"]),
+            })
+    return entries
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer(data_dir=None):
+    """The gazetteer, built once per process."""
+    global _gazetteer
+    with _gazetteer_lock:
+        if _gazetteer is None:
+            _gazetteer = build_gazetteer(str(data_dir or get_data_dir()))
+        return _gazetteer
+
+
+def lookup_place(name):
+    """Gazetteer entry for a place name, or None if it is not a known neighbourhood/district."""
+    return get_gazetteer().get(normalize_place(name))
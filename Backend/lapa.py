@@ -1,73 +1,279 @@
-from openai import OpenAI
+from openai import OpenAI, NotFoundError
 from typing_extensions import override
 from openai import AssistantEventHandler
+import hashlib
+import json
 import os
+import threading
 import time
-from config import get_openai_api_key
+from collections import OrderedDict
+from contextlib import contextmanager
+from config import get_openai_api_key, get_data_dir
+from deadline import Deadline
+from assistant_manifest import UploadManifest, sync_files
+
+RUN_POLL_CAP_S = 60  # Longest we wait for a run when the caller has no deadline
+RUN_POLL_INITIAL_S = 0.2  # Polling fallback: first interval, growth while nothing changes, ceiling
+RUN_POLL_BACKOFF = 1.5
+RUN_POLL_MAX_S = 2.0
+RUN_ACTIVE_STATUSES = ('queued', 'in_progress', 'cancelling')
+MESSAGE_SEPARATOR = "\n\n"
+MAX_SESSION_THREADS = 256  # Least recently used session threads beyond this are dropped
+SESSION_THREAD_TTL_S = 30 * 60  # Session threads idle for longer than this are dropped
+SESSION_SWEEP_INTERVAL_S = 60  # How often idle session threads are looked for while no question arrives
+DEFAULT_MAX_CONCURRENT_RUNS = 8  # Overridden by CITYTALK_MAX_CONCURRENT_RUNS
+DEFAULT_SESSION_KEY = "default"
+ASSISTANT_CONFIG = {
+    "name": "Urban Data Analyst",
+    "description": "You're an urban data analyst specialized in Barcelona city data. Analyze user queries based on the CSV files you have access to, write code to calculate and find answers, break down analysis in clear steps, execute the code, and explain results with detailed insights and recommendations.",
+    "model": "gpt-4.1",
+    "tools": [{"type": "code_interpreter"}],
+}
+
+
+class StreamEventHandler(AssistantEventHandler):
+    """
+    Forwards Assistants run events to on_event(dict) the moment they arrive:
+    {'type': 'text', 'delta': ...} for answer tokens and {'type': 'tool', 'tool': ...,
+    'stage': 'created' | 'code' | 'output' | 'done'} for tool calls and code-interpreter
+    progress ('code' carries the source being written, 'output' its logs).
+    """
+
+    def __init__(self, on_event):
+        super().__init__()
+        self.emit = on_event  # Not self.on_event: that is the base class hook for raw events
+        self.messages = []  # Final text of every completed assistant message
+
+    @override
+    def on_message_created(self, message) -> None:
+        if self.messages:  # A run can answer in several messages (e.g. around a tool call)
+            self.emit({'type': 'text', 'delta': MESSAGE_SEPARATOR})
+
+    @override
+    def on_text_delta(self, delta, snapshot) -> None:
+        if delta.value:
+            self.emit({'type': 'text', 'delta': delta.value})
+
+    @override
+    def on_tool_call_created(self, tool_call) -> None:
+        self.emit({'type': 'tool', 'tool': tool_call.type, 'stage': 'created'})
+
+    @override
+    def on_tool_call_delta(self, delta, snapshot) -> None:
+        if delta.type != 'code_interpreter' or not delta.code_interpreter:
+            return
+        if delta.code_interpreter.input:
+            self.emit({'type': 'tool', 'tool': delta.type, 'stage': 'code', 'code': delta.code_interpreter.input})
+        for output in delta.code_interpreter.outputs or []:
+            if output.type == 'logs':
+                self.emit({'type': 'tool', 'tool': delta.type, 'stage': 'output', 'logs': output.logs})
+
+    @override
+    def on_tool_call_done(self, tool_call) -> None:
+        self.emit({'type': 'tool', 'tool': tool_call.type, 'stage': 'done'})
+
+    @override
+    def on_message_done(self, message) -> None:
+        self.messages.append("".join(c.text.value for c in message.content if c.type == 'text'))
+
+    def response_text(self):
+        """Every message of the run, exactly as the deltas spelled it out"""
+        return MESSAGE_SEPARATOR.join(self.messages)
+
+
+def print_event(event):
+    """Default on_event: echoes the stream to the console"""
+    if event['type'] == 'text':
+        print(event['delta'], end="", flush=True)
+    elif event['type'] == 'tool' and event['stage'] in ('created', 'done'):
+        print(f"\n🔧 {event['tool']} {event['stage']}\n", flush=True)
+
+
+class SessionThread:
+    """One client session's Assistant thread; lock serializes runs, since a thread runs one at a time."""
+
+    def __init__(self):
+        self.thread_id = None  # Created on the session's first run
+        self.lock = threading.Lock()
+        self.users = 0  # Runs holding or waiting for the lock; the entry is never evicted while > 0
+        self.last_used = time.monotonic()
+        self.pending_history = False  # A shared answer is about to be recorded on this session's thread
+        self.history = []  # Shared exchanges not yet on the thread, posted when the session next runs
+
+
+class SessionThreads:
+    """
+    Assistant threads keyed by client session, created lazily so every session keeps
+    its own conversation and runs of different sessions proceed concurrently.
+    Threads idle for more than ttl_s, or least recently used beyond max_threads,
+    are dropped from the pool and deleted on the API: when a run starts or ends,
+    and every sweep_interval_s on a background thread, so they are released even
+    once questions stop arriving.
+    """
+
+    def __init__(self, client, max_threads=MAX_SESSION_THREADS, ttl_s=SESSION_THREAD_TTL_S,
+                 sweep_interval_s=SESSION_SWEEP_INTERVAL_S):
+        self.client = client
+        self.max_threads = max_threads
+        self.ttl_s = ttl_s
+        self.sweep_interval_s = sweep_interval_s
+        self._sessions = OrderedDict()  # session key -> SessionThread, least recently used first
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self._closed = threading.Event()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _evict(self, now):
+        """Pops expired / surplus idle sessions (caller holds self._lock) and returns them."""
+        evicted = []
+        for key, session in list(self._sessions.items()):
+            surplus = len(self._sessions) > self.max_threads
+            if not surplus and now - session.last_used <= self.ttl_s:
+                break  # Ordered by last use, so the rest are fresher
+            if session.users == 0:
+                evicted.append(self._sessions.pop(key))
+        return evicted
+
+    def sweep(self):
+        """Drops the idle sessions due for eviction now; returns how many were dropped."""
+        with self._lock:
+            evicted = self._evict(time.monotonic())
+        self._delete(evicted)
+        return len(evicted)
+
+    def _start_sweeper(self):
+        """Starts the background sweep on first use (there is nothing to sweep before)."""
+        with self._lock:
+            if self._sweeper is not None or self.sweep_interval_s is None:
+                return
+            self._sweeper = threading.Thread(target=self._sweep_periodically, name="session-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def _sweep_periodically(self):
+        while not self._closed.wait(self.sweep_interval_s):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"⚠️ Session thread sweep failed: {e}")
+
+    def close(self):
+        """Stops the background sweep."""
+        self._closed.set()
+
+    def _delete(self, sessions):
+        for session in sessions:
+            if session.thread_id is None:
+                continue
+            try:
+                self.client.beta.threads.delete(session.thread_id)
+            except Exception as e:
+                print(f"⚠️ Could not delete thread {session.thread_id}: {e}")
+
+    def has_conversation(self, session_key):
+        """True if the session has a thread, or is getting one (its next answer depends on that history)"""
+        session = self._sessions.get(session_key)
+        return session is not None and (session.thread_id is not None or session.pending_history or bool(session.history))
+
+    def expect_history(self, session_key):
+        """Marks the session as having a conversation before its thread exists (see add_exchange)."""
+        with self._lock:
+            session = self._sessions.pop(session_key, None) or SessionThread()
+            self._sessions[session_key] = session
+            session.pending_history = True
+
+    def drop_pending(self, session_key):
+        session = self._sessions.get(session_key)
+        if session is not None:
+            session.pending_history = False
+
+    def add_history(self, session_key, messages):
+        """Queues messages ({'role', 'content'}) for the session's thread; no API call until it next runs."""
+        with self._lock:
+            session = self._sessions.pop(session_key, None) or SessionThread()
+            self._sessions[session_key] = session
+            session.history.extend(messages)
+            session.pending_history = False
+
+    @contextmanager
+    def acquire(self, session_key, timeout=None):
+        """Yields the session's thread id while holding its lock (one run at a time per session)."""
+        self._start_sweeper()
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.pop(session_key, None) or SessionThread()
+            self._sessions[session_key] = session  # Most recently used last
+            session.users += 1
+            evicted = self._evict(now)
+        self._delete(evicted)
+
+        try:
+            if not session.lock.acquire(timeout=-1 if timeout is None else timeout):
+                raise TimeoutError(f"session {session_key} is still busy with its previous question after {timeout:.0f}s")
+            try:
+                if session.thread_id is None:
+                    # Queued history goes in with the thread: no extra round trips
+                    session.thread_id = self.client.beta.threads.create(messages=session.history).id
+                    session.history = []
+                    print(f"✅ Thread created for session {session_key}: {session.thread_id}")
+                while session.history:
+                    self.client.beta.threads.messages.create(thread_id=session.thread_id, **session.history[0])
+                    session.history.pop(0)
+                yield session.thread_id
+            finally:
+                session.last_used = time.monotonic()
+                session.lock.release()
+        finally:
+            with self._lock:
+                session.users -= 1
+                # Sessions that were busy when the run started can go now
+                evicted = self._evict(time.monotonic())
+            self._delete(evicted)
+
 
 class UrbanDataAssistant:
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, max_concurrent_runs=None):
         if api_key is None:
             api_key = get_openai_api_key()
         self.api_key = api_key
         self.client = OpenAI(api_key=api_key)
         self.assistant = None
-        self.thread = None
+        self.threads = SessionThreads(self.client)
+        if max_concurrent_runs is None:
+            max_concurrent_runs = int(os.environ.get('CITYTALK_MAX_CONCURRENT_RUNS', DEFAULT_MAX_CONCURRENT_RUNS))
+        self.max_concurrent_runs = max_concurrent_runs
+        self.run_slots = threading.BoundedSemaphore(max_concurrent_runs)
         self.file_ids = []
+        self.data_version = None  # Changes whenever the uploaded files or the assistant config do
         
     def setup_assistant(self):
-        """Setup OpenAI assistant with CSV files from Data directory"""
+        """
+        Setup OpenAI assistant with CSV files from Data directory.
+        Uploads and the assistant are recorded in an UploadManifest, so a restart
+        with unchanged data re-uploads nothing and reuses the same assistant.
+        """
         try:
-            # Get list of CSV files from Data directory
-            data_dir = os.path.join("..", "Data")  # Go up one directory to find Data
-            
-            if not os.path.exists(data_dir):
-                data_dir = "Data"  # Try current directory as fallback
-            
+            data_dir = str(get_data_dir())
             if not os.path.exists(data_dir):
                 print(f"⚠️ Warning: Data directory not found at {data_dir}")
                 return False
             
-            # Loop through all files in the Data directory
-            csv_files_found = []
-            for filename in os.listdir(data_dir):
-                if filename.endswith(".csv"):
-                    file_path = os.path.join(data_dir, filename)
-                    try:
-                        # Create file in OpenAI and store ID
-                        file = self.client.files.create(
-                            file=open(file_path, "rb"),
-                            purpose='assistants'
-                        )
-                        self.file_ids.append(file.id)
-                        csv_files_found.append(filename)
-                        print(f"✅ Uploaded: {filename}")
-                    except Exception as e:
-                        print(f"⚠️ Failed to upload {filename}: {e}")
+            manifest = UploadManifest.for_client(self.client)
+            uploaded = sync_files(self.client, data_dir, manifest)
+            self.file_ids = sorted(uploaded.values())
             
             if not self.file_ids:
                 print("❌ No CSV files were successfully uploaded")
+                manifest.save()
                 return False
             
-            # Create assistant
-            self.assistant = self.client.beta.assistants.create(
-                name="Urban Data Analyst",
-                description="You're an urban data analyst specialized in Barcelona city data. Analyze user queries based on the CSV files you have access to, write code to calculate and find answers, break down analysis in clear steps, execute the code, and explain results with detailed insights and recommendations.",
-                model="gpt-4.1",
-                tools=[{"type": "code_interpreter"}],
-                tool_resources={
-                    "code_interpreter": {
-                        "file_ids": self.file_ids
-                    }
-                }
-            )
-            
-            # Create thread
-            self.thread = self.client.beta.threads.create()
+            self.assistant = self._reuse_or_create_assistant(manifest)
+            manifest.save()
             
-            print(f"✅ Assistant created: {self.assistant.id}")
-            print(f"✅ Thread created: {self.thread.id}")
-            print(f"✅ Files uploaded: {len(csv_files_found)} CSV files")
+            # Threads are created per client session on first use (see SessionThreads)
+            print(f"✅ Assistant ready: {self.assistant.id}")
+            print(f"✅ Files available: {len(self.file_ids)} CSV files")
             
             return True
             
@@ -75,71 +281,186 @@ class UrbanDataAssistant:
             print(f"❌ Error setting up assistant: {e}")
             return False
     
-    def process_query_simple(self, user_query):
-        """Process query and return simple response (non-streaming)"""
+    def _reuse_or_create_assistant(self, manifest):
+        """The manifest's assistant if it still exists (updated if the files changed), else a new one"""
+        config = dict(ASSISTANT_CONFIG, tool_resources={"code_interpreter": {"file_ids": self.file_ids}})
+        config_key = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+        recorded = manifest.assistant
+        
+        assistant = None
+        if recorded.get("id"):
+            try:
+                assistant = self.client.beta.assistants.retrieve(recorded["id"])
+            except NotFoundError:
+                print("⚠️ Recorded assistant no longer exists, creating a new one")
+        
+        if assistant is None:
+            assistant = self.client.beta.assistants.create(**config)
+            print(f"✅ Assistant created: {assistant.id}")
+        elif recorded.get("config") != config_key:
+            assistant = self.client.beta.assistants.update(assistant.id, **config)
+            print(f"✅ Assistant updated: {assistant.id}")
+        else:
+            print(f"♻️ Reusing assistant: {assistant.id}")
+        
+        manifest.assistant = {"id": assistant.id, "config": config_key}
+        self.data_version = config_key[:12]
+        return assistant
+    
+    @contextmanager
+    def _session_run(self, session_key, deadline):
+        """
+        Holds the session's thread and one of the max_concurrent_runs run slots for a run.
+        Waits no longer than the question deadline allows for either.
+        """
+        timeout = deadline.timeout(RUN_POLL_CAP_S)
+        # Session first: a client queueing questions must not sit on a slot another session could use
+        with self.threads.acquire(session_key or DEFAULT_SESSION_KEY, timeout) as thread_id:
+            slot_timeout = deadline.timeout(RUN_POLL_CAP_S)  # What is left after waiting for the session
+            if not self.run_slots.acquire(timeout=slot_timeout):
+                deadline.stop("assistant_run", f"all {self.max_concurrent_runs} run slots busy for {slot_timeout:.0f}s")
+                raise TimeoutError(f"all {self.max_concurrent_runs} assistant runs are busy, please retry")
+            try:
+                yield thread_id
+            finally:
+                self.run_slots.release()
+    
+    def _stream_run(self, thread_id, handler, instructions, deadline):
+        """
+        Starts a run on the thread and consumes its event stream until the run ends
+        (or the deadline passes). Completion arrives as an event, with no polling.
+        Cancelling the deadline closes the stream at once; a run left unfinished is
+        cancelled on the API so it stops using capacity. Returns the last run state
+        the stream reported.
+        """
+        with self.client.beta.threads.runs.stream(
+            thread_id=thread_id,
+            assistant_id=self.assistant.id,
+            instructions=instructions,
+            event_handler=handler,
+        ) as stream:
+            # Unblocks the read below even while the run is silent (e.g. a long code-interpreter step)
+            unregister = deadline.cancel_token.on_cancel(lambda reason: stream.close())
+            try:
+                for _ in stream:
+                    if deadline.expired():
+                        deadline.stop("assistant_run", "run still streaming when the question deadline was reached")
+                        break
+            except Exception:
+                if not deadline.cancelled:
+                    raise
+            finally:
+                unregister()
+        
+        run = handler.current_run
+        if run is not None and run.status in RUN_ACTIVE_STATUSES and deadline.expired():
+            self._cancel_run(thread_id, run, deadline)
+        return run
+    
+    def _cancel_run(self, thread_id, run, deadline):
+        """Cancels a run nobody will read (best effort: it may have finished meanwhile)"""
+        try:
+            self.client.beta.threads.runs.cancel(run_id=run.id, thread_id=thread_id)
+            print(f"🛑 Cancelled run {run.id}: {deadline.cancel_token.reason or deadline.stop_reason}")
+        except Exception as e:
+            print(f"⚠️ Could not cancel run {run.id}: {e}")
+    
+    def _poll_run(self, thread_id, run, deadline):
+        """
+        Fallback when the event stream is unavailable: polls the run with an adaptive
+        interval. Polling starts fast and backs off while the status is unchanged.
+        It resets when the status moves and follows the API's openai-poll-after-ms hint.
+        """
+        interval = RUN_POLL_INITIAL_S
+        limit = min(RUN_POLL_CAP_S, deadline.remaining())
+        give_up = time.monotonic() + limit
+        polls = 0
+        while run.status in RUN_ACTIVE_STATUSES and time.monotonic() < give_up and not deadline.cancelled:
+            time.sleep(max(0.0, min(interval, give_up - time.monotonic())))
+            response = self.client.beta.threads.runs.with_raw_response.retrieve(thread_id=thread_id, run_id=run.id)
+            previous, run = run.status, response.parse()
+            polls += 1
+            
+            hint = response.headers.get('openai-poll-after-ms')
+            if hint:
+                interval = float(hint) / 1000
+            elif run.status != previous:
+                interval = RUN_POLL_INITIAL_S  # Progress: the next change is likely close
+            else:
+                interval *= RUN_POLL_BACKOFF
+            interval = min(max(interval, RUN_POLL_INITIAL_S), RUN_POLL_MAX_S)
+        
+        if run.status in RUN_ACTIVE_STATUSES:
+            deadline.stop("assistant_run", f"run still {run.status} after {limit:.0f}s ({polls} polls)")
+            self._cancel_run(thread_id, run, deadline)
+        return run
+    
+    def process_query_simple(self, user_query, deadline=None, session_key=None):
+        """
+        Process query and return simple response (non-streaming).
+        The run's completion is taken from its event stream; if streaming fails,
+        the run is polled with adaptive backoff (see _poll_run).
+        With a Deadline, the wait for the run is capped by the time left for the question.
+        session_key selects the conversation thread (one per client session).
+        """
+        deadline = deadline or Deadline(None)
+        instructions = "Provide detailed analysis with step-by-step breakdown. Write and execute code when needed for data analysis. Explain methodology, show results clearly, and provide actionable insights."
         try:
-            if not self.assistant or not self.thread:
+            if not self.assistant:
                 return {
                     'success': False,
                     'error': 'Assistant not properly initialized. Please check your API key.'
                 }
             
-            # Create message in thread
-            message = self.client.beta.threads.messages.create(
-                thread_id=self.thread.id,
-                role="assistant",
-                content=user_query
-            )
-            
-            # Create and run the assistant
-            run = self.client.beta.threads.runs.create(
-                thread_id=self.thread.id,
-                assistant_id=self.assistant.id,
-                instructions="Provide detailed analysis with step-by-step breakdown. Write and execute code when needed for data analysis. Explain methodology, show results clearly, and provide actionable insights."
-            )
-            
-            # Wait for completion
-            max_attempts = 60  # 60 seconds timeout
-            attempts = 0
-            while run.status in ['queued', 'in_progress', 'cancelling'] and attempts < max_attempts:
-                time.sleep(1)
-                attempts += 1
-                run = self.client.beta.threads.runs.retrieve(
-                    thread_id=self.thread.id,
-                    run_id=run.id
+            with self._session_run(session_key, deadline) as thread_id:
+                # Create message in thread
+                message = self.client.beta.threads.messages.create(
+                    thread_id=thread_id,
+                    role="user",
+                    content=user_query
                 )
                 
-                if attempts % 10 == 0:  # Progress indicator every 10 seconds
-                    print(f"⏳ Processing... ({attempts}s)")
-            
-            if run.status == 'completed':
-                # Retrieve messages
-                messages = self.client.beta.threads.messages.list(
-                    thread_id=self.thread.id
-                )
+                # Event-driven completion; fall back to polling whatever run the stream started
+                handler = StreamEventHandler(lambda event: None)
+                run = None
+                try:
+                    run = self._stream_run(thread_id, handler, instructions, deadline)
+                except Exception as e:
+                    print(f"⚠️ Run event stream failed ({e}), polling instead")
+                    run = handler.current_run
                 
-                # Get the latest assistant message
-                latest_message = messages.data[0] if messages.data else None
-                if latest_message and latest_message.role == 'assistant':
-                    response_text = ""
-                    for content in latest_message.content:
-                        if content.type == 'text':
-                            response_text += content.text.value
-                    
+                if run is None and deadline.expired():
+                    return {
+                        'success': False,
+                        'error': 'Analysis cancelled' if deadline.cancelled else 'Analysis timed out',
+                        'stop_reason': deadline.stop_reason
+                    }
+                if run is None:
+                    run = self.client.beta.threads.runs.create(
+                        thread_id=thread_id,
+                        assistant_id=self.assistant.id,
+                        instructions=instructions
+                    )
+                streamed = run.status == 'completed' and handler.messages
+                if run.status in RUN_ACTIVE_STATUSES and not deadline.expired():
+                    run = self._poll_run(thread_id, run, deadline)
+                
+                if run.status == 'completed':
+                    response_text = handler.response_text() if streamed else self._latest_response(thread_id)
                     return {
                         'success': True,
                         'response': response_text,
                         'run_id': run.id,
                         'status': run.status
                     }
-            else:
-                error_msg = f'Analysis failed with status: {run.status}'
-                if attempts >= max_attempts:
-                    error_msg += ' (timeout after 60 seconds)'
                 
+                error_msg = f'Analysis failed with status: {run.status}'
+                if run.status in RUN_ACTIVE_STATUSES:
+                    error_msg += ' (timed out)'
                 return {
                     'success': False,
-                    'error': error_msg
+                    'error': error_msg,
+                    'stop_reason': deadline.stop_reason
                 }
                 
         except Exception as e:
@@ -148,67 +469,88 @@ class UrbanDataAssistant:
                 'error': f'Processing error: {str(e)}'
             }
     
-    def process_query_streaming(self, user_query):
-        """Process query with streaming response"""
+    def _latest_response(self, thread_id):
+        """Text of the latest assistant message on the thread"""
+        messages = self.client.beta.threads.messages.list(thread_id=thread_id, limit=1)
+        latest_message = messages.data[0] if messages.data else None
+        if not latest_message or latest_message.role != 'assistant':
+            return ""
+        return "".join(content.text.value for content in latest_message.content if content.type == 'text')
+    
+    def process_query_streaming(self, user_query, on_event=None, deadline=None, session_key=None):
+        """
+        Process query with streaming response.
+
+        Run events are forwarded to on_event as they arrive (see StreamEventHandler);
+        without a callback they are printed. Returns the same dict as process_query_simple.
+        With a Deadline, the stream is abandoned once the time for the question is up.
+        session_key selects the conversation thread (one per client session).
+        """
+        deadline = deadline or Deadline(None)
+        on_event = on_event or print_event
         try:
-            if not self.assistant or not self.thread:
-                print("❌ Assistant not initialized")
-                return
+            if not self.assistant:
+                return {
+                    'success': False,
+                    'error': 'Assistant not properly initialized. Please check your API key.'
+                }
             
-            # Create message in thread
-            message = self.client.beta.threads.messages.create(
-                thread_id=self.thread.id, 
-                role="user",
-                content=user_query
-            )
+            with self._session_run(session_key, deadline) as thread_id:
+                # Create message in thread
+                message = self.client.beta.threads.messages.create(
+                    thread_id=thread_id, 
+                    role="user",
+                    content=user_query
+                )
             
-            class EventHandler(AssistantEventHandler):
-                @override
-                def on_text_created(self, text) -> None:
-                    print(f"\n🤖 Assistant > ", end="", flush=True)
-
-                @override
-                def on_tool_call_created(self, tool_call):
-                    print(f"\n🔧 {tool_call.type}\n", flush=True)
-
-                @override
-                def on_message_done(self, message) -> None:
-                    # Print citations to files
-                    message_content = message.content[0].text
-                    annotations = message_content.annotations
-                    citations = []
-                    for index, annotation in enumerate(annotations):
-                        message_content.value = message_content.value.replace(
-                            annotation.text, f"[{index}]"
-                        )
-                        if file_citation := getattr(annotation, "file_citation", None):
-                            cited_file = self.client.files.retrieve(file_citation.file_id)
-                            citations.append(f"[{index}] {cited_file.filename}")
-
-                    print(message_content.value)
-                    if citations:
-                        print("\n📚 Sources:")
-                        print("\n".join(citations))
-
-            # Stream the response
-            with self.client.beta.threads.runs.stream(
-                thread_id=self.thread.id,
-                assistant_id=self.assistant.id,
-                instructions="Provide comprehensive urban data analysis with step-by-step code execution and clear explanations.",
-                event_handler=EventHandler(),
-            ) as stream:
-                stream.until_done()
+                # Stream the response; iterating dispatches every event to the handler
+                handler = StreamEventHandler(on_event)
+                run = self._stream_run(
+                    thread_id, handler,
+                    "Provide comprehensive urban data analysis with step-by-step code execution and clear explanations.",
+                    deadline
+                )
+            
+                status = run.status if run else 'unknown'
+                if status == 'completed':
+                    return {
+                        'success': True,
+                        'response': handler.response_text(),
+                        'run_id': run.id,
+                        'status': status
+                    }
+                return {
+                    'success': False,
+                    'error': f'Analysis failed with status: {status}',
+                    'stop_reason': deadline.stop_reason
+                }
                 
         except Exception as e:
-            print(f"❌ Streaming error: {e}")
+            return {
+                'success': False,
+                'error': f'Streaming error: {str(e)}'
+            }
+    
+    def add_exchange(self, session_key, question, answer):
+        """
+        Records a question and its answer for the session's thread without a run.
+        Used for answers the session received from a run on another session's thread
+        (single-flight), so its follow-up questions keep their context. Nothing is
+        sent now: the exchange goes in with the session's next thread or run.
+        """
+        self.threads.add_history(session_key, [
+            {"role": "user", "content": question},
+            {"role": "assistant", "content": answer},
+        ])
     
     def get_assistant_info(self):
         """Get information about the assistant"""
         return {
             'assistant_id': self.assistant.id if self.assistant else None,
-            'thread_id': self.thread.id if self.thread else None,
+            'session_threads': len(self.threads),
+            'max_concurrent_runs': self.max_concurrent_runs,
             'files_uploaded': len(self.file_ids),
-            'ready': bool(self.assistant and self.thread)
+            'ready': bool(self.assistant)
         }
 
 # Demo function - only runs when file is executed directly
@@ -0,0 +1,89 @@
+"""
+Lazy dataset handles. DataCollectorAgent.fetch_data returns these instead of
+loaded frames (unless called with lazy=False); MainAgent resolves only the ones
+the generated script actually references, so unused OSM layers are never
+downloaded, projected or described.
+"""
+import ast
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from capture import echo
+
+
+class LazyDataset:
+    """Handle for a dataset that is loaded the first time something needs its rows."""
+
+    def __init__(self, name, loader, source="other", columns_hint=None):
+        """
+        Args:
+            name (str): Dataset name (as used in enriched_datasets)
+            loader (callable): Returns the loaded DataFrame/GeoDataFrame
+            source (str): "osm" or "other"
+            columns_hint (list | callable, optional): Cheap way to know the columns without loading
+        """
+        self.name = name
+        self.source = source
+        self._loader = loader
+        self._columns_hint = columns_hint
+        self._data = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return self._data is not None
+
+    def resolve(self):
+        """Loads the dataset once (thread-safe) and returns it."""
+        with self._lock:
+            if self._data is None:
+                echo(f"📥 Loading dataset on first use: {self.name}")
+                self._data = self._loader()
+        return self._data
+
+    def peek_columns(self):
+        """Column names if they are known without loading the rows, else None."""
+        if self._data is not None:
+            return list(self._data.columns)
+        if callable(self._columns_hint):
+            try:
+                self._columns_hint = list(self._columns_hint())
+            except Exception:
+                self._columns_hint = None
+        return self._columns_hint
+
+    def __repr__(self):
+        state = "loaded" if self.is_loaded else "not loaded"
+        return f"LazyDataset({self.name!r}, source={self.source!r}, {state})"
+
+
+def materialize(dataset):
+    """Returns the loaded data for a LazyDataset, or the dataset itself."""
+    return dataset.resolve() if isinstance(dataset, LazyDataset) else dataset
+
+
+def referenced_names(code, candidates):
+    """
+    Names from candidates that the code reads. Uses an AST scan; if the code does
+    not parse (it may still be corrected later), falls back to whole-word matching.
+    """
+    candidates = set(candidates)
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return {name for name in candidates if re.search(r'\b' + re.escape(name) + r'\b', code)}
+    used = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+    return used & candidates
+
+
+def prefetch(datasets, max_workers=4):
+    """
+    Resolves the given {name: dataset} concurrently (downloads overlap) and returns
+    {name: loaded data}. Already loaded or plain datasets are returned as-is.
+    """
+    pending = {name: d for name, d in datasets.items() if isinstance(d, LazyDataset) and not d.is_loaded}
+    if len(pending) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pending))) as pool:
+            list(pool.map(LazyDataset.resolve, pending.values()))
+    return {name: materialize(d) for name, d in datasets.items()}
@@ -116,3 +116,102 @@ def clean_generated_code(code):
         if imp not in code:
             code = imp + '\n' + code
     return code
+
+
+# --- Incremental correction helpers ---
+
+GENERATED_FILENAME = "<generated>"
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) used for prompt budgeting."""
+    return len(text or "") // 4 + 1
+
+
+def traceback_line_numbers(traceback_text, filename=GENERATED_FILENAME):
+    """Line numbers of the generated script that appear in a traceback (innermost last)."""
+    pattern = r'File "' + re.escape(filename) + r'", line (\d+)'
+    return [int(n) for n in re.findall(pattern, traceback_text or "")]
+
+
+def numbered_window(code, anchor_lines, context=6, max_lines=60):
+    """
+    Returns the lines around each anchor line, prefixed with their line numbers.
+    Overlapping windows are merged; gaps are shown as '...'.
+    """
+    lines = code.split('\n')
+    keep = set()
+    for anchor in anchor_lines:
+        keep.update(range(max(1, anchor - context), min(len(lines), anchor + context) + 1))
+    if not keep:
+        keep = set(range(1, min(len(lines), max_lines) + 1))
+
+    out = []
+    previous = None
+    for n in sorted(keep)[-max_lines:]:
+        if previous is not None and n != previous + 1:
+            out.append("     ...")
+        marker = ">>" if n in anchor_lines else "  "
+        out.append(f"{marker}{n:4d} | {lines[n - 1]}")
+        previous = n
+    return "\n".join(out)
+
+
+def apply_unified_diff(code, diff_text):
+    """
+    Applies a unified diff (as returned by the model) to code and returns the patched code.
+    Hunks are located by their context/removed lines, searching near the stated line number
+    first, so slightly wrong @@ headers still apply. Raises ValueError if a hunk does not match.
+    """
+    match = re.search(r"```(?:diff|patch)?\n(.*?)```", diff_text, re.DOTALL)
+    if match:
+        diff_text = match.group(1)
+
+    hunks = []
+    current = None
+    for line in diff_text.split('\n'):
+        if line.startswith(('---', '+++')) and current is None:
+            continue
+        header = re.match(r'^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@', line)
+        if header:
+            # "-l,0" (nothing removed) means the new lines go after line l, not at it
+            start = int(header.group(1)) + (1 if header.group(2) == '0' else 0)
+            current = {"start": start, "old": [], "new": []}
+            hunks.append(current)
+            continue
+        if current is None:
+            continue
+        if line.startswith('-'):
+            current["old"].append(line[1:])
+        elif line.startswith('+'):
+            current["new"].append(line[1:])
+        elif line.startswith(' ') or line == '':
+            current["old"].append(line[1:])
+            current["new"].append(line[1:])
+
+    if not hunks:
+        raise ValueError("No hunks found in diff")
+
+    lines = code.split('\n')
+    offset = 0
+    for hunk in hunks:
+        old = hunk["old"]
+        # Trailing blank context lines are often mangled by the model; ignore them
+        while old and not old[-1].strip() and hunk["new"] and not hunk["new"][-1].strip():
+            old = old[:-1]
+            hunk["new"] = hunk["new"][:-1]
+
+        expected = max(0, hunk["start"] - 1 + offset)
+        candidates = sorted(range(len(lines) - len(old) + 1), key=lambda i: abs(i - expected))
+        position = next(
+            (i for i in candidates
+             if [l.rstrip() for l in lines[i:i + len(old)]] == [l.rstrip() for l in old]),
+            None
+        )
+        if position is None:
+            raise ValueError(f"Hunk starting at line {hunk['start']} does not match the code")
+
+        lines[position:position + len(old)] = hunk["new"]
+        offset += len(hunk["new"]) - len(old)
+
+    return '\n'.join(lines)
@@ -0,0 +1,323 @@
+"""
+Pollution bands and exposure raster.
+
+'Rang' labels ("20-25 µg/m³") are parsed once at ingestion into numeric bounds,
+an ordered categorical band and per-band row bitmaps (BandIndex).
+
+The air_pollution_levels street segments are burned onto a fixed metric grid
+(EPSG:25831) holding, per cell, the highest band within radius_m of it. The grid
+is saved under the cache dir as a .npy array plus a JSON affine transform and is
+memory-mapped on load, so every worker shares one copy and the exposure of any
+batch of points is a vectorized array lookup instead of a nearest-segment search.
+
+Only the full layers registered at load time (register_layer) are rasterized to
+disk. Filtered subsets of one (nearby segments, a band range) sample its raster,
+and any other frame gets an in-memory raster, so the cache dir holds one raster
+per version of the data rather than one per query.
+"""
+import hashlib
+import json
+import math
+import operator
+import os
+import re
+import threading
+import weakref
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from capture import echo
+from config import get_cache_dir
+from spatial import METRIC_CRS, projection_cache
+
+RASTER_CELL_M = 20.0
+RASTER_RADIUS_M = 60.0  # Buildings sit back from the street centreline the segments are drawn on
+BAND_EDGES = [15, 20, 25, 30, 35, 40]
+BAND_LABELS = ["<=15 µg/m³", "15-20 µg/m³", "20-25 µg/m³", "25-30 µg/m³", "30-35 µg/m³", "35-40 µg/m³", "> 40 µg/m³"]
+BAND_WIDTH = 5.0  # Open-ended bands ("<=15", "> 40") are treated as one band width wide
+
+
+def parse_band(rang):
+    """
+    (lower, upper, mid) in µg/m³ for one 'Rang' label: '20-25 µg/m³' -> (20, 25, 22.5),
+    '<=15 µg/m³' -> (0, 15, 12.5), '> 40 µg/m³' -> (40, inf, 42.5). NaNs if unparseable.
+    """
+    numbers = [float(n) for n in re.findall(r"\d+(?:\.\d+)?", str(rang))]
+    if len(numbers) >= 2:
+        return numbers[0], numbers[1], (numbers[0] + numbers[1]) / 2
+    if len(numbers) == 1 and "<" in str(rang):
+        return 0.0, numbers[0], numbers[0] - BAND_WIDTH / 2
+    if len(numbers) == 1 and ">" in str(rang):
+        return numbers[0], np.inf, numbers[0] + BAND_WIDTH / 2
+    return np.nan, np.nan, np.nan
+
+
+def add_band_columns(data):
+    """
+    Ingestion step for layers with a 'Rang' column: adds numeric rang_lower_ugm3,
+    rang_upper_ugm3 and rang_mid_ugm3 plus rang_band, an ordered categorical, so
+    thresholds and sorting are vectorized. Each distinct label is parsed once.
+    """
+    if data is None or "Rang" not in data.columns:
+        return data
+    labels = list(pd.unique(data["Rang"].dropna()))
+    bounds = {label: parse_band(label) for label in labels}
+    for i, column in enumerate(["rang_lower_ugm3", "rang_upper_ugm3", "rang_mid_ugm3"]):
+        data[column] = data["Rang"].map({label: bound[i] for label, bound in bounds.items()}).astype(float)
+
+    ordered = sorted((label for label in labels if not np.isnan(bounds[label][2])), key=lambda label: bounds[label][2])
+    data["rang_band"] = pd.Categorical(data["Rang"], categories=ordered, ordered=True)
+    return data
+
+
+def band_midpoints(rang):
+    """Band midpoints for a 'Rang' Series (each distinct label is parsed once)."""
+    mapping = {label: parse_band(label)[2] for label in pd.unique(rang.dropna())}
+    return rang.map(mapping).astype(float)
+
+
+def _layer_midpoints(emission_gdf):
+    if "rang_mid_ugm3" in emission_gdf.columns:
+        return emission_gdf["rang_mid_ugm3"].to_numpy(dtype=float)
+    return band_midpoints(emission_gdf["Rang"]).to_numpy()
+
+
+class BandIndex:
+    """
+    Per-band row bitmaps (packed bits) over a pollution layer, so selecting the
+    rows in any set of bands is a few bitwise ORs instead of a scan of the labels.
+    """
+
+    def __init__(self, rang_band):
+        codes = rang_band.cat.codes.to_numpy()
+        self.n_rows = len(codes)
+        self.bands = list(rang_band.cat.categories)
+        self.bounds = [parse_band(label) for label in self.bands]
+        self.bitmaps = [np.packbits(codes == code) for code in range(len(self.bands))]
+
+    def positions(self, min_ugm3=None, max_ugm3=None):
+        """Ascending row positions whose whole band is >= min_ugm3 and <= max_ugm3."""
+        selected = [
+            bitmap for bitmap, (lower, upper, _) in zip(self.bitmaps, self.bounds)
+            if (min_ugm3 is None or lower >= min_ugm3) and (max_ugm3 is None or upper <= max_ugm3)
+        ]
+        if not selected:
+            return np.empty(0, dtype=np.intp)
+        combined = np.bitwise_or.reduce(selected) if len(selected) > 1 else selected[0]
+        return np.flatnonzero(np.unpackbits(combined, count=self.n_rows))
+
+
+def band_index(emission_gdf):
+    """BandIndex for the layer, built once per dataset version (adds band columns if missing)."""
+    def build():
+        data = emission_gdf if "rang_band" in emission_gdf.columns else add_band_columns(emission_gdf.copy())
+        return BandIndex(data["rang_band"])
+
+    return projection_cache.derived(emission_gdf, "band_index", build)
+
+
+def band_labels(values):
+    """'Rang'-style label for each µg/m³ value (None where the value is NaN)."""
+    values = np.asarray(values, dtype=float)
+    labels = np.asarray(BAND_LABELS, dtype=object)[np.digitize(np.nan_to_num(values), BAND_EDGES)]
+    labels[np.isnan(values)] = None
+    return labels
+
+
+class PollutionRaster:
+    """Band midpoints on a north-up grid: cell (row, col) covers x0 + col*cell, y0 - row*cell."""
+
+    def __init__(self, values, x0, y0, cell_m):
+        self.values = values
+        self.x0 = x0
+        self.y0 = y0
+        self.cell_m = cell_m
+
+    def sample(self, coords):
+        """µg/m³ at each (x, y) METRIC_CRS coordinate; NaN outside the grid or away from any street."""
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        cols = np.floor((coords[:, 0] - self.x0) / self.cell_m)
+        rows = np.floor((self.y0 - coords[:, 1]) / self.cell_m)
+        height, width = self.values.shape
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+
+        result = np.full(len(coords), np.nan)
+        result[inside] = self.values[rows[inside].astype(np.intp), cols[inside].astype(np.intp)]
+        return result
+
+    def save(self, path):
+        """Writes <path>.npy and <path>.json (atomically, so concurrent builders cannot clash)."""
+        tmp = f"{path}.{os.getpid()}.tmp.npy"
+        np.save(tmp, np.asarray(self.values, dtype=np.float32))
+        os.replace(tmp, f"{path}.npy")
+        meta = {"x0": self.x0, "y0": self.y0, "cell_m": self.cell_m, "shape": list(self.values.shape), "crs": METRIC_CRS}
+        meta_tmp = f"{path}.{os.getpid()}.json.tmp"
+        with open(meta_tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(meta_tmp, f"{path}.json")
+
+    @classmethod
+    def load(cls, path):
+        """Memory-maps a saved raster; returns None if it is missing or incomplete."""
+        if not (os.path.exists(f"{path}.npy") and os.path.exists(f"{path}.json")):
+            return None
+        with open(f"{path}.json") as f:
+            meta = json.load(f)
+        return cls(np.load(f"{path}.npy", mmap_mode="r"), meta["x0"], meta["y0"], meta["cell_m"])
+
+
+def _dilate_max(grid, radius_cells):
+    """Max over a disk of radius_cells around every cell (shifted-array maxima, no scipy needed)."""
+    out = grid.copy()
+    height, width = grid.shape
+    for dr in range(-radius_cells, radius_cells + 1):
+        for dc in range(-radius_cells, radius_cells + 1):
+            if (dr == 0 and dc == 0) or dr * dr + dc * dc > radius_cells * radius_cells:
+                continue
+            src = grid[max(0, -dr):height - max(0, dr), max(0, -dc):width - max(0, dc)]
+            dst = out[max(0, dr):height - max(0, -dr), max(0, dc):width - max(0, -dc)]
+            np.maximum(dst, src, out=dst)
+    return out
+
+
+def build_pollution_raster(emission_gdf, cell_m=RASTER_CELL_M, radius_m=RASTER_RADIUS_M):
+    """Rasterizes the segments' band midpoints onto a grid covering the layer (plus radius_m)."""
+    geometries = np.asarray(projection_cache.projected(emission_gdf).values)
+    values = _layer_midpoints(emission_gdf)
+    keep = ~(shapely.is_missing(geometries) | shapely.is_empty(geometries)) & np.isfinite(values)
+    geometries, values = geometries[keep], values[keep]
+    if not len(geometries):
+        return PollutionRaster(np.full((1, 1), np.nan, dtype=np.float32), 0.0, 0.0, cell_m)
+
+    minx, miny, maxx, maxy = shapely.total_bounds(geometries)
+    margin = radius_m + cell_m
+    x0, y0 = minx - margin, maxy + margin
+    width = int(math.ceil((maxx + margin - x0) / cell_m))
+    height = int(math.ceil((y0 - (miny - margin)) / cell_m))
+
+    # Densify so consecutive vertices are at most half a cell apart, then burn vertices in
+    vertices, owner = shapely.get_coordinates(shapely.segmentize(geometries, cell_m / 2), return_index=True)
+    cols = ((vertices[:, 0] - x0) / cell_m).astype(np.intp)
+    rows = ((y0 - vertices[:, 1]) / cell_m).astype(np.intp)
+    grid = np.full((height, width), -np.inf, dtype=np.float32)
+    np.maximum.at(grid, (rows, cols), values[owner].astype(np.float32))
+
+    grid = _dilate_max(grid, int(round(radius_m / cell_m)))
+    grid[np.isinf(grid)] = np.nan
+    return PollutionRaster(grid, float(x0), float(y0), float(cell_m))
+
+
+def _content_key(emission_gdf, cell_m, radius_m):
+    digest = hashlib.sha1(f"{cell_m}:{radius_m}:{METRIC_CRS}".encode())
+    digest.update(pd.util.hash_pandas_object(emission_gdf["Rang"].astype(str), index=False).to_numpy().tobytes())
+    for wkb in shapely.to_wkb(np.asarray(emission_gdf.geometry.values)):
+        digest.update(wkb or b"")
+    return digest.hexdigest()[:16]
+
+
+_layers_lock = threading.Lock()
+_layers = []  # (weakref, version) of the full pollution layers, most recently registered last
+
+
+def register_layer(emission_gdf):
+    """
+    Marks a freshly loaded pollution layer as the full layer: its raster is kept in
+    the cache dir, and row subsets of it are resolved against it.
+    """
+    version = projection_cache.version(emission_gdf)
+    with _layers_lock:
+        _layers[:] = [(ref, v) for ref, v in _layers if ref() is not None and ref() is not emission_gdf]
+        _layers.append((weakref.ref(emission_gdf), version))
+
+
+def _full_layer(emission_gdf):
+    """The registered layer emission_gdf is (or whose rows it is a subset of), else None."""
+    with _layers_lock:
+        candidates = [(ref(), version) for ref, version in reversed(_layers)]
+    for full, version in candidates:
+        if full is None or projection_cache.version(full) != version:
+            continue  # Collected, or changed in place since it was loaded
+        if full is emission_gdf:
+            return full
+        if len(emission_gdf) > len(full) or str(emission_gdf.crs) != str(full.crs) or not full.index.is_unique:
+            continue
+        positions = full.index.get_indexer(emission_gdf.index)
+        if (positions < 0).any():
+            continue
+        # Filtering keeps the geometry objects themselves: the same objects (and bands) means the same rows
+        full_geometries = np.asarray(full.geometry.values)[positions]
+        if not all(map(operator.is_, np.asarray(emission_gdf.geometry.values), full_geometries)):
+            continue
+        if np.array_equal(_layer_midpoints(emission_gdf), _layer_midpoints(full)[positions], equal_nan=True):
+            return full
+    return None
+
+
+def _prune_rasters(cache_dir, keep):
+    """Removes pollution rasters other than keep (earlier versions of the data)."""
+    for name in os.listdir(cache_dir):
+        if name.startswith("pollution_raster_") and not name.startswith(keep):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+
+
+def get_pollution_raster(emission_gdf, cell_m=RASTER_CELL_M, radius_m=RASTER_RADIUS_M):
+    """
+    Raster for this pollution layer, memoized per dataset version. A subset of a
+    registered full layer gets the full layer's raster, the full layer's is loaded
+    from the cache dir (memory-mapped) or built and saved there on first use, and
+    any other frame's is built in memory.
+    """
+    full = _full_layer(emission_gdf)
+    if full is not None and full is not emission_gdf:
+        return get_pollution_raster(full, cell_m, radius_m)
+
+    def load_or_build():
+        if full is None:
+            return build_pollution_raster(emission_gdf, cell_m, radius_m)
+        cache_dir = get_cache_dir()
+        name = f"pollution_raster_{_content_key(emission_gdf, cell_m, radius_m)}"
+        path = os.path.join(cache_dir, name)
+        raster = PollutionRaster.load(path)
+        if raster is None:
+            echo(f"🗺️ Building pollution raster ({cell_m:.0f} m cells) from {len(emission_gdf)} segments...")
+            build_pollution_raster(emission_gdf, cell_m, radius_m).save(path)
+            raster = PollutionRaster.load(path)
+            _prune_rasters(cache_dir, keep=name)
+        return raster
+
+    return projection_cache.derived(emission_gdf, ("pollution_raster", cell_m, radius_m), load_or_build)
+
+
+def exposure_at(locations_gdf, emission_gdf):
+    """
+    µg/m³ band midpoint for every location (centroids for polygons). Locations
+    farther than the raster radius from any street fall back to their nearest segment.
+    For a filtered subset of the loaded layer, the raster is the full layer's: the
+    air at a location does not depend on which streets the query kept.
+    """
+    return exposure_at_coords(projection_cache.metric_coords(locations_gdf), emission_gdf)
+
+
+def exposure_at_coords(coords, emission_gdf):
+    """exposure_at for (n, 2) METRIC_CRS coordinates."""
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    exposure = get_pollution_raster(emission_gdf).sample(coords)
+
+    missing = np.flatnonzero(np.isnan(exposure) & np.isfinite(coords).all(axis=1))
+    if len(missing):
+        nearest = projection_cache.nearest_positions(emission_gdf, coords[missing])
+        midpoints = _layer_midpoints(emission_gdf)
+        found = nearest >= 0
+        exposure[missing[found]] = midpoints[nearest[found]]
+    return exposure
+
+
+def exposure_range(emission_gdf):
+    """(lowest, highest) exposure exposure_at can return for this layer (band midpoints)."""
+    midpoints = _layer_midpoints(emission_gdf)
+    return float(np.nanmin(midpoints)), float(np.nanmax(midpoints))
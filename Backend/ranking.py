@@ -0,0 +1,129 @@
+"""
+Top-k ranking over a candidate layer ("the 20 houses least exposed to pollution
+near Maragall"). Scores are evaluated in vectorized batches and only the best k
+are kept (partial selection). When the score grows with distance from a center,
+candidates are visited nearest-first and the scan stops as soon as no remaining
+candidate can beat the current k-th score. Ties are broken by layer order, so
+the ranking is stable.
+"""
+import numpy as np
+import pandas as pd
+
+from pollution import exposure_at_coords, exposure_range
+from spatial import projection_cache
+
+TOP_K_BATCH = 1024
+
+
+def select_top_k(scores, positions, k):
+    """The k lowest scores (ties by position) as (positions, scores) in rank order; NaN scores are dropped."""
+    keep = ~np.isnan(scores)
+    scores, positions = scores[keep], positions[keep]
+    if k <= 0:
+        return positions[:0], scores[:0]
+    if len(scores) > k:
+        kth = np.partition(scores, k - 1)[k - 1]
+        within = scores <= kth  # Keeps every tie with the k-th score; lexsort settles them by position
+        scores, positions = scores[within], positions[within]
+    order = np.lexsort((positions, scores))[:k]
+    return positions[order], scores[order]
+
+
+def _components(by):
+    """Normalizes `by` (a name, a callable, a list of them or a {component: weight} dict) to [(component, weight)]."""
+    if isinstance(by, dict):
+        return list(by.items())
+    if isinstance(by, (list, tuple)):
+        return [(component, 1.0) for component in by]
+    return [(by, 1.0)]
+
+
+def _score_floor(component_values, components, sign, emission_gdf):
+    """Lowest possible value of the non-distance part of the score, or None if it cannot be bounded."""
+    floor = 0.0
+    for component, weight in components:
+        signed = sign * weight
+        if component == "distance":
+            continue
+        if callable(component):
+            return None
+        if component == "exposure":
+            low, high = exposure_range(emission_gdf)
+        else:
+            low, high = np.nanmin(component_values[component]), np.nanmax(component_values[component])
+        floor += signed * (low if signed > 0 else high)
+    return floor
+
+
+def rank_top_k(gdf, k, by="exposure", largest=False, center_point=None, radius_km=None,
+               emission_gdf=None, batch_size=TOP_K_BATCH):
+    """
+    Ranks gdf's features by a weighted score and keeps the best k.
+
+    Score components: 'distance' (metres to center_point), 'exposure' (µg/m³ from
+    the pollution raster of emission_gdf), any numeric column, or a callable taking
+    the candidate rows and returning one score per row.
+
+    Returns (positions, scores, scanned): layer positions and scores in rank order,
+    and how many candidates were evaluated before the scan could stop.
+    """
+    components = _components(by)
+    sign = -1.0 if largest else 1.0
+    uses_distance = any(component == "distance" for component, _ in components)
+    if (uses_distance or radius_km is not None) and center_point is None:
+        raise ValueError("center_point is required to rank by distance or within radius_km")
+    if any(component == "exposure" for component, _ in components) and emission_gdf is None:
+        raise ValueError("emission_gdf is required to rank by exposure")
+
+    # Candidate area: the spatial index narrows it to the radius before anything is scored
+    if center_point is not None and radius_km is not None:
+        membership = projection_cache.multi_center(gdf, [center_point], [radius_km])
+        candidates, distances = membership.features, membership.distances
+    elif center_point is not None:
+        candidates, distances = np.arange(len(gdf)), projection_cache.distances(gdf, center_point)
+    else:
+        candidates, distances = np.arange(len(gdf)), None
+    if distances is not None:
+        order = np.argsort(distances, kind="stable")
+        candidates, distances = candidates[order], distances[order]
+
+    component_values = {
+        component: pd.to_numeric(gdf[component], errors="coerce").to_numpy(dtype=float)[candidates]
+        for component, _ in components
+        if isinstance(component, str) and component not in ("distance", "exposure")
+    }
+    coords = projection_cache.metric_coords(gdf) if emission_gdf is not None else None
+
+    distance_weight = sign * sum(weight for component, weight in components if component == "distance")
+    floor = _score_floor(component_values, components, sign, emission_gdf) if len(candidates) else None
+    can_stop = distances is not None and distance_weight > 0 and floor is not None
+
+    best_positions, best_scores = np.empty(0, dtype=np.intp), np.empty(0)
+    batch_size = max(batch_size, k)
+    scanned = 0
+    while scanned < len(candidates):
+        batch = slice(scanned, scanned + batch_size)
+        positions = candidates[batch]
+        scores = np.zeros(len(positions))
+        for component, weight in components:
+            if callable(component):
+                values = np.asarray(component(gdf.iloc[positions]), dtype=float)
+            elif component == "distance":
+                values = distances[batch]
+            elif component == "exposure":
+                values = exposure_at_coords(coords[positions], emission_gdf)
+            else:
+                values = component_values[component][batch]
+            scores += sign * weight * values
+
+        best_positions, best_scores = select_top_k(
+            np.concatenate([best_scores, scores]), np.concatenate([best_positions, positions]), k
+        )
+        scanned += len(positions)
+
+        # Every remaining candidate is at least this far away, so its score is at least the bound
+        if can_stop and len(best_scores) == k and scanned < len(candidates):
+            if distance_weight * distances[scanned] + floor > best_scores[-1]:
+                break
+
+    return best_positions, sign * best_scores, scanned
@@ -0,0 +1,206 @@
+"""
+Walking routes over the street network in air_pollution_levels.
+
+Every segment is a street edge with a pollution band. StreetGraph snaps segment
+endpoints to shared node ids and stores the network as CSR arrays (built once
+per dataset version, at ingestion for the CSV layer). Routes are found with A*
+over those arrays, with each edge costing its length scaled up by how polluted
+it is, so pollution_weight trades a longer walk for cleaner air.
+"""
+import heapq
+import math
+
+import numpy as np
+import shapely
+
+from pollution import exposure_at_coords, band_labels
+from spatial import PointIndex, project_geometries, project_point, projection_cache
+
+SNAP_M = 1.0  # Endpoints closer than this (on a 1 m grid) become the same node
+DEFAULT_POLLUTION_WEIGHT = 2.0  # Dirtiest band costs (1 + weight) x its length
+PATH_SAMPLE_M = 10.0  # Spacing of exposure samples along arbitrary paths
+
+
+class Route:
+    """Result of StreetGraph.route: the edges walked, in order, and their totals."""
+
+    def __init__(self, segments, lengths, exposures, snap_m, found=None):
+        self.segments = segments  # Layer positions of the street segments walked, in order
+        self.lengths = lengths
+        self.exposures = exposures
+        self.snap_m = snap_m  # Distance from the requested start/end to the network
+        # A route with no segments is still found when start and end snap to the same node
+        self.found = len(segments) > 0 if found is None else found
+
+    def summary(self):
+        """JSON-serialisable totals: length, length-weighted mean and max exposure."""
+        length = float(self.lengths.sum())
+        valid = ~np.isnan(self.exposures)
+        mean = float(np.average(self.exposures[valid], weights=self.lengths[valid])) if valid.any() and length else None
+        return {
+            "found": self.found,
+            "segments": int(len(self.segments)),
+            "length_m": round(length, 1),
+            "mean_ugm3": round(mean, 2) if mean is not None else None,
+            "max_ugm3": float(np.nanmax(self.exposures)) if valid.any() else None,
+            "snap_m": [round(d, 1) for d in self.snap_m],
+        }
+
+
+class StreetGraph:
+    """CSR street graph over a pollution layer's segments (METRIC_CRS, undirected)."""
+
+    def __init__(self, emission_gdf, snap_m=SNAP_M):
+        geometries = np.asarray(projection_cache.projected(emission_gdf).values)
+        parts, owner = shapely.get_parts(geometries, return_index=True)
+        keep = ~shapely.is_empty(parts)
+        parts, owner = parts[keep], owner[keep]
+
+        starts = shapely.get_coordinates(shapely.get_point(parts, 0))
+        ends = shapely.get_coordinates(shapely.get_point(parts, -1))
+        endpoints = np.vstack([starts, ends])
+        keys = np.round(endpoints / snap_m).astype(np.int64)
+        _, first, node_of = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        node_of = node_of.ravel()
+        self.node_xy = endpoints[first]
+        n_edges, n_nodes = len(parts), len(first)
+
+        # Each segment is walkable both ways: 2 directed arcs, grouped by source node
+        sources = np.concatenate([node_of[:n_edges], node_of[n_edges:]])
+        targets = np.concatenate([node_of[n_edges:], node_of[:n_edges]])
+        arc_edges = np.concatenate([np.arange(n_edges), np.arange(n_edges)])
+        order = np.argsort(sources, kind="stable")
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=n_nodes))])
+        self.targets = targets[order]
+        self.arc_edges = arc_edges[order]
+
+        self.edge_segment = owner
+        self.edge_length = shapely.length(parts)
+        if "rang_mid_ugm3" in emission_gdf.columns:
+            self.edge_exposure = emission_gdf["rang_mid_ugm3"].to_numpy(dtype=float)[owner]
+        else:
+            self.edge_exposure = np.full(n_edges, np.nan)
+        low, high = (np.nanmin(self.edge_exposure), np.nanmax(self.edge_exposure)) if n_edges else (0, 0)
+        penalty = (self.edge_exposure - low) / (high - low) if high > low else np.zeros(n_edges)
+        self.edge_penalty = np.nan_to_num(penalty, nan=0.5)  # Unknown band: treated as mid-range
+
+        # Snap requests onto the largest connected component so small islands never strand a route
+        component = self._components()
+        main = np.flatnonzero(component == np.bincount(component).argmax()) if n_nodes else np.empty(0, dtype=np.intp)
+        self.main_nodes = main
+        self.node_index = PointIndex(self.node_xy[main])
+
+        # Plain lists are much faster than numpy scalars inside the A* loop
+        self._indptr = self.indptr.tolist()
+        self._targets = self.targets.tolist()
+        self._arc_edges = self.arc_edges.tolist()
+        self._x = self.node_xy[:, 0].tolist()
+        self._y = self.node_xy[:, 1].tolist()
+
+    def _components(self):
+        component = np.full(len(self.node_xy), -1, dtype=np.intp)
+        indptr, targets = self.indptr.tolist(), self.targets.tolist()
+        label = 0
+        for seed in range(len(component)):
+            if component[seed] >= 0:
+                continue
+            component[seed] = label
+            stack = [seed]
+            while stack:
+                node = stack.pop()
+                for k in range(indptr[node], indptr[node + 1]):
+                    neighbour = targets[k]
+                    if component[neighbour] < 0:
+                        component[neighbour] = label
+                        stack.append(neighbour)
+            label += 1
+        return component
+
+    def snap(self, xy):
+        """(node id, metres away) of the connected-network node nearest to a METRIC_CRS (x, y)."""
+        positions, distances = self.node_index.nearest_many([xy])
+        if positions[0] < 0:
+            return -1, np.inf
+        return int(self.main_nodes[positions[0]]), float(distances[0])
+
+    def route(self, start_xy, end_xy, pollution_weight=DEFAULT_POLLUTION_WEIGHT):
+        """A* from start to end (METRIC_CRS coordinates); edge cost = length * (1 + weight * band penalty)."""
+        source, source_snap = self.snap(start_xy)
+        target, target_snap = self.snap(end_xy)
+        empty = Route(np.empty(0, dtype=np.intp), np.empty(0), np.empty(0), [source_snap, target_snap])
+        if source < 0 or target < 0:
+            return empty
+        if source == target:
+            return Route(empty.segments, empty.lengths, empty.exposures, empty.snap_m, found=True)
+
+        cost = (self.edge_length * (1.0 + max(pollution_weight, 0.0) * self.edge_penalty)).tolist()
+        indptr, targets, arc_edges, xs, ys = self._indptr, self._targets, self._arc_edges, self._x, self._y
+        tx, ty = xs[target], ys[target]
+
+        # Edge cost >= its length >= the straight-line gap, so the Euclidean heuristic is admissible
+        best = {source: 0.0}
+        came_from = {}
+        heap = [(math.hypot(xs[source] - tx, ys[source] - ty), 0.0, source)]
+        while heap:
+            _, so_far, node = heapq.heappop(heap)
+            if node == target:
+                break
+            if so_far > best[node]:
+                continue
+            for k in range(indptr[node], indptr[node + 1]):
+                neighbour, edge = targets[k], arc_edges[k]
+                candidate = so_far + cost[edge]
+                if candidate < best.get(neighbour, math.inf):
+                    best[neighbour] = candidate
+                    came_from[neighbour] = (node, edge)
+                    heapq.heappush(heap, (candidate + math.hypot(xs[neighbour] - tx, ys[neighbour] - ty), candidate, neighbour))
+        else:
+            return empty
+
+        edges = []
+        node = target
+        while node != source:
+            node, edge = came_from[node]
+            edges.append(edge)
+        edges = np.asarray(edges[::-1], dtype=np.intp)
+        return Route(self.edge_segment[edges], self.edge_length[edges], self.edge_exposure[edges],
+                     [source_snap, target_snap])
+
+
+def street_graph(emission_gdf):
+    """StreetGraph for the pollution layer, built once per dataset version."""
+    return projection_cache.derived(emission_gdf, "street_graph", lambda: StreetGraph(emission_gdf))
+
+
+def cleanest_route(emission_gdf, start_point, end_point, pollution_weight=DEFAULT_POLLUTION_WEIGHT):
+    """Route between two EPSG:4326 points over the layer's street network."""
+    return street_graph(emission_gdf).route(project_point(start_point), project_point(end_point), pollution_weight)
+
+
+def path_exposure(emission_gdf, lines):
+    """
+    Exposure along arbitrary EPSG:4326 lines (e.g. a route's segments): samples the
+    pollution raster every PATH_SAMPLE_M metres and returns length, mean and max µg/m³.
+    """
+    lines = project_geometries(lines)
+    lengths = shapely.length(lines)
+    samples = []
+    for line, length in zip(lines, lengths):
+        if line is None or not length:
+            continue
+        distances = np.append(np.arange(0.0, length, PATH_SAMPLE_M), length)
+        samples.append(shapely.get_coordinates(shapely.line_interpolate_point(line, distances)))
+    if not samples:
+        return {"length_m": 0.0, "mean_ugm3": None, "max_ugm3": None, "mean_band": None}
+
+    exposure = exposure_at_coords(np.vstack(samples), emission_gdf)
+    if np.isnan(exposure).all():
+        mean = peak = None
+    else:
+        mean, peak = float(np.nanmean(exposure)), float(np.nanmax(exposure))
+    return {
+        "length_m": round(float(np.nansum(lengths)), 1),
+        "mean_ugm3": round(mean, 2) if mean is not None else None,
+        "max_ugm3": peak,
+        "mean_band": band_labels([mean])[0] if mean is not None else None,
+    }
@@ -0,0 +1,235 @@
+"""
+Registry of streaming sessions for the SSE servers.
+
+Each question streamed to a browser gets a StreamSession. It has a uuid id and
+a bounded event queue. It is removed when its stream ends, or by the sweeper
+once it expires, whether or not a client ever connected. A global cap limits
+live sessions, so memory stays flat under sustained traffic.
+
+When a producer outpaces a slow consumer, a full queue coalesces instead of
+growing:
+- contiguous delta frames are merged;
+- a snapshot supersedes the text frames queued before it;
+- a newer progress event (status/tool) replaces the oldest queued one.
+Terminal events (complete, error) are always accepted.
+
+Readers wait with get (a blocking thread, for the Flask server) or get_async
+(for the asyncio server, where an open stream holds no thread).
+"""
+import asyncio
+import threading
+import time
+import uuid
+from collections import deque
+from queue import Empty
+
+from deltastream import text_length
+
+SESSION_QUEUE_SIZE = 256  # Events held per session before coalescing kicks in
+MAX_LIVE_SESSIONS = 200
+SESSION_UNCLAIMED_TTL_S = 60  # A stream nobody connects to within this is dropped
+SESSION_IDLE_TTL_S = 300  # Hard cap on a session's life after its last event
+SWEEP_INTERVAL_S = 15
+
+TERMINAL_EVENTS = ('complete', 'error', 'timeout')
+TEXT_EVENTS = ('delta', 'snapshot')
+PROGRESS_EVENTS = ('status', 'tool')
+
+
+class SessionLimitError(Exception):
+    """Raised when MAX_LIVE_SESSIONS sessions are already live."""
+
+
+class StreamSession:
+    """One streamed question: its bounded event queue plus bookkeeping for the sweeper."""
+
+    def __init__(self, session_id, deadline=None, client_id=None, maxsize=SESSION_QUEUE_SIZE):
+        self.id = session_id
+        self.deadline = deadline
+        self.client_id = client_id
+        self.maxsize = maxsize
+        self.created = time.monotonic()
+        self.last_event = self.created
+        self.claimed = False  # A client has connected to the stream
+        self.finished = False  # A terminal event was queued
+        self.closed = False  # Removed from the registry; further events are dropped
+        self.coalesced = 0
+        self._events = deque()
+        self._ready = threading.Condition()
+        self._async_waiters = []  # (loop, asyncio.Event) of coroutines blocked in get_async
+
+    def put(self, event):
+        """Queues an event, coalescing when the queue is full. Returns False if the session is closed."""
+        with self._ready:
+            if self.closed:
+                return False
+            if len(self._events) >= self.maxsize and event['type'] not in TERMINAL_EVENTS:
+                event = self._coalesce(event)
+            if event is not None:
+                self._events.append(event)
+            self.last_event = time.monotonic()
+            self.finished = self.finished or event is not None and event['type'] in TERMINAL_EVENTS
+            self._ready.notify()
+            self._wake_async()
+            return True
+
+    def _coalesce(self, event):
+        """Makes room for event in a full queue; returns what is left to append (or None)."""
+        self.coalesced += 1
+        kind = event['type']
+        last = self._events[-1] if self._events else None
+        if kind == 'snapshot':
+            kept = [e for e in self._events if e['type'] not in TEXT_EVENTS]
+            self._events = deque(kept)
+            return event
+        if kind == 'delta' and last is not None and last['type'] == 'delta' \
+                and last['offset'] + text_length(last['delta']) == event['offset']:
+            self._events[-1] = dict(last, seq=event['seq'], first_seq=last.get('first_seq', last['seq']),
+                                    delta=last['delta'] + event['delta'])
+            return None
+        for i, queued in enumerate(self._events):
+            if queued['type'] in PROGRESS_EVENTS:
+                del self._events[i]
+                return event
+        if kind in PROGRESS_EVENTS:
+            return None  # Only text and lifecycle events are queued: this progress update is skipped
+        return event  # Nothing left to coalesce; lifecycle events may exceed maxsize by a few
+
+    def get(self, timeout=None):
+        """Next event; raises queue.Empty after timeout seconds without one."""
+        with self._ready:
+            if not self._ready.wait_for(lambda: self._events or self.closed, timeout):
+                raise Empty
+            if not self._events:
+                raise Empty
+            return self._events.popleft()
+
+    async def get_async(self, timeout=None):
+        """get for asyncio servers: waits on the event loop instead of holding a thread."""
+        loop = asyncio.get_running_loop()
+        give_up = None if timeout is None else loop.time() + timeout
+        waiter = (loop, asyncio.Event())
+        while True:
+            with self._ready:
+                if self._events:
+                    return self._events.popleft()
+                if self.closed:
+                    raise Empty
+                waiter[1].clear()
+                self._async_waiters.append(waiter)
+            try:
+                remaining = None if give_up is None else give_up - loop.time()
+                if remaining is not None and remaining <= 0:
+                    raise Empty
+                await asyncio.wait_for(waiter[1].wait(), remaining)
+            except asyncio.TimeoutError:
+                raise Empty
+            finally:
+                with self._ready:
+                    self._async_waiters.remove(waiter)
+
+    def qsize(self):
+        return len(self._events)
+
+    def close(self):
+        """Drops queued events. A question still being answered is cancelled: nobody will read it."""
+        if not self.finished and self.deadline is not None:
+            self.deadline.cancel("session closed before the answer was complete")
+        with self._ready:
+            self.closed = True
+            self._events.clear()
+            self._ready.notify_all()
+            self._wake_async()
+
+    def _wake_async(self):
+        for loop, ready in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                pass  # Event loop already closed
+
+    def expired(self, now):
+        if not self.claimed and now - self.created > SESSION_UNCLAIMED_TTL_S:
+            return True
+        return now - self.last_event > SESSION_IDLE_TTL_S
+
+
+class SessionRegistry:
+    """Live StreamSessions by id, with a global cap and a background TTL sweeper."""
+
+    def __init__(self, max_sessions=MAX_LIVE_SESSIONS, sweep_interval_s=SWEEP_INTERVAL_S):
+        self.max_sessions = max_sessions
+        self.sweep_interval_s = sweep_interval_s
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def create(self, deadline=None, client_id=None):
+        """New session with a collision-free id; raises SessionLimitError at the cap."""
+        self.start_sweeper()
+        with self._lock:
+            if len(self._sessions) >= self.max_sessions:
+                self._sweep_locked(time.monotonic())
+            if len(self._sessions) >= self.max_sessions:
+                raise SessionLimitError(f"{self.max_sessions} streaming sessions are already live")
+            session = StreamSession(f"session_{uuid.uuid4().hex}", deadline, client_id)
+            self._sessions[session.id] = session
+            return session
+
+    def get(self, session_id):
+        return self._sessions.get(session_id)
+
+    def claim(self, session_id):
+        """The session for a connecting client (None if unknown or already being streamed)."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or session.claimed:
+                return None
+            session.claimed = True
+            return session
+
+    def remove(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            session.close()
+
+    def _sweep_locked(self, now):
+        expired = [s for s in self._sessions.values() if s.expired(now)]
+        for session in expired:
+            del self._sessions[session.id]
+            session.close()
+        return len(expired)
+
+    def sweep(self):
+        """Drops expired sessions; returns how many."""
+        with self._lock:
+            removed = self._sweep_locked(time.monotonic())
+        if removed:
+            print(f"🧹 Dropped {removed} expired streaming sessions ({len(self)} live)")
+        return removed
+
+    def start_sweeper(self):
+        """Starts the background sweeper once."""
+        with self._lock:
+            if self._sweeper is not None:
+                return
+            self._sweeper = threading.Thread(target=self._sweep_forever, name="session-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval_s)
+            self.sweep()
+
+    def stats(self):
+        sessions = list(self._sessions.values())
+        return {
+            'live': len(sessions),
+            'max': self.max_sessions,
+            'unclaimed': sum(not s.claimed for s in sessions),
+            'queued_events': sum(s.qsize() for s in sessions),
+        }
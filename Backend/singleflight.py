@@ -0,0 +1,139 @@
+"""
+Single-flight coalescing of identical concurrent questions.
+
+When a link is shared, many clients submit the same prompt within seconds. A
+prompt is keyed by its normalized text and the data version the assistant
+answers from. The first request with a key starts a SharedJob. Requests with
+the same key that arrive while it runs subscribe to that job instead of
+starting their own run.
+
+Every event the job produces is fanned out to all subscriber sessions and
+kept in a replay buffer. A late joiner first receives the buffered events,
+then the live ones, so its client sees the whole answer with the usual seq
+numbers. A subscriber that leaves only detaches. The job is cancelled once
+its last subscriber is gone. Finished jobs leave the table: this coalesces
+work in flight and is not a response cache.
+
+The run happens on the starting client's conversation thread. Every client
+that joined is recorded as a member, and the server appends the question and
+answer to each member's own thread, so its follow-ups keep their context.
+"""
+import re
+import threading
+import unicodedata
+
+from sessions import TERMINAL_EVENTS
+
+
+def normalize_prompt(prompt):
+    """Case, accents, whitespace and trailing punctuation folded: "Bicing near  Clot?" -> "bicing near clot"."""
+    text = unicodedata.normalize("NFKD", str(prompt)).encode("ascii", "ignore").decode().lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip("?!. ")
+
+
+def flight_key(prompt, data_version):
+    return f"{data_version}:{normalize_prompt(prompt)}"
+
+
+class SharedJob:
+    """One running question and the sessions streaming it."""
+
+    def __init__(self, key, deadline):
+        self.key = key
+        self.deadline = deadline  # The job's own; subscriber deadlines only detach their session
+        self.events = []  # Replay buffer: everything published so far
+        self.subscribers = []
+        self.members = []  # What joiners attached while the job ran (e.g. their client ids)
+        self.finished = False
+        self.on_finish = None  # Called once with the job when a terminal event is published
+        self._lock = threading.Lock()
+
+    def subscribe(self, session, member=None):
+        """
+        Replays the buffered events into session and adds it to the live fan-out.
+        member (if given) joins self.members. Returns False if the job had already
+        finished: the session got the full replay, but member was not added.
+        """
+        with self._lock:
+            for event in self.events:
+                session.put(event)
+            if self.finished:
+                return False
+            self.subscribers.append(session)
+            if member is not None:
+                self.members.append(member)
+        if session.deadline is not None:
+            session.deadline.cancel_token.on_cancel(lambda reason: self.unsubscribe(session))
+        return True
+
+    def unsubscribe(self, session):
+        """Detaches a session; the job is cancelled when nobody is left to read it."""
+        with self._lock:
+            if session in self.subscribers:
+                self.subscribers.remove(session)
+            abandoned = not self.subscribers and not self.finished
+        if abandoned:
+            self.deadline.cancel("every client left")
+
+    def publish(self, event):
+        """Buffers event and sends it to every subscriber (sessions that closed are dropped)."""
+        with self._lock:
+            if self.finished:
+                return
+            self.events.append(event)
+            self.subscribers = [s for s in self.subscribers if s.put(event)]
+            self.finished = event['type'] in TERMINAL_EVENTS
+        if self.finished and self.on_finish is not None:
+            self.on_finish(self)
+
+    @property
+    def result(self):
+        """The terminal event once the job has finished, else None."""
+        return self.events[-1] if self.finished else None
+
+    @property
+    def subscriber_count(self):
+        return len(self.subscribers)
+
+
+class SingleFlight:
+    """In-flight SharedJobs by key: the first request for a key starts one, the rest join it."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.joined = 0  # Requests served by a job another request started
+
+    def joinable(self, key):
+        return key is not None and key in self._jobs
+
+    def join_or_start(self, key, deadline_factory):
+        """
+        The job to subscribe to for key, and whether the caller must start it.
+        key None (a question that must not be shared) always gets a private job.
+        """
+        if key is None:
+            return SharedJob(None, deadline_factory()), True
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and not job.finished and not job.deadline.expired():
+                self.joined += 1
+                return job, False
+            job = SharedJob(key, deadline_factory())
+            job.on_finish = self._forget
+            self._jobs[key] = job
+            return job, True
+
+    def _forget(self, job):
+        with self._lock:
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+
+    def stats(self):
+        jobs = list(self._jobs.values())
+        return {
+            'in_flight': len(jobs),
+            'subscribers': sum(job.subscriber_count for job in jobs),
+            'joined': self.joined,
+        }
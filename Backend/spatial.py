@@ -0,0 +1,563 @@
+"""
+Spatial primitives behind the MainAgent helpers.
+
+Every layer is standardized at ingestion (standardize_layer): geometry stays in
+EPSG:4326, which is what generated code and results use, and every feature also
+carries a representative point (rep_lon/rep_lat, and utm_x/utm_y in metres in
+EPSG:25831, ETRS89 / UTM 31N) plus, for lines and polygons, a metric bounding
+box (bbox_*). The municipal CSVs already ship metric point coordinates, so they
+are reused as-is.
+
+Projected geometries are cached per dataset version and distances per (dataset,
+center). For lines and polygons the bounding box (a lower bound) and the
+representative point (an upper bound) settle most radius and nearest queries,
+so exact geometry distances are only computed for the ambiguous rows. Queries
+return positional index arrays; callers slice with gdf.iloc.
+"""
+import threading
+import weakref
+from collections import OrderedDict
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+from shapely.geometry import Point
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+WGS84 = "EPSG:4326"
+METRIC_CRS = "EPSG:25831"  # Local metric CRS; Web Mercator (3857) overstates distances ~30% here
+
+NATIVE_METRIC_COLUMNS = ("ETRS89_COORD_X", "ETRS89_COORD_Y")  # Already EPSG:25831 in the open-data CSVs
+LONLAT_COLUMNS = [("LONGITUD", "LATITUD"), ("lon", "lat"), ("longitude", "latitude")]
+WKT_COLUMN = "geometry_wkt"
+BBOX_COLUMNS = ["bbox_minx", "bbox_miny", "bbox_maxx", "bbox_maxy"]
+BRUTE_FORCE_BLOCK = 1_000_000  # Max probe x point distances held at once without scipy
+
+_to_metric = Transformer.from_crs(WGS84, METRIC_CRS, always_xy=True)
+
+
+def project_point(point):
+    """(x, y) in METRIC_CRS for a shapely Point given in EPSG:4326."""
+    return _to_metric.transform(point.x, point.y)
+
+
+def _project_coords(coords):
+    return np.column_stack(_to_metric.transform(coords[:, 0], coords[:, 1]))
+
+
+def project_geometries(geometries):
+    """EPSG:4326 shapely geometries (array-like) -> the same geometries in METRIC_CRS."""
+    return shapely.transform(np.asarray(geometries, dtype=object), _project_coords)
+
+
+def _is_point_layer(gdf):
+    return bool(len(gdf)) and bool(gdf.geom_type.eq("Point").all())
+
+
+def has_metric_points(gdf):
+    """True if gdf is a point layer carrying utm_x/utm_y (set by standardize_layer)."""
+    return "utm_x" in gdf.columns and "utm_y" in gdf.columns and _is_point_layer(gdf)
+
+
+def has_bounds(gdf):
+    """True if gdf carries the representative points and metric bounding boxes set by standardize_layer."""
+    return all(column in gdf.columns for column in BBOX_COLUMNS + ["utm_x", "utm_y"])
+
+
+def standardize_layer(data):
+    """
+    Ingestion step for every layer (local CSVs and OSM downloads).
+
+    Returns a GeoDataFrame in EPSG:4326 built from a geometry_wkt column or a
+    lon/lat column pair, with a representative point per feature (rep_lon/rep_lat,
+    and utm_x/utm_y in METRIC_CRS): the point itself for points, a point on the
+    surface otherwise. Lines and polygons also get their metric bounding box
+    (bbox_*); their projection is computed once here and kept in the projection
+    cache. Native ETRS89 point columns are reused. Frames without usable
+    coordinates are returned unchanged.
+    """
+    if data is None or data.empty:
+        return data
+
+    if isinstance(data, gpd.GeoDataFrame) and data._geometry_column_name in data.columns:
+        gdf = data if data.crs is not None else data.set_crs(WGS84)
+        if not gdf.crs.equals(WGS84):
+            gdf = gdf.to_crs(WGS84)
+    elif WKT_COLUMN in data.columns:
+        geometry = gpd.GeoSeries.from_wkt(data[WKT_COLUMN], crs=WGS84)
+        gdf = gpd.GeoDataFrame(data, geometry=geometry.values, crs=WGS84)
+    else:
+        lonlat = next(((x, y) for x, y in LONLAT_COLUMNS if x in data.columns and y in data.columns), None)
+        if lonlat is None:
+            return data
+        lon, lat = (pd.to_numeric(data[c], errors="coerce") for c in lonlat)
+        gdf = gpd.GeoDataFrame(data, geometry=gpd.points_from_xy(lon, lat), crs=WGS84)
+
+    if "utm_x" in gdf.columns:
+        return gdf
+
+    geometries = np.asarray(gdf.geometry.values)
+    if _is_point_layer(gdf):
+        gdf["rep_lon"], gdf["rep_lat"] = shapely.get_x(geometries), shapely.get_y(geometries)
+        native_x, native_y = NATIVE_METRIC_COLUMNS
+        if native_x in gdf.columns and native_y in gdf.columns:
+            gdf["utm_x"] = pd.to_numeric(gdf[native_x], errors="coerce").to_numpy(float)
+            gdf["utm_y"] = pd.to_numeric(gdf[native_y], errors="coerce").to_numpy(float)
+        else:
+            gdf["utm_x"], gdf["utm_y"] = _to_metric.transform(gdf["rep_lon"].to_numpy(), gdf["rep_lat"].to_numpy())
+        return gdf
+
+    representative = shapely.point_on_surface(geometries)
+    gdf["rep_lon"], gdf["rep_lat"] = shapely.get_x(representative), shapely.get_y(representative)
+    gdf["utm_x"], gdf["utm_y"] = _to_metric.transform(gdf["rep_lon"].to_numpy(), gdf["rep_lat"].to_numpy())
+    projected = project_geometries(geometries)
+    bounds = shapely.bounds(projected)
+    for i, column in enumerate(BBOX_COLUMNS):
+        gdf[column] = bounds[:, i]
+    projection_cache.seed(gdf, projected)
+    return gdf
+
+
+class PointIndex:
+    """
+    Radius, k-nearest and batch nearest queries over (n, 2) metric coordinates.
+    Uses scipy's cKDTree when available, else blocked numpy brute force (fine for
+    the few thousand stations/stops in the municipal layers). Results are layer
+    positions (for gdf.iloc) and distances in metres.
+    """
+
+    def __init__(self, coords):
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self.positions = np.flatnonzero(np.isfinite(coords).all(axis=1))  # Rows without coordinates are skipped
+        self.coords = coords[self.positions]
+        self.tree = cKDTree(self.coords) if cKDTree is not None and len(self.coords) else None
+
+    def __len__(self):
+        return len(self.coords)
+
+    def _distances_from(self, x, y):
+        return np.hypot(self.coords[:, 0] - x, self.coords[:, 1] - y)
+
+    def radius(self, x, y, radius_m):
+        """(positions, distances) of the points within radius_m of (x, y), closest first."""
+        if not len(self):
+            return np.empty(0, dtype=np.intp), np.empty(0)
+        if self.tree is not None:
+            hits = np.asarray(self.tree.query_ball_point([x, y], radius_m), dtype=np.intp)
+            distances = np.hypot(self.coords[hits, 0] - x, self.coords[hits, 1] - y)
+        else:
+            distances = self._distances_from(x, y)
+            hits = np.flatnonzero(distances <= radius_m)
+            distances = distances[hits]
+        order = np.argsort(distances, kind="stable")
+        return self.positions[hits[order]], distances[order]
+
+    def knn(self, x, y, k):
+        """(positions, distances) of the k points nearest to (x, y), closest first."""
+        k = min(int(k), len(self))
+        if k <= 0:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+        if self.tree is not None:
+            distances, hits = self.tree.query([x, y], k=k)
+            distances, hits = np.atleast_1d(distances), np.atleast_1d(hits)
+        else:
+            all_distances = self._distances_from(x, y)
+            hits = np.argpartition(all_distances, k - 1)[:k]
+            hits = hits[np.argsort(all_distances[hits], kind="stable")]
+            distances = all_distances[hits]
+        return self.positions[hits], distances
+
+    def nearest_many(self, probes):
+        """
+        Nearest point for every row of probes (m, 2), in one batch.
+        Returns (positions, distances); probes without coordinates get -1 / inf.
+        """
+        probes = np.asarray(probes, dtype=float).reshape(-1, 2)
+        positions = np.full(len(probes), -1, dtype=np.intp)
+        distances = np.full(len(probes), np.inf)
+        valid = np.flatnonzero(np.isfinite(probes).all(axis=1))
+        if not len(self) or not len(valid):
+            return positions, distances
+
+        queries = probes[valid]
+        if self.tree is not None:
+            best_distances, best = self.tree.query(queries, k=1)
+        else:
+            best = np.empty(len(queries), dtype=np.intp)
+            best_distances = np.empty(len(queries))
+            block = max(1, BRUTE_FORCE_BLOCK // len(self))
+            for start in range(0, len(queries), block):
+                chunk = queries[start:start + block]
+                squared = (chunk[:, 0, None] - self.coords[None, :, 0]) ** 2
+                squared += (chunk[:, 1, None] - self.coords[None, :, 1]) ** 2
+                nearest = squared.argmin(axis=1)
+                best[start:start + len(chunk)] = nearest
+                best_distances[start:start + len(chunk)] = np.sqrt(squared[np.arange(len(chunk)), nearest])
+
+        positions[valid] = self.positions[best]
+        distances[valid] = best_distances
+        return positions, distances
+
+    def count_within(self, probes, radius_m):
+        """Number of points within radius_m of every row of probes (m, 2), in one batch."""
+        probes = np.asarray(probes, dtype=float).reshape(-1, 2)
+        counts = np.zeros(len(probes), dtype=np.int64)
+        valid = np.flatnonzero(np.isfinite(probes).all(axis=1))
+        if not len(self) or not len(valid):
+            return counts
+
+        queries = probes[valid]
+        if self.tree is not None:
+            counts[valid] = self.tree.query_ball_point(queries, radius_m, return_length=True)
+        else:
+            block = max(1, BRUTE_FORCE_BLOCK // len(self))
+            for start in range(0, len(queries), block):
+                chunk = queries[start:start + block]
+                squared = (chunk[:, 0, None] - self.coords[None, :, 0]) ** 2
+                squared += (chunk[:, 1, None] - self.coords[None, :, 1]) ** 2
+                counts[valid[start:start + len(chunk)]] = (squared <= radius_m * radius_m).sum(axis=1)
+        return counts
+
+
+class CenterMembership:
+    """
+    Sparse feature x center membership from a multi-center radius query: parallel
+    arrays of layer positions, center indices and distances (metres), one entry
+    per (feature, center) pair within that center's radius.
+    """
+
+    def __init__(self, features, centers, distances, n_centers):
+        order = np.lexsort((centers, features))
+        self.features = np.asarray(features, dtype=np.intp)[order]
+        self.centers = np.asarray(centers, dtype=np.intp)[order]
+        self.distances = np.asarray(distances, dtype=float)[order]
+        self.n_centers = n_centers
+
+    def __len__(self):
+        return len(self.features)
+
+    def union(self):
+        """Ascending positions of features within the radius of any center."""
+        return np.unique(self.features)
+
+    def intersection(self):
+        """Ascending positions of features within the radius of every center."""
+        features, counts = np.unique(self.features, return_counts=True)
+        return features[counts == self.n_centers]
+
+    def for_center(self, center):
+        """Ascending positions of the features within the radius of one center."""
+        return self.features[self.centers == center]
+
+    def nearest_center(self):
+        """(positions, center indices, distances): each member feature assigned to its closest center."""
+        order = np.lexsort((self.distances, self.features))
+        features = self.features[order]
+        first = np.ones(len(features), dtype=bool)
+        first[1:] = features[1:] != features[:-1]
+        chosen = order[first]
+        return self.features[chosen], self.centers[chosen], self.distances[chosen]
+
+
+class _CenterDistances:
+    """
+    Distances from one center to a layer's features. Point layers are exact from
+    the start; for bounded layers (see has_bounds) rows start with a lower bound
+    (bounding box) and an upper bound (representative point) and are made exact
+    only when a query cannot be settled by the bounds.
+    """
+
+    def __init__(self, entry, x, y):
+        self.entry = entry
+        self.point = Point(x, y)
+        self.known = None  # None: every distance is exact
+        self._order = None  # Row positions sorted by exact (or lower-bound) distance, built on the first within()
+        self._sorted = None
+        if entry.coords is not None:
+            self.exact = np.hypot(entry.coords[:, 0] - x, entry.coords[:, 1] - y)
+        elif entry.bounds is not None:
+            minx, miny, maxx, maxy = entry.bounds.T
+            self.lower = np.hypot(np.maximum(np.maximum(minx - x, x - maxx), 0),
+                                  np.maximum(np.maximum(miny - y, y - maxy), 0))
+            self.upper = np.hypot(entry.rep[:, 0] - x, entry.rep[:, 1] - y)
+            self.exact = np.full(len(self.lower), np.nan)
+            self.known = np.zeros(len(self.lower), dtype=bool)
+        else:
+            self.exact = entry.projected.distance(self.point).to_numpy()
+
+    def resolve(self, positions):
+        """Makes the distances of the given rows exact."""
+        if self.known is None:
+            return
+        todo = positions[~self.known[positions]]
+        if len(todo):
+            self.exact[todo] = shapely.distance(self.entry.project_rows(todo), self.point)
+            self.known[todo] = True
+
+    def full(self):
+        """Exact distances for every row."""
+        if self.known is not None:
+            self.resolve(np.flatnonzero(~self.known))
+        return self.exact
+
+    def _sorted_keys(self):
+        """Sorts the rows once by exact distance (or by lower bound for bounded layers); NaN sorts last."""
+        if self._order is None:
+            keys = self.exact if self.known is None else self.lower
+            self._order = np.argsort(keys, kind='stable')
+            self._sorted = keys[self._order]
+        return self._order, self._sorted
+
+    def within(self, radius_m):
+        """Ascending positions of the rows within radius_m (a binary search over the sorted distances)."""
+        order, keys = self._sorted_keys()
+        candidates = np.sort(order[:np.searchsorted(keys, radius_m, side='right')])
+        if self.known is None:
+            return candidates
+        # Bounded layers: candidates have lower <= radius; the representative point settles most of them
+        inside = self.upper[candidates] <= radius_m
+        maybe = candidates[~inside]
+        self.resolve(maybe)
+        inside[~inside] = self.exact[maybe] <= radius_m
+        return candidates[inside]
+
+    def nearest(self):
+        """(position, distance) of the nearest row (lowest position on ties); (-1, nan) if none."""
+        if self.known is None:
+            candidates = np.flatnonzero(~np.isnan(self.exact))
+        else:
+            if np.isnan(self.upper).all():
+                return -1, np.nan
+            candidates = np.flatnonzero(self.lower <= np.nanmin(self.upper))
+            self.resolve(candidates)
+            candidates = candidates[~np.isnan(self.exact[candidates])]
+        if not len(candidates):
+            return -1, np.nan
+        best = candidates[np.argmin(self.exact[candidates])]
+        return int(best), float(self.exact[best])
+
+
+class _LayerEntry:
+    def __init__(self, gdf, version, projected, note, coords=None, bounds=None, rep=None):
+        self.ref = weakref.ref(gdf)
+        self.version = version
+        self._projected = projected
+        self.note = note
+        self.coords = coords  # (n, 2) metres for point layers, else None
+        self.bounds = bounds  # (n, 4) metric bounding boxes for bounded layers, else None
+        self.rep = rep  # (n, 2) metric representative points for bounded layers, else None
+        self.index = gdf.index
+        self.geometries = np.asarray(gdf.geometry.values)
+        self.point_index = None
+        self.strtree = None
+        self.derived = {}
+        self._centroids = None
+        self._rows = None  # Per-row projection cache when the full projection was never needed
+        self.centers = OrderedDict()  # (lon, lat) -> _CenterDistances
+
+    @property
+    def projected(self):
+        if self._projected is None:
+            if self.coords is not None:
+                geometries = gpd.points_from_xy(self.coords[:, 0], self.coords[:, 1])
+            else:
+                geometries = project_geometries(self.geometries)
+            self._projected = gpd.GeoSeries(geometries, index=self.index, crs=METRIC_CRS)
+        return self._projected
+
+    def project_rows(self, positions):
+        """Metric geometries of some rows, projecting only those not projected yet."""
+        if self._projected is not None:
+            return np.asarray(self._projected.values)[positions]
+        if self._rows is None:
+            self._rows = np.full(len(self.geometries), None, dtype=object)
+        missing = positions[pd.isna(self._rows[positions])]
+        if len(missing):
+            self._rows[missing] = project_geometries(self.geometries[missing])
+        return self._rows[positions]
+
+    def metric_coords(self):
+        """(n, 2) metres: the points themselves, representative points, or centroids."""
+        if self.coords is not None:
+            return self.coords
+        if self.rep is not None:
+            return self.rep
+        if self._centroids is None:
+            centroids = self.projected.centroid
+            self._centroids = np.column_stack([centroids.x.to_numpy(), centroids.y.to_numpy()])
+        return self._centroids
+
+
+class ProjectionCache:
+    """Metric projections and per-center distances, keyed by dataset identity and version."""
+
+    def __init__(self, max_layers=32, max_centers=16):
+        self.max_layers = max_layers
+        self.max_centers = max_centers
+        self._layers = OrderedDict()
+        self._aliases = {}  # id(copy) -> (weakref to the copy, its version, the source's entry), see share()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def version(gdf):
+        """Changes whenever rows, the geometry column or the CRS of gdf change."""
+        return (len(gdf), id(gdf.geometry.values), str(gdf.crs))
+
+    def _entry(self, gdf):
+        key = id(gdf)
+        version = self.version(gdf)
+        with self._lock:
+            alias = self._aliases.get(key)
+            if alias is not None and alias[0]() is gdf and alias[1] == version:
+                return alias[2]
+            entry = self._layers.get(key)
+            if entry is not None and entry.ref() is gdf and entry.version == version:
+                self._layers.move_to_end(key)
+                return entry
+
+            if has_metric_points(gdf):
+                # Point layers standardized at ingestion: metres are already on the rows
+                coords = np.column_stack([gdf["utm_x"].to_numpy(float), gdf["utm_y"].to_numpy(float)])
+                entry = _LayerEntry(gdf, version, None, None, coords)
+            elif has_bounds(gdf) and gdf.crs is not None and gdf.crs.equals(WGS84):
+                # Lines/polygons standardized at ingestion: project rows lazily, only when the bounds cannot decide
+                bounds = gdf[BBOX_COLUMNS].to_numpy(float)
+                rep = np.column_stack([gdf["utm_x"].to_numpy(float), gdf["utm_y"].to_numpy(float)])
+                entry = _LayerEntry(gdf, version, None, None, bounds=bounds, rep=rep)
+            else:
+                geometry, note = gdf.geometry, None
+                if gdf.crs is None:
+                    geometry = geometry.set_crs(WGS84)
+                    note = "had no CRS; assumed EPSG:4326"
+                entry = _LayerEntry(gdf, version, geometry.to_crs(METRIC_CRS), note)
+            self._layers[key] = entry
+            while len(self._layers) > self.max_layers:
+                self._layers.popitem(last=False)
+            return entry
+
+    def share(self, gdf):
+        """
+        A shallow copy of gdf (pandas copies on write, so changes to it never reach
+        gdf) that uses gdf's projections, indexes and derived memos for as long as
+        its rows and geometry are unchanged. One loaded layer can then serve every
+        query, each adding columns to its own copy. Frames without geometry are only copied.
+        """
+        copy = gdf.copy(deep=False)
+        if not isinstance(gdf, gpd.GeoDataFrame) or gdf._geometry_column_name not in gdf.columns:
+            return copy
+        entry = self._entry(gdf)
+        key = id(copy)
+
+        def forget(ref):
+            with self._lock:
+                if self._aliases.get(key, (None,))[0] is ref:
+                    del self._aliases[key]
+
+        with self._lock:
+            self._aliases[key] = (weakref.ref(copy, forget), self.version(copy), entry)
+        return copy
+
+    def seed(self, gdf, projected):
+        """Registers an already computed METRIC_CRS projection of gdf's geometry (at ingestion)."""
+        entry = self._entry(gdf)
+        with self._lock:
+            if entry._projected is None and entry.coords is None:
+                entry._projected = gpd.GeoSeries(projected, index=gdf.index, crs=METRIC_CRS)
+
+    def projected(self, gdf):
+        """gdf's geometry in METRIC_CRS (projected once per dataset version)."""
+        return self._entry(gdf).projected
+
+    def note(self, gdf):
+        """Any assumption made while projecting gdf (e.g. a missing CRS), else None."""
+        return self._entry(gdf).note
+
+    def metric_coords(self, gdf):
+        """(n, 2) METRIC_CRS coordinates of gdf's points (centroids for other geometries)."""
+        return self._entry(gdf).metric_coords()
+
+    def point_index(self, gdf):
+        """PointIndex over gdf, built on first use and kept for the dataset version."""
+        entry = self._entry(gdf)
+        with self._lock:
+            if entry.point_index is None:
+                entry.point_index = PointIndex(entry.metric_coords())
+            return entry.point_index
+
+    def _strtree(self, entry):
+        with self._lock:
+            if entry.strtree is None:
+                entry.strtree = shapely.STRtree(np.asarray(entry.projected.values))
+            return entry.strtree
+
+    def derived(self, gdf, name, build):
+        """Memoizes build() for this dataset version (e.g. a raster built from the layer)."""
+        entry = self._entry(gdf)
+        with self._lock:
+            if name not in entry.derived:
+                entry.derived[name] = build()
+            return entry.derived[name]
+
+    def nearest_positions(self, gdf, coords):
+        """Layer position of the feature nearest to each (x, y) METRIC_CRS coordinate (true geometry distance)."""
+        tree = self._strtree(self._entry(gdf))
+        probes, nearest = tree.query_nearest(shapely.points(np.asarray(coords, dtype=float).reshape(-1, 2)), all_matches=False)
+        positions = np.full(len(coords), -1, dtype=np.intp)
+        positions[probes] = nearest
+        return positions
+
+    def multi_center(self, gdf, center_points, radii_km):
+        """
+        Membership of gdf's features in several circles at once: one spatial-index
+        query for all centers (EPSG:4326 points) with one radius each (or a shared
+        radius), using true geometry distances. Returns a CenterMembership.
+        """
+        entry = self._entry(gdf)
+        tree = self._strtree(entry)
+        xy = np.array([project_point(center) for center in center_points], dtype=float).reshape(-1, 2)
+        radii_m = np.broadcast_to(np.asarray(radii_km, dtype=float) * 1000, (len(xy),))
+        centers = shapely.points(xy)
+
+        center_idx, features = tree.query(centers, predicate="dwithin", distance=radii_m)
+        if entry.coords is not None:
+            distances = np.hypot(entry.coords[features, 0] - xy[center_idx, 0], entry.coords[features, 1] - xy[center_idx, 1])
+        else:
+            distances = shapely.distance(tree.geometries[features], centers[center_idx])
+        return CenterMembership(features, center_idx, distances, len(xy))
+
+    def _center(self, gdf, center_point):
+        entry = self._entry(gdf)
+        key = (round(center_point.x, 7), round(center_point.y, 7))
+        with self._lock:
+            cached = entry.centers.get(key)
+            if cached is not None:
+                entry.centers.move_to_end(key)
+                return cached
+
+        cached = _CenterDistances(entry, *project_point(center_point))
+        with self._lock:
+            entry.centers[key] = cached
+            while len(entry.centers) > self.max_centers:
+                entry.centers.popitem(last=False)
+        return cached
+
+    def distances(self, gdf, center_point):
+        """Metres from each feature of gdf to center_point (EPSG:4326), as a numpy array."""
+        return self._center(gdf, center_point).full()
+
+    def indices_within(self, gdf, center_point, radius_km):
+        """Ascending positional indices of the features within radius_km of center_point."""
+        return self._center(gdf, center_point).within(radius_km * 1000)
+
+    def nearest(self, gdf, center_point):
+        """(position, metres) of the feature nearest to center_point; (-1, nan) if there is none."""
+        return self._center(gdf, center_point).nearest()
+
+
+projection_cache = ProjectionCache()
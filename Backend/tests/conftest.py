@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+# Backend modules import each other as top-level modules (from spatial import ...)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def data_env(tmp_path, monkeypatch):
+    """Isolated data and cache dirs with one small CSV to upload."""
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    (data_dir / "stops.csv").write_text("NOM,LATITUD,LONGITUD\nClot,41.409,2.187\n")
+    monkeypatch.setenv("CITYTALK_DATA_DIR", str(data_dir))
+    monkeypatch.setenv("CITYTALK_CACHE_DIR", str(tmp_path / "cache"))
+    return data_dir
+
+
+@pytest.fixture
+def fake_api(data_env, monkeypatch):
+    """
+    Starts the fake Assistants API and points the OpenAI client at it.
+    Returns start(**options) -> state; options go to FakeAssistantsState.
+    """
+    from fake_assistants import start_fake_server
+
+    servers = []
+
+    def start(**options):
+        server, state, base_url = start_fake_server(**options)
+        servers.append(server)
+        monkeypatch.setenv("OPENAI_BASE_URL", base_url)
+        return state
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
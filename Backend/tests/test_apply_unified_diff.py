@@ -0,0 +1,75 @@
+"""apply_unified_diff on model-style diffs: wrong line numbers, insertions, several hunks, mismatches."""
+import pytest
+
+from mainAgentUtils import apply_unified_diff
+
+CODE = "\n".join([
+    "import pandas as pd",
+    "",
+    "radius_km = 0.5",
+    "stations = filter_by_distance(bicing, center, radius_km)",
+    "print(len(stations))",
+    "",
+    "radius_km = 0.5",
+    "parks = filter_by_distance(parks, center, radius_km)",
+    "print(len(parks))",
+    "results.to_csv('results.csv', index=False)",
+])
+
+
+def test_a_hunk_with_a_shifted_header_still_applies():
+    # The header says line 2; the lines are at 4-5
+    diff = (
+        "--- a/script.py\n"
+        "+++ b/script.py\n"
+        "@@ -2,2 +2,2 @@\n"
+        " stations = filter_by_distance(bicing, center, radius_km)\n"
+        "-print(len(stations))\n"
+        "+print(f'{len(stations)} stations')\n"
+    )
+    patched = apply_unified_diff(CODE, diff).split("\n")
+    assert patched[4] == "print(f'{len(stations)} stations')"
+    assert patched[8] == "print(len(parks))"
+    assert len(patched) == len(CODE.split("\n"))
+
+
+def test_a_pure_insertion_goes_after_the_stated_line():
+    # -3,0: nothing removed, the new lines follow line 3
+    diff = "@@ -3,0 +4,2 @@\n+center = Point(2.17, 41.39)\n+print(center)\n"
+    patched = apply_unified_diff(CODE, diff).split("\n")
+    assert patched[2:6] == [
+        "radius_km = 0.5",
+        "center = Point(2.17, 41.39)",
+        "print(center)",
+        "stations = filter_by_distance(bicing, center, radius_km)",
+    ]
+
+
+def test_later_hunks_are_located_after_the_earlier_ones_shifted_the_code():
+    # "radius_km = 0.5" appears twice: the second hunk means the one at line 7, now line 9
+    diff = (
+        "```diff\n"
+        "@@ -1,1 +1,3 @@\n"
+        " import pandas as pd\n"
+        "+import geopandas as gpd\n"
+        "+from shapely.geometry import Point\n"
+        "@@ -7,1 +9,1 @@\n"
+        "-radius_km = 0.5\n"
+        "+radius_km = 1.0\n"
+        "```\n"
+    )
+    patched = apply_unified_diff(CODE, diff).split("\n")
+    assert patched[1:3] == ["import geopandas as gpd", "from shapely.geometry import Point"]
+    assert patched[4] == "radius_km = 0.5"
+    assert patched[8] == "radius_km = 1.0"
+
+
+def test_a_hunk_that_does_not_match_raises():
+    diff = "@@ -3,1 +3,1 @@\n-radius_km = 5\n+radius_km = 1.0\n"
+    with pytest.raises(ValueError, match="line 3 does not match"):
+        apply_unified_diff(CODE, diff)
+
+
+def test_text_without_hunks_raises():
+    with pytest.raises(ValueError, match="No hunks"):
+        apply_unified_diff(CODE, "I changed the radius to 1 km.")
@@ -0,0 +1,46 @@
+"""sync_files against the fake Assistants API: what counts as a missing upload, and what gets deleted."""
+import pytest
+from openai import OpenAI
+
+from assistant_manifest import UploadManifest, sync_files
+
+
+@pytest.fixture
+def synced(fake_api, data_env, tmp_path):
+    state = fake_api()
+    client = OpenAI(api_key="test-key")
+    manifest = UploadManifest(str(tmp_path / "manifest.json"))
+    first = sync_files(client, str(data_env), manifest)
+    return state, client, manifest, first
+
+
+def test_an_upload_deleted_remotely_is_replaced(synced, data_env):
+    state, client, manifest, first = synced
+    state.files.pop(first["stops.csv"])
+
+    second = sync_files(client, str(data_env), manifest)
+    assert second["stops.csv"] != first["stops.csv"]
+    assert list(state.files) == [second["stops.csv"]]
+
+
+def test_a_replaced_upload_is_deleted(synced, data_env, monkeypatch):
+    state, client, manifest, first = synced
+    # The API says the file is gone, but it is still there: the re-upload must not leave it behind
+    monkeypatch.setattr("assistant_manifest._file_exists", lambda client, file_id: False)
+
+    second = sync_files(client, str(data_env), manifest)
+    assert list(state.files) == [second["stops.csv"]]
+    assert [entry["file_id"] for entry in manifest.files.values()] == [second["stops.csv"]]
+
+
+def test_errors_other_than_not_found_are_raised(synced, data_env, monkeypatch):
+    state, client, manifest, first = synced
+
+    def unreachable(file_id):
+        raise ConnectionError("network is down")
+
+    monkeypatch.setattr(client.files, "retrieve", unreachable)
+    with pytest.raises(ConnectionError):
+        sync_files(client, str(data_env), manifest)
+    assert list(state.files) == [first["stops.csv"]]  # Nothing re-uploaded or deleted
+    assert [entry["file_id"] for entry in manifest.files.values()] == [first["stops.csv"]]
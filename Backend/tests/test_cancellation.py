@@ -0,0 +1,179 @@
+"""CancelToken callbacks under concurrent cancels, abort_on_cancel, and Deadline cancellation."""
+import sys
+import threading
+import time
+
+import pytest
+
+from cancellation import CancelToken, Cancelled, abort_on_cancel
+from deadline import Deadline
+
+GENERATED = "<generated>"
+BUSY_LOOP_SOURCE = (
+    "n = 0\n"
+    "while True:\n"
+    "    try:\n"
+    "        n += 1\n"
+    "    except Exception:\n"
+    "        pass\n"
+)
+BUSY_LOOP = compile(BUSY_LOOP_SOURCE, GENERATED, "exec")
+
+
+def test_callbacks_run_once_when_many_threads_cancel():
+    token = CancelToken()
+    calls = []
+    token.on_cancel(calls.append)
+    barrier = threading.Barrier(16)
+    results = []
+
+    def cancel(i):
+        barrier.wait()
+        results.append(token.cancel(f"reason {i}"))
+
+    threads = [threading.Thread(target=cancel, args=(i,)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results.count(True) == 1
+    assert calls == [token.reason]
+
+
+def test_on_cancel_after_cancel_runs_immediately():
+    token = CancelToken()
+    token.cancel("gone")
+    calls = []
+    unregister = token.on_cancel(calls.append)
+    assert calls == ["gone"]
+    unregister()  # A no-op, but still callable
+
+
+def test_unregistered_callbacks_do_not_run_and_failures_do_not_stop_others():
+    token = CancelToken()
+    calls = []
+    unregister = token.on_cancel(lambda reason: calls.append("removed"))
+    token.on_cancel(lambda reason: 1 / 0)
+    token.on_cancel(lambda reason: calls.append("kept"))
+    unregister()
+
+    token.cancel()
+    assert calls == ["kept"]
+    with pytest.raises(Cancelled):
+        token.raise_if_cancelled()
+
+
+def run_in_thread(target):
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    time.sleep(0.1)
+    assert thread.is_alive()
+    return thread
+
+
+def test_abort_on_cancel_interrupts_a_loop_that_catches_exceptions():
+    token = CancelToken()
+    outcome = {}
+
+    def run():
+        try:
+            with abort_on_cancel(token):
+                outcome["tracer"] = sys.gettrace()
+                exec(BUSY_LOOP, {})
+        except Cancelled as e:
+            outcome["reason"] = str(e)
+
+    thread = run_in_thread(run)
+    token.cancel("client disconnected")
+    thread.join(2)
+
+    assert not thread.is_alive()
+    assert outcome == {"tracer": sys.gettrace(), "reason": "client disconnected"}  # No tracer of its own
+
+
+def test_abort_on_cancel_leaves_finished_work_alone():
+    token = CancelToken()
+    scope = {}
+    with abort_on_cancel(token):
+        exec(compile("total = sum(range(10))", GENERATED, "exec"), scope)
+    assert scope["total"] == 45
+
+    # Cancelling afterwards does not reach the thread any more
+    token.cancel()
+    time.sleep(0.05)
+    assert scope["total"] == 45
+
+
+def test_abort_on_cancel_refuses_to_start_cancelled_work():
+    token = CancelToken()
+    token.cancel("gone")
+    with pytest.raises(Cancelled):
+        with abort_on_cancel(token):
+            pytest.fail("the block must not run")
+
+
+def test_agent_exec_entry_points_return_a_cancelled_result():
+    from MainAgent import MainAgent
+
+    agent = MainAgent("test-key")
+    results = {}
+    for name, call in [
+        ("execute_code", lambda code: agent.execute_code(code, {})),
+        ("execute_code_with_retry", lambda code: agent.execute_code_with_retry(code, {})),
+    ]:
+        agent.current_deadline = Deadline(60)
+        thread = run_in_thread(lambda: results.setdefault(name, call(BUSY_LOOP_SOURCE)))
+        agent.current_deadline.cancel("client disconnected")
+        thread.join(2)
+        assert not thread.is_alive(), name
+
+    for name, result in results.items():
+        assert result["status"] == "cancelled", name
+        assert result["message"] == "Analysis cancelled: client disconnected"
+        assert result["executed_code"] == BUSY_LOOP_SOURCE
+
+
+def test_unbounded_questions_run_without_the_guard(monkeypatch):
+    import MainAgent as main_agent
+
+    def guard(token):
+        raise AssertionError("abort_on_cancel armed for an unbounded deadline")
+
+    monkeypatch.setattr(main_agent, "abort_on_cancel", guard)
+    agent = main_agent.MainAgent("test-key")
+    scope = {}
+    agent._exec_generated("total = 1 + 1", scope)
+    assert scope["total"] == 2
+
+
+def test_cancelled_deadline_reads_as_expired_and_records_why():
+    deadline = Deadline(60)
+    fired = []
+    deadline.cancel_token.on_cancel(fired.append)
+    assert not deadline.expired()
+
+    deadline.cancel("client disconnected")
+    deadline.cancel("stream timed out")  # The first reason wins
+
+    assert deadline.cancelled and deadline.expired()
+    assert deadline.remaining() == 0
+    assert fired == ["client disconnected"]
+    assert deadline.stop_reason == "cancelled: client disconnected"
+
+
+def test_a_stage_stopping_on_the_cancel_does_not_hide_its_reason():
+    deadline = Deadline(60)
+    # Runs after the token reads as cancelled but before cancel() records why, like a stream loop would
+    deadline.cancel_token.on_cancel(lambda reason: deadline.stop("assistant_run", "deadline reached"))
+
+    deadline.cancel("client disconnected")
+    assert deadline.stop_reason == "cancelled: client disconnected"
+    assert [stage["stage"] for stage in deadline.stages] == ["assistant_run", "cancelled"]
+
+
+def test_unbounded_deadline_can_still_be_cancelled():
+    deadline = Deadline(None)
+    assert deadline.remaining() == float("inf")
+    deadline.cancel("gone")
+    assert deadline.expired()
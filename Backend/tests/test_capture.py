@@ -0,0 +1,55 @@
+"""BoundedOutput caps in UTF-8 bytes, and the helpers' output lands in the buffer capturing the script."""
+import threading
+
+import geopandas as gpd
+from shapely.geometry import Point
+
+from capture import BoundedOutput, echo
+from spatial import WGS84, standardize_layer
+
+
+def test_caps_count_encoded_bytes_not_characters():
+    output = BoundedOutput(head_bytes=16, tail_bytes=16)
+    for _ in range(50):
+        output.print("NO2 35-40 µg/m³ 🚲")  # 17 characters, 23 bytes
+
+    head, tail = output.getvalue().split(" bytes truncated] ...\n")
+    head = head.split("\n... [")[0]
+    assert len(head.encode()) <= 16 and len(tail.encode()) <= 16
+    assert output.total_bytes == 50 * len("NO2 35-40 µg/m³ 🚲\n".encode())
+    assert output.truncated_bytes == output.total_bytes - len(head.encode()) - len(tail.encode())
+
+
+def test_truncation_never_splits_a_character():
+    output = BoundedOutput(head_bytes=3, tail_bytes=5)
+    output.write("🚲")  # 4 bytes: does not fit the head, and the head stays closed after it
+    output.write("ab")
+    output.write("µ")
+    assert output.getvalue() == "\n... [4 bytes truncated] ...\nabµ"
+    assert output.excerpt(4) == "a\n... [4 bytes omitted] ...\nbµ"
+
+
+def test_helpers_echo_into_the_buffer_capturing_their_thread(capsys):
+    output = BoundedOutput()
+    with output.capturing():
+        echo("inside")
+        other = threading.Thread(target=echo, args=("other thread",))
+        other.start()
+        other.join()
+    echo("after")
+
+    assert output.getvalue() == "inside\n"
+    assert capsys.readouterr().out == "other thread\nafter\n"
+
+
+def test_agent_helper_notes_reach_the_captured_output(capsys):
+    from MainAgent import MainAgent
+
+    agent = MainAgent("test-key")
+    stations = standardize_layer(gpd.GeoDataFrame({"name": ["Far"]}, geometry=[Point(2.30, 41.50)], crs=WGS84))
+    output = BoundedOutput()
+    with output.capturing():
+        agent.filter_by_distance_with_fallback(stations, Point(2.17, 41.39), max_distance_km=1.0)
+
+    assert "No results within 1.0km, trying 2.0km" in output.getvalue()
+    assert "No results within" not in capsys.readouterr().out
@@ -0,0 +1,120 @@
+"""DeltaEncoder frames decoded the way the web client (src/App.js) applies them."""
+import threading
+import time
+
+from deltastream import DeltaEncoder, text_length
+
+
+class Client:
+    """The client's rules: append a delta only in sequence and at the text's end, else wait for a snapshot."""
+
+    def __init__(self):
+        self.units = []  # UTF-16 code units, so lengths compare like JavaScript's string length
+        self.last_seq = 0
+        self.out_of_sync = False
+
+    @property
+    def text(self):
+        return b"".join(self.units).decode("utf-16-le")
+
+    def apply(self, frame):
+        if frame["type"] == "snapshot":
+            self.units = self._units(frame["content"])
+            self.out_of_sync = False
+        elif not self.out_of_sync and frame.get("first_seq", frame["seq"]) == self.last_seq + 1 \
+                and frame["offset"] == len(self.units):
+            self.units += self._units(frame["delta"])
+        else:
+            self.out_of_sync = True
+            return
+        self.last_seq = frame["seq"]
+
+    @staticmethod
+    def _units(text):
+        data = text.encode("utf-16-le")
+        return [data[i:i + 2] for i in range(0, len(data), 2)]
+
+
+def encode(chunks, **options):
+    frames = []
+    encoder = DeltaEncoder(frames.append, flush_interval_s=60, **options)
+    for chunk in chunks:
+        encoder.append(chunk)
+        encoder.flush()
+    return encoder, frames
+
+
+def test_deltas_rebuild_the_answer_and_snapshots_stay_linear():
+    chunks = [f"token {i} " for i in range(2000)]
+    encoder, frames = encode(chunks, first_snapshot_chars=64)
+
+    client = Client()
+    for frame in frames:
+        client.apply(frame)
+    answer = "".join(chunks)
+    assert client.text == encoder.text() == answer
+
+    snapshots = [f for f in frames if f["type"] == "snapshot"]
+    assert sum(len(s["content"]) for s in snapshots) <= 2 * len(answer)
+    assert len(snapshots) <= 12  # The text doubles between snapshots
+    assert [f["seq"] for f in frames if f["type"] == "delta"] == list(range(1, len(chunks) + 1))
+
+
+def test_offsets_count_utf16_units_so_emoji_keep_the_client_in_sync():
+    chunks = ["Bicing 🚲 ", "near Clot: ", "NO₂ 35-40 µg/m³ ", "🌳 parks"]
+    _, frames = encode(chunks, first_snapshot_chars=10_000)  # No snapshot to fall back on
+
+    client = Client()
+    for frame in frames:
+        client.apply(frame)
+    assert not client.out_of_sync
+    assert client.text == "".join(chunks)
+    assert frames[1]["offset"] == text_length("Bicing 🚲 ") == len("Bicing 🚲 ") + 1
+
+
+def test_a_missed_delta_is_repaired_by_the_next_snapshot():
+    chunks = ["a" * 10 for _ in range(20)]
+    _, frames = encode(chunks, first_snapshot_chars=50)
+
+    client = Client()
+    lost = next(f for f in frames if f["type"] == "delta" and f["seq"] == 2)
+    for frame in frames:
+        if frame is lost:
+            continue
+        client.apply(frame)
+        if frame["seq"] == 3 and frame["type"] == "delta":
+            assert client.out_of_sync and client.text == "a" * 10
+    assert not client.out_of_sync
+    assert client.text == "a" * 200
+
+
+def test_chunks_within_the_flush_interval_go_out_as_one_frame():
+    frames = []
+    encoder = DeltaEncoder(frames.append, flush_interval_s=0.05)
+    for word in ["one ", "two ", "three"]:
+        encoder.append(word)
+    encoder.append("")  # Ignored
+    assert encoder.started and frames == []
+
+    deadline = time.monotonic() + 2
+    while not frames and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert frames == [{"type": "delta", "seq": 1, "offset": 0, "delta": "one two three"}]
+    encoder.flush()  # Nothing pending: no frame
+    assert len(frames) == 1
+
+
+def test_concurrent_appends_lose_nothing():
+    frames = []
+    encoder = DeltaEncoder(frames.append, flush_interval_s=0.001, first_snapshot_chars=10 ** 9)
+    writers = [threading.Thread(target=lambda: [encoder.append("x") for _ in range(500)]) for _ in range(4)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    encoder.flush()
+
+    client = Client()
+    for frame in frames:
+        client.apply(frame)
+    assert client.text == "x" * 2000
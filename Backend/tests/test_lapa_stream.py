@@ -0,0 +1,175 @@
+"""UrbanDataAssistant against the fake Assistants API: streamed runs, the polling fallback, API volume."""
+import threading
+
+import pytest
+
+from deadline import Deadline
+from lapa import RUN_POLL_INITIAL_S, RUN_POLL_MAX_S, UrbanDataAssistant
+
+
+def ready_assistant():
+    assistant = UrbanDataAssistant("fake-key")
+    assert assistant.setup_assistant()
+    return assistant
+
+
+def calls_since(state, start):
+    return [(method, path.split("/")[-1] if path.count("/") > 3 else path) for method, path in state.requests[start:]]
+
+
+def retrieve_gaps(state, start):
+    """Seconds between consecutive run retrieve (poll) requests after index start."""
+    times = [t for (method, path), t in zip(state.requests[start:], state.request_times[start:])
+             if method == "GET" and "/runs/" in path]
+    return [b - a for a, b in zip(times, times[1:])], len(times)
+
+
+def test_streamed_run_completes_from_events(fake_api):
+    state = fake_api(token_delay_s=0.001)
+    assistant = ready_assistant()
+
+    events = []
+    result = assistant.process_query_streaming("bicing near Clot", on_event=events.append, session_key="s1")
+
+    assert result["success"], result
+    assert result["response"] == "You asked: bicing near Clot"
+    assert "".join(e["delta"] for e in events if e["type"] == "text") == result["response"]
+    assert [run["status"] for run in state.runs.values()] == ["completed"]
+
+
+def test_query_request_counts(fake_api):
+    state = fake_api(token_delay_s=0.001)
+    assistant = ready_assistant()
+
+    start = len(state.requests)
+    result = assistant.process_query_simple("first question", session_key="s1")
+    assert result["success"] and result["response"] == "You asked: first question"
+    # Thread, message, streamed run: no polling and no message listing
+    assert [method for method, _ in state.requests[start:]] == ["POST", "POST", "POST"]
+    assert state.requests[start][1] == "/v1/threads"
+
+    start = len(state.requests)
+    assert assistant.process_query_simple("second question", session_key="s1")["success"]
+    # The session's thread is reused: message and streamed run only
+    assert len(state.requests) - start == 2
+
+    start = len(state.requests)
+    assert assistant.process_query_simple("other session", session_key="s2")["success"]
+    assert len(state.requests) - start == 3  # A second session gets its own thread
+
+
+def test_polling_fallback_follows_the_poll_hint(fake_api):
+    state = fake_api(stream_error_status=400, run_s=1.0, poll_after_ms=250)
+    assistant = ready_assistant()
+
+    start = len(state.requests)
+    result = assistant.process_query_simple("polled question", session_key="s1")
+
+    assert result["success"], result
+    assert result["response"] == "You asked: polled question"
+    gaps, polls = retrieve_gaps(state, start)
+    assert 3 <= polls <= 6
+    assert all(0.2 <= gap <= 0.4 for gap in gaps), gaps
+
+
+def test_polling_fallback_backs_off_without_a_hint(fake_api):
+    # Queued until 1 s, in_progress until 3 s: the interval grows while the status does not change
+    state = fake_api(stream_error_status=400, run_s=3.0, poll_after_ms=None)
+    assistant = ready_assistant()
+
+    start = len(state.requests)
+    result = assistant.process_query_simple("slow question", session_key="s1")
+
+    assert result["success"], result
+    gaps, polls = retrieve_gaps(state, start)
+    assert polls <= 12  # A fixed 0.2 s interval would need about 15
+    # Exactly one reset (the move to in_progress), wherever the poll timing puts it
+    resets = [i for i in range(1, len(gaps)) if gaps[i] < gaps[i - 1]]
+    assert len(resets) == 1, gaps
+    reset = resets[0]
+    assert reset >= 2, gaps  # Still queued: backed off at least once first
+    assert all(b > a * 1.2 for a, b in zip(gaps[:reset], gaps[1:reset])), gaps
+    assert all(b > a * 1.2 or b >= RUN_POLL_MAX_S for a, b in zip(gaps[reset:], gaps[reset + 1:])), gaps
+    assert gaps[reset] < RUN_POLL_INITIAL_S * 1.5, gaps  # Back to the initial interval
+    assert all(gap >= RUN_POLL_INITIAL_S * 0.8 for gap in gaps)
+    assert max(gaps) <= RUN_POLL_MAX_S + 0.2
+
+
+def test_polling_fallback_cancels_a_run_past_the_deadline(fake_api):
+    state = fake_api(stream_error_status=400, run_s=30.0, poll_after_ms=None)
+    assistant = ready_assistant()
+
+    result = assistant.process_query_simple("too slow", deadline=Deadline(1.0), session_key="s1")
+
+    assert not result["success"]
+    assert "timed out" in result["error"]
+    assert [run["status"] for run in state.runs.values()] == ["cancelling"]
+
+
+def test_cancelling_the_deadline_cancels_a_streamed_run(fake_api):
+    state = fake_api(token_delay_s=0.2)
+    assistant = ready_assistant()
+    deadline = Deadline(30)
+
+    def cancel_on_first_text(event):
+        if event["type"] == "text":
+            threading.Thread(target=deadline.cancel, args=("client disconnected",)).start()
+
+    result = assistant.process_query_streaming("a long answer with many words", on_event=cancel_on_first_text,
+                                               deadline=deadline, session_key="s1")
+
+    assert not result["success"]
+    assert deadline.stop_reason == "cancelled: client disconnected"
+    assert [run["status"] for run in state.runs.values()] in (["cancelling"], ["cancelled"])
+    assert ("POST", f"/v1/threads/{next(iter(state.runs.values()))['thread_id']}/runs/"
+            f"{next(iter(state.runs))}/cancel") in state.requests
+
+
+def test_shared_answers_reach_the_joiner_thread_with_its_next_question(fake_api):
+    state = fake_api(token_delay_s=0.001)
+    assistant = ready_assistant()
+
+    start = len(state.requests)
+    assistant.threads.expect_history("joiner")
+    assert assistant.threads.has_conversation("joiner")
+    assistant.add_exchange("joiner", "parks in Gracia", "You asked: parks in Gracia")
+    assert len(state.requests) == start  # Recorded in memory only
+    assert assistant.threads.has_conversation("joiner")
+
+    result = assistant.process_query_simple("and near Clot?", session_key="joiner")
+    assert result["success"], result
+    # Same three calls as any first question: the history rides along with the thread
+    assert [method for method, _ in state.requests[start:]] == ["POST", "POST", "POST"]
+    thread = next(messages for messages in state.threads.values() if len(messages) == 4)
+    assert [(m["role"], m["content"][0]["text"]["value"]) for m in thread] == [
+        ("user", "parks in Gracia"),
+        ("assistant", "You asked: parks in Gracia"),
+        ("user", "and near Clot?"),
+        ("assistant", "You asked: and near Clot?"),
+    ]
+
+
+def test_history_recorded_after_the_thread_exists_is_posted_before_the_next_question(fake_api):
+    state = fake_api(token_delay_s=0.001)
+    assistant = ready_assistant()
+    assert assistant.process_query_simple("first", session_key="s1")["success"]
+
+    assistant.add_exchange("s1", "shared question", "shared answer")
+    assert assistant.process_query_simple("follow-up", session_key="s1")["success"]
+
+    (thread,) = state.threads.values()
+    assert [m["content"][0]["text"]["value"] for m in thread] == [
+        "first", "You asked: first", "shared question", "shared answer", "follow-up", "You asked: follow-up",
+    ]
+
+
+def test_busy_run_slots_report_the_wait_that_was_applied(fake_api):
+    fake_api(token_delay_s=0.001)
+    assistant = UrbanDataAssistant("fake-key", max_concurrent_runs=1)
+    assert assistant.setup_assistant()
+    assistant.run_slots.acquire()  # Another question holds the only slot
+    deadline = Deadline(1.5)
+
+    result = assistant.process_query_simple("parks in Gracia", deadline=deadline, session_key="s1")
+    assert not result["success"]
+    assert deadline.stop_reason == "assistant_run: all 1 run slots busy for 1s"
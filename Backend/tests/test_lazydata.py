@@ -0,0 +1,77 @@
+"""Lazy dataset handles from DataCollectorAgent.fetch_data: unused layers are never loaded."""
+import pytest
+
+from DataCollect03 import DataCollectorAgent
+from DataReader import DataReaderAgent
+from deadline import Deadline
+from lazydata import LazyDataset, referenced_names
+
+POLLUTION_CSV = (
+    "TRAM,Rang,geometry_wkt\n"
+    'T1,20-25 µg/m³,"LINESTRING (2.164 41.427, 2.165 41.428)"\n'
+    'T2,35-40 µg/m³,"LINESTRING (2.197 41.404, 2.198 41.405)"\n'
+)
+BICING_CSV = "station_id,name,lat,lon\n1,Gran Via,41.3979,2.1801\n2,Roger de Flor,41.3954,2.1771\n"
+DATASETS = [
+    {"name": "Air Pollution Levels", "source": "other", "tag": "air_pollution_levels"},
+    {"name": "Bike Stations", "source": "other", "tag": "bicing"},
+]
+
+
+@pytest.fixture
+def collector(tmp_path):
+    (tmp_path / "air_pollution_levels.csv").write_text(POLLUTION_CSV, encoding="utf-8")
+    (tmp_path / "bicingstations.csv").write_text(BICING_CSV)  # The layer's earlier file name
+    return DataCollectorAgent("test-key", data_dir=str(tmp_path))
+
+
+def test_fetch_data_returns_unloaded_handles_by_default(collector):
+    all_data, csv_dirs = collector.fetch_data(DATASETS, {})
+
+    assert set(all_data) == {"air_pollution_levels", "bicing"}
+    assert all(isinstance(d, LazyDataset) and not d.is_loaded for d in all_data.values())
+    assert csv_dirs["bicing"].endswith("bicingstations.csv")
+    # Columns are known without loading the rows
+    assert all_data["bicing"].peek_columns()[:2] == ["station_id", "name"]
+    assert not all_data["bicing"].is_loaded
+
+
+def test_an_unreferenced_dataset_is_never_loaded(collector):
+    from MainAgent import MainAgent
+
+    all_data, _ = collector.fetch_data(DATASETS, {})
+    enriched = DataReaderAgent("test-key").create_dataset_with_analysis(all_data)  # No API call for unloaded layers
+    agent = MainAgent("test-key")
+    code = "result = air_pollution_levels[air_pollution_levels['rang_mid_ugm3'] > 30]"
+
+    agent._prepare_dataset_summary(enriched)
+    exec_globals = agent._build_exec_globals(enriched, code)
+    exec(code, exec_globals)
+
+    assert exec_globals["result"]["TRAM"].tolist() == ["T2"]
+    assert all_data["air_pollution_levels"].is_loaded
+    assert "bicing" not in exec_globals
+    assert not all_data["bicing"].is_loaded
+
+
+def test_eager_fetch_loads_everything(collector):
+    all_data, _ = collector.fetch_data(DATASETS, {}, lazy=False)
+    assert len(all_data["air_pollution_levels"]) == 2
+    assert len(all_data["bicing"]) == 2
+
+
+def test_referenced_names_reads_the_code_not_strings_or_attributes():
+    candidates = ["bicing", "air_pollution_levels"]
+    assert referenced_names("x = df.bicing + 'air_pollution_levels'", candidates) == set()
+    assert referenced_names("x = bicing.head()", candidates) == {"bicing"}
+    # Unparsable code (to be corrected later) falls back to whole words
+    assert referenced_names("x = bicing.head(", candidates) == {"bicing"}
+
+
+def test_lazy_osm_layers_are_skipped_once_the_deadline_is_short(tmp_path):
+    collector = DataCollectorAgent("test-key", data_dir=str(tmp_path))
+    deadline = Deadline(5)  # Less than one Overpass round trip
+    all_data, _ = collector.fetch_data([{"name": "Park Locations", "source": "osm"}], {}, deadline)
+
+    assert all_data["Park Locations"].resolve().empty
+    assert deadline.stop_reason == "fetching: skipped OSM layer 'Park Locations'"
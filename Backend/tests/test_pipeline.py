@@ -0,0 +1,26 @@
+"""Mother.answer_question: one Deadline, created at the question entry, reaches every stage."""
+import Mother
+
+
+def test_every_stage_gets_the_question_deadline(monkeypatch):
+    seen = {}
+
+    def record(stage, result):
+        def stage_call(self, *args):
+            seen[stage] = args[-1]
+            return result
+        return stage_call
+
+    monkeypatch.setattr(Mother.AmenityAgent, "find_coordinates_for_prompt", record("geocoding", {}))
+    monkeypatch.setattr(Mother.DataLayerAgent, "identify_datasets", lambda self, query: {"datasets": []})
+    monkeypatch.setattr(Mother.DataCollectorAgent, "fetch_data", record("fetching", ({"layer": object()}, {})))
+    monkeypatch.setattr(Mother.DataReaderAgent, "create_dataset_with_analysis", record("describing", {}))
+    monkeypatch.setattr(Mother.MainAgent, "execute_question", record("execution", {"status": "success"}))
+
+    result, all_data = Mother.answer_question("parks near Clot", "test-key", budget_s=42)
+
+    assert result == {"status": "success"}
+    assert set(seen) == {"geocoding", "fetching", "describing", "execution"}
+    deadline = seen["geocoding"]
+    assert deadline.budget_s == 42
+    assert all(d is deadline for d in seen.values())
@@ -0,0 +1,67 @@
+"""Exposure rasters: subsets of the loaded layer share its raster and the cache dir holds one per version."""
+import numpy as np
+import pytest
+from shapely.geometry import Point
+
+from DataCollect03 import load_layer
+from pollution import exposure_at_coords, get_pollution_raster
+from spatial import project_point
+
+POLLUTION_CSV = (
+    "TRAM,Rang,geometry_wkt\n"
+    'T1,20-25 µg/m³,"LINESTRING (2.164 41.427, 2.165 41.428)"\n'
+    'T2,35-40 µg/m³,"LINESTRING (2.197 41.404, 2.198 41.405)"\n'
+    'T3,> 40 µg/m³,"LINESTRING (2.170 41.390, 2.171 41.391)"\n'
+)
+
+
+def rasters(cache_dir):
+    return sorted(p.name for p in cache_dir.glob("pollution_raster_*"))
+
+
+@pytest.fixture
+def layer(data_env):
+    path = data_env / "air_pollution_levels.csv"
+    path.write_text(POLLUTION_CSV, encoding="utf-8")
+    return path
+
+
+def test_filtered_subsets_sample_the_full_layers_raster(layer, data_env):
+    cache_dir = data_env.parent / "cache"
+    full = load_layer(str(layer))
+    raster = get_pollution_raster(full)
+    assert len(rasters(cache_dir)) == 2  # One .npy and its .json
+
+    for subset in [full[full["rang_mid_ugm3"] > 30], full.iloc[[2]], full.copy()]:
+        assert get_pollution_raster(subset) is raster
+    assert len(rasters(cache_dir)) == 2
+
+    # A point on T1 reads T1's band even through a subset without it
+    on_t1 = np.array([project_point(Point(2.1645, 41.4275))])
+    assert exposure_at_coords(on_t1, full.iloc[[1, 2]])[0] == pytest.approx(22.5)
+
+
+def test_unrelated_frames_are_not_written_to_the_cache_dir(layer, data_env):
+    cache_dir = data_env.parent / "cache"
+    full = load_layer(str(layer))
+    get_pollution_raster(full)
+    before = rasters(cache_dir)
+
+    rebanded = full.copy()
+    rebanded["rang_mid_ugm3"] = 10.0  # Same streets, different values
+    moved = full.copy()
+    moved["geometry"] = moved.geometry.translate(0.001, 0)
+    for edited in [rebanded, moved, full.reset_index(drop=True).iloc[::-1].reset_index(drop=True)]:
+        assert get_pollution_raster(edited) is not get_pollution_raster(full)
+    assert rasters(cache_dir) == before
+
+
+def test_a_new_version_of_the_data_replaces_the_old_raster(layer, data_env):
+    cache_dir = data_env.parent / "cache"
+    get_pollution_raster(load_layer(str(layer)))
+    before = rasters(cache_dir)
+
+    layer.write_text(POLLUTION_CSV.replace("> 40", "30-35"), encoding="utf-8")
+    get_pollution_raster(load_layer(str(layer)))
+    after = rasters(cache_dir)
+    assert len(after) == 2 and after != before
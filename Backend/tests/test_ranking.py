@@ -0,0 +1,95 @@
+"""rank_top_k against a full scan: the nearest-first scan stops early without changing the ranking."""
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import LineString, Point
+
+from pollution import exposure_at_coords
+from ranking import rank_top_k, select_top_k
+from spatial import WGS84, projection_cache, standardize_layer
+
+CENTER = Point(2.17, 41.39)
+
+
+def houses(n=4000, seed=0):
+    rng = np.random.default_rng(seed)
+    points = shapely.points(2.17 + rng.uniform(-0.03, 0.03, n), 41.39 + rng.uniform(-0.02, 0.02, n))
+    return standardize_layer(gpd.GeoDataFrame({"rent": rng.uniform(500, 1500, n)}, geometry=points, crs=WGS84))
+
+
+def emissions():
+    lines = [LineString([(2.15, 41.38 + 0.005 * i), (2.19, 41.38 + 0.005 * i)]) for i in range(5)]
+    bands = ["20-25 µg/m³", "35-40 µg/m³", "25-30 µg/m³", "> 40 µg/m³", "<=15 µg/m³"]
+    return gpd.GeoDataFrame({"Rang": bands}, geometry=lines, crs=WGS84)
+
+
+def full_scan(gdf, k, weights, emission_gdf=None):
+    """Every candidate scored, then the k lowest scores (ties by position)."""
+    scores = np.zeros(len(gdf))
+    for component, weight in weights.items():
+        if component == "distance":
+            values = projection_cache.distances(gdf, CENTER)
+        elif component == "exposure":
+            values = exposure_at_coords(projection_cache.metric_coords(gdf), emission_gdf)
+        else:
+            values = gdf[component].to_numpy(float)
+        scores += weight * values
+    order = np.lexsort((np.arange(len(gdf)), scores))[:k]
+    return order, scores[order]
+
+
+@pytest.mark.parametrize("weights", [{"distance": 1.0}, {"distance": 1.0, "rent": 0.5}])
+def test_nearest_first_scan_stops_early_with_the_full_scan_ranking(weights):
+    gdf = houses()
+    positions, scores, scanned = rank_top_k(gdf, 10, by=weights, center_point=CENTER, batch_size=100)
+
+    expected_positions, expected_scores = full_scan(gdf, 10, weights)
+    np.testing.assert_array_equal(positions, expected_positions)
+    np.testing.assert_allclose(scores, expected_scores)
+    assert scanned < len(gdf) / 4
+
+
+def test_exposure_bounds_let_the_scan_stop_too():
+    gdf, emission_gdf = houses(), emissions()
+    weights = {"distance": 1.0, "exposure": 20.0}
+    positions, scores, scanned = rank_top_k(gdf, 5, by=weights, center_point=CENTER,
+                                            emission_gdf=emission_gdf, batch_size=100)
+
+    expected_positions, expected_scores = full_scan(gdf, 5, weights, emission_gdf)
+    np.testing.assert_array_equal(positions, expected_positions)
+    np.testing.assert_allclose(scores, expected_scores)
+    assert scanned < len(gdf)
+
+
+def test_unbounded_scores_are_scanned_in_full():
+    gdf = houses(500)
+    by = {"distance": 1.0, (lambda rows: rows["rent"].to_numpy()): 1.0}  # A callable has no known floor
+    _, _, scanned = rank_top_k(gdf, 5, by=by, center_point=CENTER, batch_size=50)
+    assert scanned == len(gdf)
+
+    # So is a ranking where farther is better
+    _, _, scanned = rank_top_k(gdf, 5, by="distance", largest=True, center_point=CENTER, batch_size=50)
+    assert scanned == len(gdf)
+
+
+def test_largest_ranks_highest_first():
+    gdf = houses(300)
+    positions, scores, _ = rank_top_k(gdf, 3, by="rent", largest=True)
+    rent = gdf["rent"].to_numpy()
+    np.testing.assert_array_equal(positions, np.argsort(-rent, kind="stable")[:3])
+    np.testing.assert_allclose(scores, np.sort(rent)[::-1][:3])
+
+
+def test_select_top_k_breaks_ties_by_position_and_drops_nan():
+    scores = np.array([2.0, np.nan, 1.0, 2.0, 2.0, 1.0])
+    positions = np.array([10, 11, 12, 13, 14, 15])
+    got_positions, got_scores = select_top_k(scores, positions, 4)
+    np.testing.assert_array_equal(got_positions, [12, 15, 10, 13])
+    np.testing.assert_array_equal(got_scores, [1.0, 1.0, 2.0, 2.0])
+    assert len(select_top_k(scores, positions, 0)[0]) == 0
+
+
+def test_distance_ranking_needs_a_center():
+    with pytest.raises(ValueError, match="center_point"):
+        rank_top_k(houses(10), 3, by="distance")
@@ -0,0 +1,84 @@
+"""StreetGraph routes on a small synthetic street grid."""
+import geopandas as gpd
+import pytest
+from shapely.geometry import LineString
+
+from routing import StreetGraph, cleanest_route, street_graph
+from spatial import METRIC_CRS, WGS84
+
+X0, Y0 = 430000.3, 4581000.3  # Near Plaça de Catalunya, off the 1 m snap grid's rounding edges
+STEP = 100.0
+CLEAN, DIRTY = 20.0, 60.0
+
+
+def grid_layer(size=3, dirty=lambda a, b: False, island=False):
+    """size x size street grid; dirty(a, b) marks the segment between grid nodes a and b."""
+    lines, bands = [], []
+    for i in range(size):
+        for j in range(size):
+            for di, dj in [(1, 0), (0, 1)]:
+                if i + di < size and j + dj < size:
+                    a, b = (i, j), (i + di, j + dj)
+                    lines.append(LineString([(X0 + a[0] * STEP, Y0 + a[1] * STEP), (X0 + b[0] * STEP, Y0 + b[1] * STEP)]))
+                    bands.append(DIRTY if dirty(a, b) else CLEAN)
+    if island:
+        lines.append(LineString([(X0 + 5000, Y0), (X0 + 5050, Y0)]))
+        bands.append(CLEAN)
+    geometry = gpd.GeoSeries(lines, crs=METRIC_CRS).to_crs(WGS84)
+    return gpd.GeoDataFrame({"rang_mid_ugm3": bands}, geometry=geometry.values, crs=WGS84)
+
+
+def node(i, j):
+    return X0 + i * STEP, Y0 + j * STEP
+
+
+def test_route_between_opposite_corners_has_the_grid_distance():
+    graph = StreetGraph(grid_layer())
+    route = graph.route(node(0, 0), node(2, 2), pollution_weight=0)
+    summary = route.summary()
+    assert summary["found"] and summary["segments"] == 4
+    assert summary["length_m"] == pytest.approx(400, abs=0.5)
+    assert max(summary["snap_m"]) < 0.01
+
+
+def test_pollution_weight_trades_distance_for_cleaner_air():
+    # The bottom row and right column are dirty: the clean way round goes up the left and along the top
+    dirty = lambda a, b: a[1] == b[1] == 0 or a[0] == b[0] == 2
+    graph = StreetGraph(grid_layer(dirty=dirty))
+    route = graph.route(node(0, 0), node(2, 2), pollution_weight=2.0)
+    assert route.found
+    assert (route.exposures == CLEAN).all()
+    assert route.lengths.sum() == pytest.approx(400, abs=0.5)
+
+
+def test_start_and_end_on_the_same_node_is_a_found_empty_route():
+    graph = StreetGraph(grid_layer())
+    route = graph.route(node(1, 1), (node(1, 1)[0] + 3, node(1, 1)[1]))
+    summary = route.summary()
+    assert summary["found"] is True
+    assert summary["segments"] == 0 and summary["length_m"] == 0
+    assert summary["mean_ugm3"] is None
+
+
+def test_requests_near_an_island_snap_onto_the_main_network():
+    graph = StreetGraph(grid_layer(island=True))
+    route = graph.route(node(0, 0), (X0 + 5025, Y0))
+    assert route.found
+    assert route.snap_m[1] > 4000  # Snapped back to the grid, not to the island
+    assert route.lengths.sum() == pytest.approx(200, abs=0.5)
+
+
+def test_layer_without_bands_still_routes():
+    gdf = grid_layer().drop(columns=["rang_mid_ugm3"])
+    with pytest.warns(RuntimeWarning):  # All-NaN bands: every edge gets the mid-range penalty
+        graph = StreetGraph(gdf)
+    route = graph.route(node(0, 0), node(2, 0))
+    assert route.found and route.summary()["mean_ugm3"] is None
+
+
+def test_cleanest_route_takes_wgs84_points_and_reuses_the_graph():
+    gdf = grid_layer()
+    corners = gpd.GeoSeries(gpd.points_from_xy(*zip(node(0, 0), node(2, 1))), crs=METRIC_CRS).to_crs(WGS84)
+    route = cleanest_route(gdf, corners.iloc[0], corners.iloc[1])
+    assert route.found and route.lengths.sum() == pytest.approx(300, abs=0.5)
+    assert street_graph(gdf) is street_graph(gdf)
@@ -0,0 +1,49 @@
+"""Both servers expose Retry-After to cross-origin clients on 503 (warming up) and 429 (at capacity)."""
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import asgi_server
+import Mother2
+
+ORIGIN = "http://localhost:3000"  # The React dev server
+PROMPT = {"prompt": "parks near Clot", "streaming": True, "client_id": "c1"}
+
+
+@pytest.fixture(params=["warming_up", "busy"])
+def server_state(request, monkeypatch):
+    """Not ready yet (503), or ready with every worker busy (429)."""
+    ready = request.param == "busy"
+    warmup = SimpleNamespace(ready=ready, failed=False, start=lambda: None, report=lambda: {})
+    monkeypatch.setattr(Mother2.chat_assistant, "warmup", warmup)
+    monkeypatch.setattr(Mother2.chat_assistant.workers, "admits", lambda: False)
+    return 429 if ready else 503
+
+
+def test_flask_exposes_retry_after(server_state):
+    response = Mother2.app.test_client().post("/process-prompt", json=PROMPT, headers={"Origin": ORIGIN})
+    assert response.status_code == server_state
+    assert int(response.headers["Retry-After"]) > 0
+    assert "Retry-After" in response.headers["Access-Control-Expose-Headers"]
+
+
+def test_asgi_exposes_retry_after(server_state):
+    scope = {"type": "http", "method": "POST", "path": "/process-prompt",
+             "headers": [(b"origin", ORIGIN.encode()), (b"content-type", b"application/json")]}
+    body = json.dumps(PROMPT).encode()
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi_server.app(scope, receive, send))
+    start = sent[0]
+    headers = {name.decode(): value.decode() for name, value in start["headers"]}
+    assert start["status"] == server_state
+    assert int(headers["retry-after"]) > 0
+    assert headers["access-control-expose-headers"] == "Retry-After"
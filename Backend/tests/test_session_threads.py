@@ -0,0 +1,77 @@
+"""SessionThreads against the fake Assistants API: idle threads are released without further traffic."""
+import threading
+import time
+
+import pytest
+from openai import OpenAI
+
+from lapa import SessionThreads
+
+
+@pytest.fixture
+def client(fake_api):
+    state = fake_api()
+    return state, OpenAI(api_key="test-key")
+
+
+def wait_for(condition, timeout=3.0):
+    give_up = time.monotonic() + timeout
+    while not condition() and time.monotonic() < give_up:
+        time.sleep(0.02)
+    return condition()
+
+
+def test_idle_threads_are_deleted_once_traffic_stops(client):
+    state, openai_client = client
+    threads = SessionThreads(openai_client, ttl_s=0.2, sweep_interval_s=0.05)
+    try:
+        for key in ["a", "b"]:
+            with threads.acquire(key):
+                pass
+        assert len(state.threads) == 2
+
+        # No further acquire: the background sweep alone releases them
+        assert wait_for(lambda: len(threads) == 0 and not state.threads)
+    finally:
+        threads.close()
+
+
+def test_surplus_sessions_busy_at_acquire_are_dropped_when_they_finish(client):
+    state, openai_client = client
+    threads = SessionThreads(openai_client, max_threads=1, sweep_interval_s=None)
+    started, finish = threading.Event(), threading.Event()
+
+    def long_run():
+        with threads.acquire("first"):
+            started.set()
+            finish.wait(2)
+
+    runner = threading.Thread(target=long_run)
+    runner.start()
+    assert started.wait(2)
+    with threads.acquire("second"):
+        assert len(threads) == 2  # Over the cap, but both are in use
+        finish.set()
+        runner.join(2)
+        # "first" is released as its run ends, not at some later acquire
+        assert len(threads) == 1
+        assert len(state.threads) == 1
+
+
+def test_busy_session_timeout_reports_the_limit_applied(client):
+    state, openai_client = client
+    threads = SessionThreads(openai_client, sweep_interval_s=None)
+    with threads.acquire("s1"):
+        acquired = {}
+
+        def second():
+            try:
+                with threads.acquire("s1", timeout=1.0):
+                    pass
+            except TimeoutError as e:
+                acquired["error"] = str(e)
+
+        waiter = threading.Thread(target=second)
+        waiter.start()
+        waiter.join(2)
+    assert acquired["error"] == "session s1 is still busy with its previous question after 1s"
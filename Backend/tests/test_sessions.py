@@ -0,0 +1,205 @@
+"""StreamSession coalescing and thread/async waiting, SessionRegistry caps and expiry."""
+import asyncio
+import threading
+from queue import Empty
+
+import pytest
+
+import sessions
+from deadline import Deadline
+from deltastream import DeltaEncoder
+from sessions import SessionLimitError, SessionRegistry, StreamSession
+
+
+def drain(session):
+    events = []
+    while True:
+        try:
+            events.append(session.get(timeout=0))
+        except Empty:
+            return events
+
+
+def rebuild_text(events):
+    """Client-side reassembly (as in App.js): deltas must be contiguous, snapshots replace the text."""
+    text, last_seq = "", 0
+    for event in events:
+        if event["type"] == "delta":
+            assert event.get("first_seq", event["seq"]) == last_seq + 1
+            assert event["offset"] == len(text)
+            text += event["delta"]
+            last_seq = event["seq"]
+        elif event["type"] == "snapshot":
+            text, last_seq = event["content"], event["seq"]
+    return text
+
+
+def delta(seq, offset, text):
+    return {"type": "delta", "seq": seq, "offset": offset, "delta": text}
+
+
+def test_full_queue_merges_contiguous_deltas():
+    session = StreamSession("s", maxsize=2)
+    session.put(delta(1, 0, "ab"))
+    session.put(delta(2, 2, "cd"))
+    session.put(delta(3, 4, "ef"))
+    session.put(delta(4, 6, "gh"))
+
+    events = drain(session)
+    assert len(events) == 2
+    assert events[1] == {"type": "delta", "seq": 4, "first_seq": 2, "offset": 2, "delta": "cdefgh"}
+    assert rebuild_text(events) == "abcdefgh"
+    assert session.coalesced == 2
+
+
+def test_snapshot_supersedes_queued_text_but_keeps_lifecycle_events():
+    session = StreamSession("s", maxsize=3)
+    session.put({"type": "start"})
+    session.put(delta(1, 0, "ab"))
+    session.put(delta(2, 2, "cd"))
+    session.put({"type": "snapshot", "seq": 3, "content": "abcdef"})
+
+    events = drain(session)
+    assert [e["type"] for e in events] == ["start", "snapshot"]
+    assert rebuild_text(events) == "abcdef"
+
+
+def test_progress_events_are_dropped_first_and_terminal_events_always_fit():
+    session = StreamSession("s", maxsize=2)
+    session.put({"type": "status", "message": "old"})
+    session.put(delta(1, 0, "ab"))
+    session.put({"type": "tool", "stage": "code"})  # Replaces the queued status
+    session.put({"type": "complete", "seq": 1})  # Over maxsize, still accepted
+
+    assert [e["type"] for e in drain(session)] == ["delta", "tool", "complete"]
+    assert session.finished
+
+
+def test_closed_session_refuses_events_and_wakes_readers():
+    session = StreamSession("s")
+    woke = threading.Event()
+
+    def reader():
+        with pytest.raises(Empty):
+            session.get(timeout=5)
+        woke.set()
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    session.close()
+    thread.join(2)
+    assert woke.is_set()
+    assert session.put({"type": "status"}) is False
+
+
+def test_slow_consumer_sees_the_whole_text_through_coalescing():
+    """A fast producer thread and a slow reader on a tiny queue: nothing is lost or reordered."""
+    session = StreamSession("s", maxsize=4)
+    words = [f"w{i} " for i in range(3000)]
+    received = []
+
+    def producer():
+        encoder = DeltaEncoder(session.put)
+        for word in words:
+            encoder.append(word)
+            encoder.flush()
+        session.put({"type": "complete", "seq": encoder.seq})
+
+    def consumer():
+        while True:
+            event = session.get(timeout=5)
+            received.append(event)
+            if event["type"] == "complete":
+                return
+
+    threads = [threading.Thread(target=producer), threading.Thread(target=consumer)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert received[-1]["type"] == "complete"
+    assert rebuild_text(received) == "".join(words)
+
+
+def test_get_async_waits_without_a_thread_and_wakes_on_put():
+    session = StreamSession("s")
+
+    async def main():
+        threading.Timer(0.05, session.put, args=({"type": "status", "message": "hi"},)).start()
+        first = await session.get_async(timeout=2)
+        with pytest.raises(Empty):
+            await session.get_async(timeout=0.05)
+        threading.Timer(0.05, session.close).start()
+        with pytest.raises(Empty):
+            await session.get_async(timeout=2)
+        return first
+
+    assert asyncio.run(main())["message"] == "hi"
+    assert session._async_waiters == []
+
+
+def test_closing_an_unfinished_session_cancels_its_deadline():
+    unfinished = StreamSession("a", deadline=Deadline(30))
+    unfinished.close()
+    assert unfinished.deadline.cancelled
+
+    finished = StreamSession("b", deadline=Deadline(30))
+    finished.put({"type": "complete"})
+    finished.close()
+    assert not finished.deadline.cancelled
+
+
+def test_registry_cap_and_claim():
+    registry = SessionRegistry(max_sessions=2)
+    first, second = registry.create(), registry.create()
+    assert first.id != second.id
+    with pytest.raises(SessionLimitError):
+        registry.create()
+
+    assert registry.claim(first.id) is first
+    assert registry.claim(first.id) is None  # A stream is claimed once
+    registry.remove(first.id)
+    assert first.closed
+    assert registry.create() is not None
+
+
+def test_sweep_drops_unclaimed_and_idle_sessions():
+    registry = SessionRegistry()
+    unclaimed, claimed = registry.create(), registry.create()
+    registry.claim(claimed.id)
+
+    unclaimed.created -= sessions.SESSION_UNCLAIMED_TTL_S + 1
+    claimed.created -= sessions.SESSION_UNCLAIMED_TTL_S + 1
+    assert registry.sweep() == 1
+    assert registry.get(unclaimed.id) is None and unclaimed.closed
+    assert registry.get(claimed.id) is claimed
+
+    claimed.last_event -= sessions.SESSION_IDLE_TTL_S + 1
+    assert registry.sweep() == 1
+    assert len(registry) == 0
+
+
+def test_concurrent_creates_never_exceed_the_cap():
+    registry = SessionRegistry(max_sessions=50)
+    created, refused = [], []
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(20):
+            try:
+                session = registry.create()
+                with lock:
+                    created.append(session.id)
+            except SessionLimitError:
+                with lock:
+                    refused.append(1)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(created) == 50 and len(set(created)) == 50
+    assert len(refused) == 8 * 20 - 50
@@ -0,0 +1,127 @@
+"""Single-flight keys, leader election under concurrency, replay and subscriber lifecycle."""
+import threading
+from queue import Empty
+
+from deadline import Deadline
+from sessions import StreamSession
+from singleflight import SingleFlight, SharedJob, flight_key, normalize_prompt
+
+
+def drain(session):
+    events = []
+    while True:
+        try:
+            events.append(session.get(timeout=0))
+        except Empty:
+            return events
+
+
+def subscriber(name):
+    return StreamSession(name, deadline=Deadline(60))
+
+
+def test_normalize_prompt_folds_case_accents_spacing_and_punctuation():
+    assert normalize_prompt("Bicing near  Clot?") == "bicing near clot"
+    assert normalize_prompt("  Parcs a GRÀCIA!! ") == "parcs a gracia"
+    assert flight_key("Parks?", "v1") == flight_key("parks", "v1") != flight_key("parks", "v2")
+
+
+def test_exactly_one_leader_among_concurrent_identical_requests():
+    flights = SingleFlight()
+    barrier = threading.Barrier(20)
+    outcomes = []
+
+    def request():
+        barrier.wait()
+        outcomes.append(flights.join_or_start("v1:parks", lambda: Deadline(60)))
+
+    threads = [threading.Thread(target=request) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [leader for _, leader in outcomes].count(True) == 1
+    assert len({id(job) for job, _ in outcomes}) == 1
+    assert flights.joined == 19
+    assert flights.stats()['in_flight'] == 1
+
+
+def test_unkeyed_requests_always_get_a_private_job():
+    flights = SingleFlight()
+    first, first_leads = flights.join_or_start(None, lambda: Deadline(60))
+    second, second_leads = flights.join_or_start(None, lambda: Deadline(60))
+    assert first_leads and second_leads and first is not second
+    assert flights.stats()['in_flight'] == 0
+
+
+def test_late_joiner_gets_the_replay_then_live_events():
+    job = SharedJob("k", Deadline(60))
+    early = subscriber("early")
+    job.subscribe(early)
+    job.publish({"type": "start"})
+    job.publish({"type": "delta", "seq": 1, "offset": 0, "delta": "Hello "})
+
+    late = subscriber("late")
+    assert job.subscribe(late, member="client-b")
+    job.publish({"type": "delta", "seq": 2, "offset": 6, "delta": "world"})
+    job.publish({"type": "complete", "seq": 2})
+
+    assert drain(early) == drain(late) == job.events
+    assert job.result["type"] == "complete"
+    assert job.members == ["client-b"]
+
+
+def test_one_subscriber_leaving_does_not_cancel_the_job_but_the_last_one_does():
+    job = SharedJob("k", Deadline(60))
+    first, second = subscriber("a"), subscriber("b")
+    job.subscribe(first)
+    job.subscribe(second)
+
+    first.deadline.cancel("client disconnected")
+    assert job.subscriber_count == 1
+    assert not job.deadline.cancelled
+
+    second.deadline.cancel("client disconnected")
+    assert job.subscriber_count == 0
+    assert job.deadline.cancelled
+    assert job.deadline.stop_reason == "cancelled: every client left"
+
+
+def test_finished_jobs_are_forgotten_and_not_joined():
+    flights = SingleFlight()
+    job, _ = flights.join_or_start("v1:parks", lambda: Deadline(60))
+    job.subscribe(subscriber("a"))
+    job.publish({"type": "complete", "seq": 0})
+
+    assert not flights.joinable("v1:parks")
+    late = subscriber("late")
+    assert job.subscribe(late, member="client-c") is False
+    assert drain(late) == job.events
+    assert job.members == []
+
+    # Leaving after the job finished does not cancel it
+    late.deadline.cancel("client disconnected")
+    assert not job.deadline.cancelled
+
+    next_job, leads = flights.join_or_start("v1:parks", lambda: Deadline(60))
+    assert leads and next_job is not job
+
+
+def test_expired_jobs_are_not_joined():
+    flights = SingleFlight()
+    job, _ = flights.join_or_start("v1:parks", lambda: Deadline(60))
+    job.deadline.cancel("stream timed out")
+    fresh, leads = flights.join_or_start("v1:parks", lambda: Deadline(60))
+    assert leads and fresh is not job
+
+
+def test_closed_subscribers_are_dropped_from_the_fan_out():
+    job = SharedJob("k", Deadline(60))
+    gone, staying = subscriber("gone"), subscriber("staying")
+    job.subscribe(gone)
+    job.subscribe(staying)
+    gone.close()
+
+    job.publish({"type": "status", "message": "working"})
+    assert job.subscribers == [staying]
@@ -0,0 +1,79 @@
+"""ProjectionCache radius and nearest queries against brute-force projected distances."""
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import Point
+
+from spatial import METRIC_CRS, WGS84, ProjectionCache, project_point, standardize_layer
+
+CENTER = Point(2.17, 41.39)  # Eixample, Barcelona
+
+
+def random_points(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return shapely.points(2.17 + rng.uniform(-0.03, 0.03, n), 41.39 + rng.uniform(-0.02, 0.02, n))
+
+
+def point_layer():
+    return standardize_layer(gpd.GeoDataFrame({"id": range(500)}, geometry=random_points(500), crs=WGS84))
+
+
+def polygon_layer():
+    # Buffers in degrees: irregular enough that the bounding box and representative point often disagree
+    rng = np.random.default_rng(1)
+    polygons = shapely.buffer(random_points(300, seed=2), rng.uniform(0.0005, 0.004, 300))
+    return standardize_layer(gpd.GeoDataFrame({"id": range(300)}, geometry=polygons, crs=WGS84))
+
+
+def raw_line_layer():
+    # Not standardized: the cache projects the whole layer itself
+    starts = shapely.get_coordinates(random_points(200, seed=3))
+    ends = starts + np.random.default_rng(4).uniform(-0.004, 0.004, starts.shape)
+    lines = shapely.linestrings(np.stack([starts, ends], axis=1))
+    return gpd.GeoDataFrame({"id": range(200)}, geometry=lines, crs=WGS84)
+
+
+def brute_force_distances(gdf):
+    return gdf.geometry.to_crs(METRIC_CRS).distance(Point(*project_point(CENTER))).to_numpy()
+
+
+@pytest.mark.parametrize("make_layer", [point_layer, polygon_layer, raw_line_layer])
+def test_indices_within_matches_brute_force(make_layer):
+    gdf = make_layer()
+    cache = ProjectionCache()
+    exact = brute_force_distances(gdf)
+
+    for radius_km in [0.0, 0.3, 0.75, 1.5, 3.0, 10.0]:
+        expected = np.flatnonzero(exact <= radius_km * 1000)
+        got = cache.indices_within(gdf, CENTER, radius_km)
+        np.testing.assert_array_equal(got, expected, err_msg=f"radius {radius_km} km")
+
+
+@pytest.mark.parametrize("make_layer", [point_layer, polygon_layer, raw_line_layer])
+def test_nearest_and_distances_match_brute_force(make_layer):
+    gdf = make_layer()
+    cache = ProjectionCache()
+    exact = brute_force_distances(gdf)
+
+    position, metres = cache.nearest(gdf, CENTER)
+    assert position == int(np.argmin(exact))
+    assert metres == pytest.approx(exact.min(), abs=1e-6)
+    np.testing.assert_allclose(cache.distances(gdf, CENTER), exact, atol=1e-6)
+
+
+def test_radius_queries_stay_correct_after_the_layer_changes():
+    gdf = point_layer()
+    cache = ProjectionCache()
+    before = cache.indices_within(gdf, CENTER, 1.0)
+
+    smaller = gdf.iloc[::2]  # A new frame: the cache must not reuse the old distances
+    expected = np.flatnonzero(brute_force_distances(smaller) <= 1000)
+    np.testing.assert_array_equal(cache.indices_within(smaller, CENTER, 1.0), expected)
+    assert len(expected) < len(before)
+
+
+def test_empty_layer_has_no_nearest_feature():
+    gdf = gpd.GeoDataFrame({"id": []}, geometry=gpd.GeoSeries([], crs=WGS84), crs=WGS84)
+    position, metres = ProjectionCache().nearest(gdf, CENTER)
+    assert position == -1 and np.isnan(metres)
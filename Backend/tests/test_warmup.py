@@ -0,0 +1,67 @@
+"""The warm-up loads layers once; queries get their own copy of the same layer and its indexes."""
+import os
+
+import pytest
+
+import DataCollect03
+from DataCollect03 import DataCollectorAgent, load_layer
+from pollution import get_pollution_raster
+from routing import street_graph
+from spatial import projection_cache
+from warmup import warm_layers, warm_pollution_raster
+
+POLLUTION_CSV = (
+    "TRAM,Rang,geometry_wkt\n"
+    'T1,20-25 µg/m³,"LINESTRING (2.164 41.427, 2.165 41.428)"\n'
+    'T2,35-40 µg/m³,"LINESTRING (2.197 41.404, 2.198 41.405)"\n'
+)
+
+
+@pytest.fixture
+def reads(data_env, monkeypatch):
+    (data_env / "air_pollution_levels.csv").write_text(POLLUTION_CSV, encoding="utf-8")
+    calls = []
+    read_layer = DataCollect03._read_layer
+    monkeypatch.setattr(DataCollect03, "_read_layer", lambda path, nrows=None: calls.append(path) or read_layer(path, nrows))
+    return calls
+
+
+def test_queries_reuse_what_the_warm_up_loaded(reads, data_env):
+    warm_layers()
+    warm_pollution_raster()
+    assert len(reads) == 2  # stops.csv and air_pollution_levels.csv, once each
+
+    collector = DataCollectorAgent("test-key", data_dir=str(data_env))
+    all_data, _ = collector.fetch_data([{"name": "Air Pollution Levels", "source": "other", "tag": "air_pollution_levels"},
+                                        {"name": "Stops", "source": "other", "tag": "stops"}], {})
+    pollution, stops = all_data["air_pollution_levels"].resolve(), all_data["stops"].resolve()
+    assert len(reads) == 2
+
+    warmed_stops = load_layer(str(data_env / "stops.csv"))
+    assert stops is not warmed_stops
+    assert projection_cache.point_index(stops) is projection_cache.point_index(warmed_stops)
+    warmed = load_layer(str(data_env / "air_pollution_levels.csv"))
+    assert street_graph(pollution) is street_graph(warmed)
+    assert get_pollution_raster(pollution) is get_pollution_raster(warmed)
+
+
+def test_each_caller_changes_only_its_own_copy(reads, data_env):
+    path = str(data_env / "air_pollution_levels.csv")
+    first = load_layer(path)
+    first["distance"] = 1.0
+    first.loc[0, "rang_mid_ugm3"] = 99.0
+
+    second = load_layer(path)
+    assert "distance" not in second.columns
+    assert second["rang_mid_ugm3"].tolist() == [22.5, 37.5]
+    assert len(reads) == 1
+
+
+def test_a_changed_file_is_read_again(reads, data_env):
+    path = data_env / "air_pollution_levels.csv"
+    load_layer(str(path))
+    path.write_text(POLLUTION_CSV + 'T3,> 40 µg/m³,"LINESTRING (2.170 41.390, 2.171 41.391)"\n', encoding="utf-8")
+    os.utime(path, ns=(0, 0))  # Whatever the clock resolution, the signature changes
+
+    assert len(load_layer(str(path))) == 3
+    assert len(reads) == 2
@@ -0,0 +1,84 @@
+"""WorkerPool admission control: capacity, rejections and release of finished jobs."""
+import threading
+import time
+
+import pytest
+
+from workers import PoolSaturatedError, WorkerPool
+
+
+def wait_until(condition, timeout=2.0):
+    stop = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > stop:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_full_pool_refuses_jobs_and_counts_rejections():
+    pool = WorkerPool(workers=2, max_queued=1, name="test")
+    gate = threading.Event()
+    futures = [pool.submit(gate.wait) for _ in range(3)]
+
+    assert pool.stats() == {'workers': 2, 'max_queued': 1, 'in_flight': 3, 'busy': 2, 'queued': 1, 'rejected': 0}
+    assert not pool.admits()
+    with pytest.raises(PoolSaturatedError):
+        pool.submit(gate.wait)
+    assert pool.rejected == 2
+
+    gate.set()
+    for future in futures:
+        future.result(timeout=2)
+    assert wait_until(lambda: pool.in_flight == 0)
+    assert pool.admits()
+
+
+def test_failing_jobs_release_their_slot():
+    pool = WorkerPool(workers=1, max_queued=0, name="test")
+    future = pool.submit(lambda: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        future.result(timeout=2)
+    assert wait_until(lambda: pool.in_flight == 0)
+    assert pool.submit(lambda: "ok").result(timeout=2) == "ok"
+
+
+def test_concurrent_submits_never_exceed_capacity():
+    pool = WorkerPool(workers=3, max_queued=5, name="test")
+    gate = threading.Event()
+    running, peak = [0], [0]
+    lock = threading.Lock()
+    accepted, refused = [], []
+    barrier = threading.Barrier(12)
+
+    def job():
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        gate.wait()
+        with lock:
+            running[0] -= 1
+
+    def client():
+        barrier.wait()
+        for _ in range(5):
+            try:
+                accepted.append(pool.submit(job))
+            except PoolSaturatedError:
+                refused.append(1)
+
+    threads = [threading.Thread(target=client) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(accepted) == pool.capacity == 8
+    assert len(refused) == 12 * 5 - 8 == pool.rejected
+    assert pool.in_flight == 8
+
+    gate.set()
+    for future in accepted:
+        future.result(timeout=2)
+    assert peak[0] == 3
+    assert wait_until(lambda: pool.in_flight == 0)
@@ -0,0 +1,125 @@
+"""
+Background warm-up for the servers.
+
+Start-up work (assistant uploads, dataset loads and the indexes and grids
+derived from them) runs on a background thread, so the server binds its port
+and answers /health immediately. Readiness is reported separately and turns
+true once every required step has finished. Optional steps keep warming
+caches afterwards. Their results land in process-wide memos (gazetteer,
+transit grid, the loaded layers with their indexes) or in the cache dir
+(pollution raster), where later queries (and other processes) find them.
+"""
+import os
+import threading
+import time
+
+from config import get_data_dir
+
+WARMUP_RETRY_AFTER_S = 5  # Retry hint for requests that arrive before the server is ready
+
+
+class Warmup:
+    """Named start-up steps run in order on one background thread."""
+
+    def __init__(self):
+        self.steps = []  # (name, fn, required)
+        self.status = {}  # name -> {'state': pending|running|done|failed, 'required', 'seconds', 'error'}
+        self.started_at = None
+        self.finished = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def add(self, name, fn, required=False):
+        self.steps.append((name, fn, required))
+        self.status[name] = {'state': 'pending', 'required': required, 'seconds': None, 'error': None}
+        return self
+
+    def start(self):
+        """Starts the warm-up thread once; later calls do nothing."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.started_at = time.monotonic()
+            self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+            self._thread.start()
+
+    @property
+    def started(self):
+        return self._thread is not None
+
+    def _run(self):
+        # Required steps first so readiness does not wait for optional cache warming
+        for name, fn, _ in sorted(self.steps, key=lambda step: not step[2]):
+            status = self.status[name]
+            status['state'] = 'running'
+            began = time.monotonic()
+            try:
+                if fn() is False:
+                    raise RuntimeError(f"{name} did not complete")
+                status['state'] = 'done'
+            except Exception as e:
+                status['state'] = 'failed'
+                status['error'] = str(e)
+                print(f"⚠️ Warm-up step {name} failed: {e}")
+            status['seconds'] = round(time.monotonic() - began, 2)
+            print(f"🔥 Warm-up {name}: {status['state']} ({status['seconds']}s)")
+        self.finished.set()
+
+    @property
+    def ready(self):
+        """True once every required step has succeeded."""
+        return self.started and all(s['state'] == 'done' for s in self.status.values() if s['required'])
+
+    @property
+    def failed(self):
+        """True if a required step failed (the server will not become ready without a restart)."""
+        return any(s['state'] == 'failed' for s in self.status.values() if s['required'])
+
+    def report(self):
+        return {
+            'ready': self.ready,
+            'finished': self.finished.is_set(),
+            'elapsed_s': round(time.monotonic() - self.started_at, 2) if self.started_at else None,
+            'steps': {name: dict(status) for name, status in self.status.items()},
+        }
+
+
+def warm_gazetteer():
+    from gazetteer import get_gazetteer
+    print(f"📍 Gazetteer: {len(get_gazetteer())} neighbourhoods and districts")
+
+
+def warm_transit_grid():
+    from accessibility import get_accessibility_surface
+    get_accessibility_surface()
+
+
+def warm_layers():
+    """
+    Loads every local CSV through the loader queries use (DataCollect03.load_layer).
+    The loaded layers, their point indexes, band bitmaps and street graph are kept
+    for the process, and each query's fetch_data is handed a copy of the same layer.
+    """
+    from DataCollect03 import load_layer
+
+    data_dir = get_data_dir()
+    if not os.path.isdir(data_dir):
+        return
+    for name in sorted(os.listdir(data_dir)):
+        if name.endswith(".csv"):
+            print(f"📂 {name}: {len(load_layer(os.path.join(data_dir, name)))} rows")
+
+
+def warm_pollution_raster():
+    """
+    Builds (or checks) the pollution layer's exposure raster on the shared loaded
+    layer, so queries find it memoized in memory (and other processes find it in
+    the cache dir, memory-mapped instead of rebuilt).
+    """
+    from DataCollect03 import load_layer
+    from pollution import get_pollution_raster
+
+    path = os.path.join(get_data_dir(), "air_pollution_levels.csv")
+    if not os.path.exists(path):
+        return
+    get_pollution_raster(load_layer(path))
@@ -0,0 +1,70 @@
+"""
+Bounded worker pool for the blocking agent work behind the servers.
+
+Each streamed question runs on one pool thread (the assistant run, its event
+stream and any tool work). The pool has a fixed number of workers and a
+bounded backlog. A question that finds both full is refused at admission with
+a retry hint, instead of spawning another thread. Open SSE connections do not
+hold a worker; they only wait on their session queue.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WORKERS = int(os.environ.get('CITYTALK_WORKERS', 16))
+DEFAULT_MAX_QUEUED = int(os.environ.get('CITYTALK_MAX_QUEUED_JOBS', 64))  # Admitted jobs waiting for a worker
+SATURATED_RETRY_AFTER_S = 10
+
+
+class PoolSaturatedError(Exception):
+    """Raised when every worker is busy and the backlog is full."""
+
+
+class WorkerPool:
+    """ThreadPoolExecutor with admission control: at most workers + max_queued jobs in flight."""
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_queued=DEFAULT_MAX_QUEUED, name="agent"):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.capacity = workers + max_queued
+        self.in_flight = 0
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+
+    def admits(self):
+        """False (and counted as a rejection) when a new job would not fit right now."""
+        with self._lock:
+            if self.in_flight < self.capacity:
+                return True
+            self.rejected += 1
+            return False
+
+    def submit(self, fn, *args, **kwargs):
+        """Queues fn(*args, **kwargs); raises PoolSaturatedError instead of queueing past capacity."""
+        with self._lock:
+            if self.in_flight >= self.capacity:
+                self.rejected += 1
+                raise PoolSaturatedError(f"{self.in_flight} jobs in flight ({self.workers} workers, {self.max_queued} queued)")
+            self.in_flight += 1
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'max_queued': self.max_queued,
+            'in_flight': self.in_flight,
+            'busy': min(self.in_flight, self.workers),
+            'queued': max(0, self.in_flight - self.workers),
+            'rejected': self.rejected,
+        }
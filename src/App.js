@@ -1,6 +1,18 @@
 import React, { useState } from 'react';
 import styled, { keyframes, css } from 'styled-components';
 
+const BUSY_RETRIES = 12;  // Backend warm-up (503) and full job queues (429) normally clear well within a minute
+
+// Identifies this browser tab so the backend keeps its questions in one conversation thread
+const getClientId = () => {
+  let clientId = window.sessionStorage.getItem('citytalkClientId');
+  if (!clientId) {
+    clientId = `client_${Date.now()}_${Math.random().toString(36).slice(2, 10)}`;
+    window.sessionStorage.setItem('citytalkClientId', clientId);
+  }
+  return clientId;
+};
+
 const typingPulse = keyframes`
   0%, 50%, 100% { opacity: 1; }
   25%, 75% { opacity: 0.5; }
@@ -314,6 +326,10 @@ function App() {
     const eventSource = new EventSource(`http://127.0.0.1:5000/stream/${sessionId}`);
     let streamingMessageId = null;
     let streamTimeout = null;
+    // Delta protocol state: text received so far, last applied frame, and whether a frame was missed
+    let streamText = '';
+    let lastSeq = 0;
+    let outOfSync = false;
     
     console.log(`🔗 Connecting to stream: ${sessionId}`);
     
@@ -363,16 +379,39 @@ function App() {
             }]);
             break;
             
-          case 'content':
-            // Update streaming message content
-            setChatHistory(prev => 
-              prev.map(msg => 
-                msg.id === streamingMessageId 
-                  ? { ...msg, content: data.content }
-                  : msg
-              )
-            );
-            setStreamingStatus(`Writing... ${Math.round(data.progress * 100)}%`);
+          case 'delta':
+          case 'snapshot':
+            if (data.type === 'snapshot') {
+              // Full text for resync; also confirms the deltas applied so far
+              streamText = data.content;
+              outOfSync = false;
+            } else if (!outOfSync && (data.first_seq || data.seq) === lastSeq + 1 && data.offset === streamText.length) {
+              // first_seq is set when the server merged several frames for a slow connection
+              streamText += data.delta;
+            } else {
+              outOfSync = true;  // Wait for the next snapshot (or the final content)
+              break;
+            }
+            lastSeq = data.seq;
+            {
+              const text = streamText;
+              setChatHistory(prev => 
+                prev.map(msg => 
+                  msg.id === streamingMessageId 
+                    ? { ...msg, content: text }
+                    : msg
+                )
+              );
+            }
+            setStreamingStatus('Writing...');
+            break;
+            
+          case 'tool':
+            // Code-interpreter progress while the assistant analyses the data
+            setStreamingStatus(data.message);
+            if (data.stage === 'output') {
+              console.log('🧮 Code output:', data.logs);
+            }
             break;
             
           case 'complete':
@@ -470,18 +509,32 @@ function App() {
     setMapError(null);
     
     try {
-      const response = await fetch('http://127.0.0.1:5000/process-prompt', {
+      const request = () => fetch('http://127.0.0.1:5000/process-prompt', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
         },
         body: JSON.stringify({ 
           prompt: userMessage,
-          streaming: true 
+          streaming: true,
+          client_id: getClientId()
         })
       });
 
-      const data = await response.json();
+      // While the backend is warming up (503) or at capacity (429) it answers with a Retry-After hint
+      const busy = (response, data) => (response.status === 503 && data.warming_up) || response.status === 429;
+      let response = await request();
+      let data = await response.json();
+      for (let attempt = 0; busy(response, data) && attempt < BUSY_RETRIES; attempt++) {
+        const retryAfter = Number(response.headers.get('Retry-After')) || data.retry_after_s || 5;
+        setStreamingStatus(response.status === 429
+          ? `Server is busy, retrying in ${retryAfter}s...`
+          : `Assistant is warming up, retrying in ${retryAfter}s...`);
+        await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+        response = await request();
+        data = await response.json();
+      }
+      setStreamingStatus(null);
       
       if (data.error) {
         console.error('Error:', data.error);